@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""Compares the per-request cost of matching update queries against Rules with
+the match* functions in auslib.util.rulematching (which re-parse each Rule
+column on every call) and with precompiled CompiledRules.
+
+The Rules and queries are synthetic, but are shaped like the ones that broad
+products (eg: Firefox nightly) have: many Rules per buildTarget, most of them
+with channel globs, version comparisons, buildID comparisons and
+osVersion/locale lists."""
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from auslib.util.rulematching import (  # noqa: E402
+    CompiledRule,
+    matchBoolean,
+    matchBuildID,
+    matchChannel,
+    matchCsv,
+    matchLocale,
+    matchMemory,
+    matchSimpleExpression,
+    matchVersion,
+)
+from auslib.util.versions import MozillaVersion  # noqa: E402
+
+CHANNELS = ("nightly", "nightly*", "aurora", "beta", "beta*", "release", "release*", "esr", None)
+OS_VERSIONS = (None, "Windows_NT 5.1,Windows_NT 5.2", "Windows_NT 6.1 && AMD", "Darwin 15,Darwin 16,Darwin 17")
+LOCALES = (None, "de,en-US,fr", "ja,ja-JP-mac,zh-CN,zh-TW")
+
+
+def make_rules(count, rand):
+    rules = []
+    for rule_id in range(count):
+        major = rand.randint(50, 130)
+        rules.append(
+            dict(
+                rule_id=rule_id,
+                priority=rand.randint(0, 1000),
+                channel=rand.choice(CHANNELS),
+                version=rand.choice((None, "<%d.0" % major, ">=%d.0" % major, "%d.0,%d.0.1" % (major, major), "%d.*" % major)),
+                buildID=rand.choice((None, "<%d" % rand.randint(20200101000000, 20251231000000))),
+                memory=rand.choice((None, None, None, "<2048")),
+                osVersion=rand.choice(OS_VERSIONS),
+                instructionSet=rand.choice((None, None, "SSE", "SSE,SSE2")),
+                distribution=rand.choice((None, None, None, "default,acer")),
+                locale=rand.choice(LOCALES),
+                mig64=rand.choice((None, None, None, True, False)),
+                jaws=rand.choice((None, None, None, False)),
+            )
+        )
+    return rules
+
+
+def make_queries(count, rand):
+    queries = []
+    for _ in range(count):
+        queries.append(
+            dict(
+                product="Firefox",
+                channel=rand.choice(("nightly", "beta", "release", "release-cck-foo", "esr")),
+                version="%d.0" % rand.randint(50, 130),
+                buildID=str(rand.randint(20200101000000, 20251231000000)),
+                memory=rand.choice(("1024", "8192")),
+                osVersion=rand.choice(("Windows_NT 6.1.0.0 (x64)", "Darwin 17.7.0", "Windows_NT 5.1.2.0 AMD")),
+                instructionSet=rand.choice(("SSE", "SSE2", "SSE4_2")),
+                distribution="default",
+                locale=rand.choice(("en-US", "de", "ja")),
+                mig64=rand.choice((None, True, False)),
+                jaws=False,
+            )
+        )
+    return queries
+
+
+def match_uncompiled(rule, updateQuery, fallbackChannel):
+    # This mirrors the matching loop that Rules.getRulesMatchingQuery used
+    # before rules were compiled.
+    return (
+        matchChannel(rule["channel"], updateQuery["channel"], fallbackChannel)
+        and matchVersion(rule["version"], updateQuery["version"], MozillaVersion)
+        and matchBuildID(rule["buildID"], updateQuery.get("buildID", ""))
+        and matchMemory(rule["memory"], updateQuery.get("memory"))
+        and matchSimpleExpression(rule["osVersion"], updateQuery.get("osVersion", ""))
+        and matchCsv(rule["instructionSet"], updateQuery.get("instructionSet", ""), substring=False)
+        and matchCsv(rule["distribution"], updateQuery.get("distribution", ""), substring=False)
+        and matchLocale(rule["locale"], updateQuery.get("locale", ""))
+        and matchBoolean(rule["mig64"], updateQuery.get("mig64"))
+        and matchBoolean(rule["jaws"], updateQuery.get("jaws"))
+    )
+
+
+def run_uncompiled(rules, queries):
+    matches = 0
+    for query in queries:
+        fallbackChannel = query["channel"].split("-cck-")[0]
+        for rule in rules:
+            if match_uncompiled(rule, query, fallbackChannel):
+                matches += 1
+    return matches
+
+
+def run_compiled(rules, queries):
+    matches = 0
+    for query in queries:
+        fallbackChannel = query["channel"].split("-cck-")[0]
+        for rule in rules:
+            if rule.matchesQuery(query, fallbackChannel, MozillaVersion):
+                matches += 1
+    return matches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rules", type=int, default=300, help="Number of candidate Rules per query")
+    parser.add_argument("--queries", type=int, default=1000, help="Number of update queries per run")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs to take the best time from")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    rules = make_rules(args.rules, rand)
+    compiled = [CompiledRule(rule) for rule in rules]
+    queries = make_queries(args.queries, rand)
+
+    expected = run_uncompiled(rules, queries)
+    actual = run_compiled(compiled, queries)
+    if expected != actual:
+        sys.exit("Compiled rules matched %d times, uncompiled rules matched %d times!" % (actual, expected))
+
+    uncompiled_time = min(timeit.repeat(lambda: run_uncompiled(rules, queries), number=1, repeat=args.repeat))
+    compiled_time = min(timeit.repeat(lambda: run_compiled(compiled, queries), number=1, repeat=args.repeat))
+    compile_time = min(timeit.repeat(lambda: [CompiledRule(rule) for rule in rules], number=1, repeat=args.repeat))
+
+    print("%d queries against %d rules (%d matches)" % (args.queries, args.rules, expected))
+    print("uncompiled: %8.1f us/query" % (uncompiled_time / args.queries * 1e6))
+    print("compiled:   %8.1f us/query (%.1fx faster)" % (compiled_time / args.queries * 1e6, uncompiled_time / compiled_time))
+    print("compiling all rules (warm compile caches): %.1f ms" % (compile_time * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""Compares the cost of the version parsing and comparisons that update
+requests do when Rules are matched (version columns like "<60.0" or
+"60.0,60.0.1") and when Releases decide whether they should be served (the
+query's version against the Release's, and the Release's against a pin), with
+interned version objects and sort key comparisons, and without them.
+
+"Without" parses a new object for every version string (skipping the dispatch
+that MozillaVersion does to pick a class, so it slightly flatters the old code)
+and compares them with _cmp, like every version comparison used to.
+
+The versions are synthetic, but like real traffic, most requests come from a
+small number of versions."""
+
+import argparse
+import operator
+import os
+import random
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from auslib.util.comparison import get_op  # noqa: E402
+from auslib.util.versions import MozillaVersion, PinVersion  # noqa: E402
+
+CMP_OPS = {
+    operator.eq: lambda c: c == 0,
+    operator.lt: lambda c: c < 0,
+    operator.le: lambda c: c <= 0,
+    operator.gt: lambda c: c > 0,
+    operator.ge: lambda c: c >= 0,
+}
+
+
+def make_rule_versions(count, rand):
+    versions = []
+    for _ in range(count):
+        major = rand.randint(50, 130)
+        versions.append(rand.choice(("<%d.0" % major, ">=%d.0" % major, "%d.0,%d.0.1" % (major, major), "<=%d.0a1" % major)))
+    return versions
+
+
+def make_queries(count, rand):
+    # Most clients are on one of the last few releases.
+    popular = ["%d.0%s" % (major, suffix) for major in range(120, 130) for suffix in ("", ".1", ".2", "a1")]
+    queries = []
+    for _ in range(count):
+        if rand.random() < 0.9:
+            version = rand.choice(popular)
+        else:
+            version = "%d.%d.%d" % (rand.randint(50, 130), rand.randint(0, 3), rand.randint(0, 3))
+        queries.append(
+            dict(
+                version=version,
+                release_version=rand.choice(("128.0", "128.0.1", "129.0")),
+                pin=rand.choice((None, None, None, "115.", "128.0.")),
+            )
+        )
+    return queries
+
+
+CLASSES = {}
+
+
+def fresh(version):
+    if version not in CLASSES:
+        CLASSES[version] = type(MozillaVersion(version))
+    return type.__call__(CLASSES[version], version)
+
+
+def fresh_pin(version):
+    return type.__call__(PinVersion, version)
+
+
+def run_rules_uninterned(rule_ops, queries):
+    matches = 0
+    for query in queries:
+        for ops in rule_ops:
+            for opfunc, operand in ops:
+                if CMP_OPS[opfunc](fresh(query["version"])._cmp(fresh(operand))):
+                    matches += 1
+                    break
+    return matches
+
+
+def run_rules_interned(rule_ops, queries):
+    matches = 0
+    for query in queries:
+        for ops in rule_ops:
+            for opfunc, operand in ops:
+                if opfunc(MozillaVersion(query["version"]), MozillaVersion(operand)):
+                    matches += 1
+                    break
+    return matches
+
+
+def run_serve_uninterned(queries):
+    served = 0
+    for query in queries:
+        releaseVersion = fresh(query["release_version"])
+        queryVersion = fresh(query["version"])
+        if queryVersion._cmp(releaseVersion) > 0 or releaseVersion._cmp(queryVersion) == 0:
+            continue
+        if query["pin"] is not None and fresh_pin(query["pin"])._cmp(releaseVersion) < 0:
+            continue
+        served += 1
+    return served
+
+
+def run_serve_interned(queries):
+    served = 0
+    for query in queries:
+        releaseVersion = MozillaVersion(query["release_version"])
+        queryVersion = MozillaVersion(query["version"])
+        if queryVersion > releaseVersion or releaseVersion == queryVersion:
+            continue
+        if query["pin"] is not None and releaseVersion > PinVersion(query["pin"]):
+            continue
+        served += 1
+    return served
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rules", type=int, default=50, help="Number of Rule version columns checked per query")
+    parser.add_argument("--queries", type=int, default=10000, help="Number of update queries per run")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs to take the best time from")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    rule_ops = [[get_op(v) for v in rule.split(",")] for rule in make_rule_versions(args.rules, rand)]
+    queries = make_queries(args.queries, rand)
+
+    for name, uninterned, interned in (
+        ("rule matching", lambda: run_rules_uninterned(rule_ops, queries), lambda: run_rules_interned(rule_ops, queries)),
+        ("shouldServeUpdate", lambda: run_serve_uninterned(queries), lambda: run_serve_interned(queries)),
+    ):
+        expected, actual = uninterned(), interned()
+        if expected != actual:
+            sys.exit("%s: interned versions gave %d, uninterned versions gave %d!" % (name, actual, expected))
+
+        uninterned_time = min(timeit.repeat(uninterned, number=1, repeat=args.repeat))
+        interned_time = min(timeit.repeat(interned, number=1, repeat=args.repeat))
+        print("%s (%d queries, result %d)" % (name, args.queries, expected))
+        print("  uninterned: %8.2f us/query" % (uninterned_time / args.queries * 1e6))
+        print("  interned:   %8.2f us/query (%.1fx faster)" % (interned_time / args.queries * 1e6, uninterned_time / interned_time))
+
+    print("MozillaVersion interning: %s" % (MozillaVersion.cache_info(),))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,12 @@ import re
 from random import randint
 from urllib.parse import urlparse
 
-from auslib.blobs.base import ServeUpdate, createBlob
+from repoze.lru import LRUCache
+
+from auslib.blobs.base import ServeUpdate
 from auslib.global_state import cache, dbo
 from auslib.services import releases
+from auslib.util.memo import memoize, memoize_many
 from auslib.util.versions import PinVersion
 
 
@@ -32,32 +35,78 @@ def isSpecialURL(url, specialForceHosts):
     return False
 
 
-def isForbiddenUrl(url, product, allowlistedDomains):
-    if allowlistedDomains is None:
-        allowlistedDomains = []
+# The most (url, product) verdicts that a DomainAllowlist remembers.
+ALLOWLIST_VERDICTS = 10000
+
+_unchecked = object()
+
+
+def _checkUrl(url, product, allowlistedDomains, compiledPaths):
+    """Returns the warning to log (as logging.warning arguments) if url is
+    forbidden for product, or None if it's allowed. compiledPaths maps domains
+    with path restrictions to their compiled patterns and products, or is None
+    if the patterns in allowlistedDomains haven't been compiled."""
     parsedUrl = urlparse(url)
     domain = parsedUrl.netloc
     if domain not in allowlistedDomains:
-        logging.warning("Forbidden domain: %s", domain)
-        return True
+        return ("Forbidden domain: %s", domain)
     allowlistedDomain = allowlistedDomains[domain]
     if isinstance(allowlistedDomain, tuple):
         if product in allowlistedDomain:
-            return False
-        logging.warning("Forbidden domain for product %s: %s", product, domain)
+            return None
+        return ("Forbidden domain for product %s: %s", product, domain)
     elif isinstance(allowlistedDomain, dict):
         path = parsedUrl.path
-        for pathRegex in allowlistedDomain:
-            if not re.fullmatch(pathRegex, path):
+        if compiledPaths is None:
+            paths = [(re.compile(pathRegex), products) for pathRegex, products in allowlistedDomain.items()]
+        else:
+            paths = compiledPaths[domain]
+        for pathRegex, products in paths:
+            if not pathRegex.fullmatch(path):
                 continue
-            if product in allowlistedDomain[pathRegex]:
-                return False
-            logging.warning("Forbidden domain/path for product %s: %s (%s)", product, domain, path)
-            return True
-        logging.warning("Forbidden domain/path: %s (%s)", domain, path)
+            if product in products:
+                return None
+            return ("Forbidden domain/path for product %s: %s (%s)", product, domain, path)
+        return ("Forbidden domain/path: %s (%s)", domain, path)
+    return ("Forbidden domain, malformed entry: %s", domain)
+
+
+class DomainAllowlist(dict):
+    """A domain allowlist (see isForbiddenUrl) with its path patterns compiled,
+    which remembers what it decided for the URLs that it checked most recently.
+    It must not be modified after it's created."""
+
+    def __init__(self, allowlist, maxsize=ALLOWLIST_VERDICTS):
+        super(DomainAllowlist, self).__init__(allowlist)
+        self.compiledPaths = {
+            domain: [(re.compile(pathRegex), products) for pathRegex, products in paths.items()] for domain, paths in self.items() if isinstance(paths, dict)
+        }
+        self.verdicts = LRUCache(maxsize)
+
+    def check(self, url, product):
+        key = (url, product)
+        verdict = self.verdicts.get(key, _unchecked)
+        if verdict is _unchecked:
+            verdict = _checkUrl(url, product, self, self.compiledPaths)
+            self.verdicts.put(key, verdict)
+        return verdict
+
+
+def isForbiddenUrl(url, product, allowlistedDomains):
+    if isinstance(allowlistedDomains, DomainAllowlist):
+        warning = allowlistedDomains.check(url, product)
     else:
-        logging.warning("Forbidden domain, malformed entry: %s", domain)
-    return True
+        warning = _checkUrl(url, product, allowlistedDomains or [], None)
+    if warning:
+        logging.warning(*warning)
+        return True
+    return False
+
+
+def containsForbiddenUrl(urls, product, allowlistedDomains):
+    """Returns True if any of urls is forbidden for product. Blobs tend to
+    repeat the same URLs many times, so each one is only checked once."""
+    return any(isForbiddenUrl(url, product, allowlistedDomains) for url in set(urls))
 
 
 def getFallbackChannel(channel):
@@ -71,38 +120,120 @@ class AUS:
         self.log = logging.getLogger(self.__class__.__name__)
 
     def updates_are_disabled(self, product, channel, transaction=None):
+        if dbo.emergencyShutoffs.snapshot is not None:
+            return dbo.emergencyShutoffs.updatesAreDisabled(product, channel, transaction)
+
         cache_key = (product, channel)
-        v = cache.get("updates_disabled", cache_key)
-        if v is not None:
+
+        def lookup():
+            v = cache.get("updates_disabled", cache_key)
+            if v is not None:
+                return v
+
+            where = dict(product=product, channel=channel)
+            emergency_shutoffs = dbo.emergencyShutoffs.select(where=where, transaction=transaction)
+            v = bool(emergency_shutoffs)
+            cache.put("updates_disabled", cache_key, v)
             return v
 
-        where = dict(product=product, channel=channel)
-        emergency_shutoffs = dbo.emergencyShutoffs.select(where=where, transaction=transaction)
-        v = bool(emergency_shutoffs)
-        cache.put("updates_disabled", cache_key, v)
-        return v
+        return memoize("updates_disabled", cache_key, lookup)
 
     def evaluateRules(self, updateQuery, transaction=None):
-        self.log.debug("Looking for rules that apply to:")
-        self.log.debug(updateQuery)
+        return self.evaluateRulesBatch([updateQuery], transaction)[0]
 
-        eval_metadata = dict(rule_id="unknown", rule_data_version="unknown")
+    def evaluateRulesBatch(self, updateQueries, transaction=None):
+        """Does the same thing as calling evaluateRules for each of updateQueries, and
+        returns their (blob, update_type, eval_metadata) in the same order. This is
+        meant for variants of one query (eg: the same query for each of the products
+        in a SuperBlob), whose candidate Rules are looked up together, and whose
+        Releases are loaded all at once."""
+        results = []
+        enabled = []
+        for i, updateQuery in enumerate(updateQueries):
+            self.log.debug("Looking for rules that apply to:")
+            self.log.debug(updateQuery)
 
-        if self.updates_are_disabled(updateQuery["product"], updateQuery["channel"], transaction) or self.updates_are_disabled(
-            updateQuery["product"], getFallbackChannel(updateQuery["channel"]), transaction
-        ):
-            log_message = "Updates are disabled for {}/{}.".format(updateQuery["product"], updateQuery["channel"])
-            self.log.debug(log_message)
-            return None, None, eval_metadata
+            results.append((None, None, dict(rule_id="unknown", rule_data_version="unknown")))
 
-        rules = dbo.rules.getRulesMatchingQuery(updateQuery, fallbackChannel=getFallbackChannel(updateQuery["channel"]), transaction=transaction)
+            if self.updates_are_disabled(updateQuery["product"], updateQuery["channel"], transaction) or self.updates_are_disabled(
+                updateQuery["product"], getFallbackChannel(updateQuery["channel"]), transaction
+            ):
+                log_message = "Updates are disabled for {}/{}.".format(updateQuery["product"], updateQuery["channel"])
+                self.log.debug(log_message)
+                continue
+            enabled.append(i)
 
         # TODO: throw any N->N update rules and keep the highest priority remaining one?
-        if len(rules) < 1:
-            return None, None, eval_metadata
+        rules = self.getMatchingRules([updateQueries[i] for i in enabled], transaction)
+
+        mapped = []
+        for i, rule in zip(enabled, rules):
+            mapping = self._chooseMapping(updateQueries[i], rule, results[i][2])
+            if mapping:
+                mapped.append((i, rule, mapping))
 
-        rules = sorted(rules, key=lambda rule: rule["priority"], reverse=True)
-        rule = rules[0]
+        blobs = self.getBlobs([(mapping, updateQueries[i]) for i, _, mapping in mapped], transaction)
+        for (i, rule, mapping), (blob, data_version) in zip(mapped, blobs):
+            results[i] = self._resolveUpdate(updateQueries[i], rule, mapping, blob, data_version, results[i][2], transaction)
+        return results
+
+    def getMatchingRules(self, updateQueries, transaction=None):
+        """Returns the highest priority Rule that matches each of updateQueries
+        (or None, for those that don't match any)."""
+        keys = [tuple(sorted((k, repr(v)) for k, v in updateQuery.items())) for updateQuery in updateQueries]
+        queries = dict(zip(keys, updateQueries))
+
+        def lookup(keys):
+            lookups = [(queries[key], getFallbackChannel(queries[key]["channel"])) for key in keys]
+            if not lookups:
+                return []
+            elif len(lookups) == 1:
+                return [dbo.rules.getHighestPriorityMatchingRule(*lookups[0], transaction=transaction)]
+            return dbo.rules.getHighestPriorityMatchingRules(lookups, transaction=transaction)
+
+        return memoize_many("rule", keys, lookup)
+
+    def getBlobs(self, lookups, transaction=None):
+        """Returns the blob and data_version(s) of the Release for each of the
+        (mapping, updateQuery) tuples in lookups. Only the parts of a Release that
+        the query needs are loaded, if we know which ones those are."""
+        keys = []
+        for mapping, updateQuery in lookups:
+            if updateQuery.get("buildTarget") and updateQuery.get("locale"):
+                keys.append((mapping, (updateQuery["buildTarget"], updateQuery["locale"])))
+            else:
+                keys.append((mapping, None))
+
+        def lookup(keys):
+            found = {}
+            by_parts = {}
+            for mapping, parts in keys:
+                by_parts.setdefault(parts, []).append(mapping)
+            for parts, mappings in by_parts.items():
+                if parts:
+                    release_rows = releases.get_releases_for_locale(mappings, [parts[0]], parts[1], transaction)
+                else:
+                    release_rows = {mapping: releases.get_release(mapping, transaction, include_sc=False) for mapping in mappings}
+                for mapping, release in release_rows.items():
+                    found[(mapping, parts)] = release
+
+            blobs = []
+            for key in keys:
+                release = found[key]
+                if release:
+                    blobs.append((releases.get_release_blob(key[0], release, key[1]), release["data_versions"]))
+                # TODO: remove me when old releases table dies
+                else:
+                    release = dbo.releases.getReleases(name=key[0], limit=1, transaction=transaction)[0]
+                    blobs.append((release["data"], release["data_version"]))
+            return blobs
+
+        return memoize_many("release", keys, lookup)
+
+    def _chooseMapping(self, updateQuery, rule, eval_metadata):
+        """Returns the Release that rule points updateQuery at, if any."""
+        if rule is None:
+            return None
 
         eval_metadata["rule_id"] = rule["rule_id"]
         eval_metadata["rule_data_version"] = rule["data_version"]
@@ -114,7 +245,7 @@ class AUS:
         # 1) No mapping.
         if not rule["mapping"]:
             self.log.debug("Matching rule points at null mapping.")
-            return None, None, eval_metadata
+            return None
         mapping = rule["mapping"]
 
         # 2) For background checks (force=1 missing from query), we might not
@@ -127,26 +258,17 @@ class AUS:
                 fallbackReleaseName = rule["fallbackMapping"]
                 if not fallbackReleaseName:
                     self.log.debug("No fallback releases. Request was dropped")
-                    return None, None, eval_metadata
+                    return None
 
                 self.log.debug("Using fallback release %s", fallbackReleaseName)
                 mapping = fallbackReleaseName
 
+        return mapping
+
+    def _resolveUpdate(self, updateQuery, rule, mapping, blob, data_version, eval_metadata, transaction):
         # 3) Incoming release is older than the one in the mapping, defined as one of:
         #    * version decreases
         #    * version is the same and buildID doesn't increase
-        def get_blob(mapping):
-            release = releases.get_release(mapping, transaction, include_sc=False)
-            blob = None
-            if release:
-                blob = createBlob(release["blob"])
-            # TODO: remove me when old releases table dies
-            else:
-                release = dbo.releases.getReleases(name=mapping, limit=1, transaction=transaction)[0]
-                blob = release["data"]
-            return blob
-
-        blob = get_blob(mapping)
         if not blob:
             return None, None, eval_metadata
         candidate = blob.shouldServeUpdate(updateQuery)
@@ -155,7 +277,8 @@ class AUS:
 
         if candidate == ServeUpdate.Maybe:
             version_pin = PinVersion(updateQuery.get("pin"))
-            pin_mapping = dbo.pinnable_releases.getPinMapping(updateQuery["product"], getFallbackChannel(updateQuery["channel"]), str(version_pin))
+            pin_key = (updateQuery["product"], getFallbackChannel(updateQuery["channel"]), str(version_pin))
+            pin_mapping = memoize("pin", pin_key, lambda: dbo.pinnable_releases.getPinMapping(*pin_key, transaction=transaction))
             # Note that we fall back to serving the original update if the pin is not found
             # in the pin table, even if the version that we will serve is past the pinned
             # version. This is because, if there is something wrong with the update pin,
@@ -179,9 +302,14 @@ class AUS:
             # installations vulnerable.
             if pin_mapping is not None:
                 mapping = pin_mapping
-                blob = get_blob(mapping)
+                blob, data_version = self.getBlobs([(mapping, updateQuery)], transaction)[0]
                 if not blob or not blob.shouldServeUpdate(updateQuery):
                     return None, None, eval_metadata
 
         self.log.debug("Returning release %s", mapping)
+        # The data_version of the Release (or the data_versions of the parts of it
+        # that were loaded) lets callers tell whether anything they've derived
+        # from it is still current.
+        eval_metadata["release"] = mapping
+        eval_metadata["release_data_version"] = data_version
         return blob, rule["update_type"], eval_metadata
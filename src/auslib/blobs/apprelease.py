@@ -1,19 +1,93 @@
 import itertools
+import sys
 
-from auslib.AUS import getFallbackChannel, isForbiddenUrl, isSpecialURL
-from auslib.blobs.base import ServeUpdate, XMLBlob, createBlob
+from repoze.lru import LRUCache
+
+from auslib.AUS import containsForbiddenUrl, getFallbackChannel, isForbiddenUrl, isSpecialURL
+from auslib.blobs.base import ServeUpdate, XMLBlob, escapeAmpersands
 from auslib.errors import BadDataError, BlobValidationError
 from auslib.global_state import dbo
 from auslib.services import releases
 from auslib.util.comparison import has_operator, strip_operator
+from auslib.util.memo import memoize
 from auslib.util.rulematching import matchBuildID, matchChannel, matchVersion
 from auslib.util.versions import MozillaVersion, PinVersion, decrement_version, increment_version
 
+# Stands in for a buildID that a LocaleServingData doesn't have.
+_missing = object()
+
+# The most patch XML fragments that a ServingView remembers. Channels come from
+# update requests, and there's no limit to how many of them a Rule can match, so
+# the least recently used fragments are dropped to make room for new ones.
+MAX_PATCH_FRAGMENTS = 1000
+
+# Stands in for a patch XML fragment that a ServingView doesn't have.
+_notRendered = object()
+
+
+class LocaleServingData(object):
+    """What serving updates needs to know about a locale of a platform."""
+
+    __slots__ = ("data", "buildID")
+
+    def __init__(self, platformData, localeData):
+        self.data = localeData
+        if "buildID" in localeData:
+            self.buildID = localeData["buildID"]
+        else:
+            self.buildID = platformData.get("buildID", _missing)
+
+
+class ServingView(object):
+    """The lookups that serving updates from a Release does, worked out ahead of
+    time (see ReleaseBlobBase.precomputeLookups). Each platform, including the
+    ones that are aliases, maps to the platform that it resolves to, and to all
+    of the platforms that resolve to the same one. Each (platform, locale) maps
+    to a LocaleServingData, which is shared by all of the platforms that resolve
+    to the same one.
+
+    patchFragments is an LRUCache of the <patch> XML of each patch once it's been
+    rendered for a channel, platform, locale and product (see _getPatchFragment),
+    for the allowlistedDomains that it was checked against. It's only made once
+    the first patch is rendered."""
+
+    __slots__ = ("resolvedPlatforms", "platformAliases", "locales", "patchFragments", "allowlistedDomains")
+
+    def __init__(self, blob):
+        platforms = blob.get("platforms", {})
+        self.resolvedPlatforms = {}
+        aliasedBy = {}
+        for platform, platformData in platforms.items():
+            platform = sys.intern(platform)
+            self.resolvedPlatforms[platform] = sys.intern(platformData.get("alias", platform))
+            aliasedBy.setdefault(platformData.get("alias", ""), set()).add(platform)
+        self.platformAliases = {platform: frozenset({resolved, *aliasedBy.get(resolved, ())}) for platform, resolved in self.resolvedPlatforms.items()}
+
+        self.locales = {}
+        byResolvedPlatform = {}
+        for platform, resolved in self.resolvedPlatforms.items():
+            if resolved not in byResolvedPlatform:
+                platformData = platforms.get(resolved, {})
+                byResolvedPlatform[resolved] = {
+                    sys.intern(locale): LocaleServingData(platformData, localeData) for locale, localeData in platformData.get("locales", {}).items()
+                }
+            for locale, localeServingData in byResolvedPlatform[resolved].items():
+                self.locales[(platform, locale)] = localeServingData
+
+        self.patchFragments = None
+        self.allowlistedDomains = None
+
 
 class ReleaseBlobBase(XMLBlob):
+    # Set by precomputeLookups.
+    servingView = None
+
     def __init__(self, **kwargs):
         XMLBlob.__init__(self, **kwargs)
 
+    def precomputeLookups(self):
+        self.servingView = ServingView(self)
+
     def processSpecialForceHosts(self, url, specialForceHosts, force_arg):
         if isSpecialURL(url, specialForceHosts):
             if "?" in url:
@@ -46,10 +120,24 @@ class ReleaseBlobBase(XMLBlob):
 
     def getResolvedPlatform(self, platform):
         try:
+            if self.servingView:
+                return self.servingView.resolvedPlatforms[platform]
             return self["platforms"][platform].get("alias", platform)
         except KeyError:
             raise BadDataError("Can't find platform '%s'", platform)
 
+    def getPlatformAliases(self, platform):
+        """Returns the platform that platform is an alias of (or platform itself,
+        if it isn't an alias), and all of the platforms that are aliases of it."""
+        if self.servingView:
+            return self.servingView.platformAliases[platform]
+        unaliasedPlatform = self["platforms"][platform].get("alias", platform)
+        aliases = set([unaliasedPlatform])
+        for bt in self["platforms"]:
+            if self["platforms"][bt].get("alias", "") == unaliasedPlatform:
+                aliases.add(bt)
+        return aliases
+
     def getPlatformData(self, platform):
         platform = self.getResolvedPlatform(platform)
         try:
@@ -58,6 +146,8 @@ class ReleaseBlobBase(XMLBlob):
             raise BadDataError("Can't find platform '%s'", platform)
 
     def getLocaleData(self, platform, locale):
+        if self.servingView and (platform, locale) in self.servingView.locales:
+            return self.servingView.locales[(platform, locale)].data
         platformData = self.getPlatformData(platform)
         try:
             return platformData["locales"][locale]
@@ -65,6 +155,11 @@ class ReleaseBlobBase(XMLBlob):
             raise BadDataError("Can't find locale '%s' in '%s'", locale, platform)
 
     def getLocaleOrTopLevelParam(self, platform, locale, param):
+        if self.servingView:
+            localeServingData = self.servingView.locales.get((platform, locale))
+            if localeServingData and param in localeServingData.data:
+                return localeServingData.data[param]
+            return self.get(param)
         try:
             platform = self.getResolvedPlatform(platform)
             return self["platforms"][platform]["locales"][locale][param]
@@ -75,6 +170,10 @@ class ReleaseBlobBase(XMLBlob):
                 return None
 
     def getBuildID(self, platform, locale):
+        if self.servingView:
+            localeServingData = self.servingView.locales.get((platform, locale))
+            if localeServingData and localeServingData.buildID is not _missing:
+                return localeServingData.buildID
         platform = self.getResolvedPlatform(platform)
         if locale not in self["platforms"].get(platform, {}).get("locales", {}):
             raise BadDataError("No such locale '%s' in platform '%s'" % (locale, platform))
@@ -92,37 +191,111 @@ class ReleaseBlobBase(XMLBlob):
         # Because we know it doesn't exist in the database it's wasteful to
         # even attempt to look it up.
         if patch["from"] != "*":
+
+            def lookup():
+                try:
+                    release = releases.get_release(patch["from"], None, include_sc=False)
+                    if release:
+                        return releases.get_release_blob(patch["from"], release)
+                    else:
+                        return dbo.releases.getReleaseBlob(name=patch["from"])
+                except KeyError:
+                    # Release doesn't exist
+                    return None
+
+            return memoize("from_release", patch["from"], lookup)
+        else:
+            return None
+
+    def _getFromBuildIDs(self, patch, locale):
+        """Returns the buildIDs that the "from" Release of a patch has for locale,
+        keyed by platform, or None if it doesn't exist. This is all that we need
+        to know about it, so the Release itself is only loaded if it's still in
+        the old releases table."""
+        # "*" is a special case for the "from" field that means "any release".
+        if patch["from"] == "*":
+            return None
+
+        def lookup():
+            buildIDs = releases.get_build_ids(patch["from"], locale, None)
+            if buildIDs is not None:
+                return buildIDs
+
+            # TODO: remove me when old releases table dies
             try:
-                release = releases.get_release(patch["from"], None, include_sc=False)
-                if release:
-                    return createBlob(release["blob"])
-                else:
-                    return dbo.releases.getReleaseBlob(name=patch["from"])
+                fromRelease = dbo.releases.getReleaseBlob(name=patch["from"])
             except KeyError:
                 # Release doesn't exist
                 return None
-        else:
+            buildIDs = {}
+            for platform in fromRelease.get("platforms", {}):
+                try:
+                    buildIDs[platform] = fromRelease.getBuildID(platform, locale)
+                except BadDataError:
+                    pass
+            return buildIDs
+
+        return memoize("build_ids", (patch["from"], locale), lookup)
+
+    def getFromBuildIDs(self, updateQuery):
+        """Returns the buildIDs that the "from" Release of each patch that could be
+        served for updateQuery has, for its platform and the platform's aliases,
+        keyed by Release name (None if it doesn't exist). These decide which patches
+        are served (see _getSpecificPatchXML), and can change without this Release
+        changing."""
+        try:
+            localeData = self.getLocaleData(updateQuery["buildTarget"], updateQuery["locale"])
+            platforms = (updateQuery["buildTarget"], *sorted(self.getPlatformAliases(updateQuery["buildTarget"])))
+        except (BadDataError, KeyError):
             return None
 
+        patches = [localeData.get("complete"), localeData.get("partial"), *localeData.get("completes", []), *localeData.get("partials", [])]
+        fromBuildIDs = {}
+        for patch in patches:
+            if not patch or patch.get("from", "*") == "*" or patch["from"] in fromBuildIDs:
+                continue
+            buildIDs = self._getFromBuildIDs(patch, updateQuery["locale"])
+            fromBuildIDs[patch["from"]] = None if buildIDs is None else [buildIDs.get(platform) for platform in platforms]
+        return fromBuildIDs
+
     def _getAdditionalPatchAttributes(self, patch):
         return {}
 
     def _getSpecificPatchXML(self, patchKey, patchType, patch, updateQuery, allowlistedDomains, specialForceHosts):
-        fromRelease = self._getFromRelease(patch)
+        fromBuildIDs = self._getFromBuildIDs(patch, updateQuery["locale"])
         # Find all the alias' for this build target so we can look for the current platform
         # in the fromRelease
-        unaliasedBuildTarget = self["platforms"][updateQuery["buildTarget"]].get("alias", updateQuery["buildTarget"])
-        aliases = set([unaliasedBuildTarget])
-        for bt in self["platforms"]:
-            if self["platforms"][bt].get("alias", "") == unaliasedBuildTarget:
-                aliases.add(bt)
-        # don't return an update if we don't match the from restriction
-        if fromRelease and not fromRelease.matchesUpdateQuery(updateQuery, aliases):
-            return None
+        aliases = self.getPlatformAliases(updateQuery["buildTarget"])
         # don't return an update if an older release isn't in the DB for some reason
-        if patch["from"] != "*" and fromRelease is None:
+        if patch["from"] != "*" and fromBuildIDs is None:
+            return None
+        # don't return an update if we don't match the from restriction
+        if fromBuildIDs is not None and not any(fromBuildIDs.get(bt) == updateQuery["buildID"] for bt in (updateQuery["buildTarget"], *aliases)):
             return None
 
+        return self._getPatchFragment(patchKey, patchType, patch, updateQuery, allowlistedDomains, specialForceHosts)
+
+    def _getPatchFragment(self, patchKey, patchType, patch, updateQuery, allowlistedDomains, specialForceHosts):
+        """Returns the result of _renderPatchXML, which is only rendered once for
+        each channel, platform, locale and product that a patch is served to, if
+        this blob has a servingView. Forced URLs aren't worth remembering."""
+        view = self.servingView
+        if not view or updateQuery["force"]:
+            return self._renderPatchXML(patchKey, patchType, patch, updateQuery, allowlistedDomains, specialForceHosts)
+
+        if view.patchFragments is None or view.allowlistedDomains is not allowlistedDomains:
+            view.patchFragments = LRUCache(MAX_PATCH_FRAGMENTS)
+            view.allowlistedDomains = allowlistedDomains
+        # Patches belong to this blob, which is never modified while it has a
+        # servingView, so they're identified by their ids.
+        key = (updateQuery["channel"], updateQuery["buildTarget"], updateQuery["locale"], updateQuery["product"], patchType, id(patch))
+        fragment = view.patchFragments.get(key, _notRendered)
+        if fragment is _notRendered:
+            fragment = self._renderPatchXML(patchKey, patchType, patch, updateQuery, allowlistedDomains, specialForceHosts)
+            view.patchFragments.put(key, fragment)
+        return fragment
+
+    def _renderPatchXML(self, patchKey, patchType, patch, updateQuery, allowlistedDomains, specialForceHosts):
         try:
             url = self._getUrl(updateQuery, patchKey, patch, specialForceHosts)
         except ValueError:
@@ -157,10 +330,10 @@ class ReleaseBlobBase(XMLBlob):
             patchXML += ' %s="%s"' % (attribute, additionalPatchAttributes[attribute])
         patchXML += "/>"
 
-        return patchXML
+        return escapeAmpersands(patchXML)
 
     def getInnerHeaderXML(self, updateQuery, update_type, allowlistedDomains, specialForceHosts):
-        return self._getUpdateLineXML(updateQuery, update_type)
+        return escapeAmpersands(self._getUpdateLineXML(updateQuery, update_type))
 
     def getInnerFooterXML(self, updateQuery, update_type, allowlistedDomains, specialForceHosts):
         return "    </update>"
@@ -247,33 +420,29 @@ class ReleaseBlobBase(XMLBlob):
     def containsForbiddenDomain(self, product, allowlistedDomains):
         """Returns True if the blob contains any file URLs that contain a
         domain that we're not allowed to serve updates to."""
+        urls = []
         # Check the top level URLs, if the exist.
         for c in self.get("fileUrls", {}).values():
             # New-style
             if isinstance(c, dict):
                 for from_ in c.values():
-                    for url in from_.values():
-                        if isForbiddenUrl(url, product, allowlistedDomains):
-                            return True
+                    urls.extend(from_.values())
             # Old-style
             else:
-                if isForbiddenUrl(c, product, allowlistedDomains):
-                    return True
+                urls.append(c)
 
         # And also the locale-level URLs.
         for platform in self.get("platforms", {}).values():
             for locale in platform.get("locales", {}).values():
                 for type_ in ("partial", "complete"):
                     if type_ in locale and "fileUrl" in locale[type_]:
-                        if isForbiddenUrl(locale[type_]["fileUrl"], product, allowlistedDomains):
-                            return True
+                        urls.append(locale[type_]["fileUrl"])
                 for type_ in ("partials", "completes"):
                     for update in locale.get(type_, {}):
                         if "fileUrl" in update:
-                            if isForbiddenUrl(update["fileUrl"], product, allowlistedDomains):
-                                return True
+                            urls.append(update["fileUrl"])
 
-        return False
+        return containsForbiddenUrl(urls, product, allowlistedDomains)
 
 
 class SeparatedFileUrlsMixin(object):
@@ -1230,7 +1399,9 @@ class DesupportBlob(XMLBlob):
             .replace("%os%", updateQuery["buildTarget"].split("_")[0])
         )
         xml = []
-        xml.append('    <update type="%s" unsupported="true" detailsURL="%s" displayVersion="%s">' % (update_type, tmp_url, self["displayVersion"]))
+        xml.append(
+            escapeAmpersands('    <update type="%s" unsupported="true" detailsURL="%s" displayVersion="%s">' % (update_type, tmp_url, self["displayVersion"]))
+        )
         return xml
 
     def getInnerFooterXML(self, updateQuery, update_type, allowlistedDomains, specialForceHosts):
@@ -1,15 +1,35 @@
 import enum
 import json
 import logging
+import re
 from os import path
 
 import jsonschema
 import yaml
+from repoze.lru import ExpiringLRUCache
 
 # To enable shared jsonschema validators
 import auslib.util.jsonschema_validators  # noqa
 from auslib.errors import BlobValidationError
 from auslib.global_state import cache
+from auslib.util.data_structures import ensure_path_exists, get_by_path, set_by_path
+
+# Compiled validators for each schema file. Like the schemas in the "blob_schema"
+# cache, they only change during deployments. They're kept separately because
+# they're not worth copying (like the admin app's cache does) or able to be stored
+# in Redis.
+validators = ExpiringLRUCache(50, 24 * 60 * 60)
+
+_unescapedAmpersand = re.compile("&(?!amp;)")
+
+
+def escapeAmpersands(xml):
+    """Returns a piece of update XML with any ampersands that aren't already part
+    of an "&amp;" escaped. XMLBlobs use this on everything that they return
+    which could contain values from the blob or the update query."""
+    if "&" not in xml:
+        return xml
+    return _unescapedAmpersand.sub("&amp;", xml)
 
 
 def createBlob(data):
@@ -133,6 +153,27 @@ def merge_dicts(ancestor, left, right):
     return result
 
 
+def getSubschema(schema, path):
+    """Returns the part of schema that applies to the value found by following
+    path (a sequence of keys) from the root of a blob, or None if there isn't
+    exactly one such part."""
+    for key in path:
+        candidates = []
+        for option in schema.get("oneOf", schema.get("anyOf", [schema])):
+            if key in option.get("properties", {}):
+                candidates.append(option["properties"][key])
+                continue
+            matches = [s for pattern, s in option.get("patternProperties", {}).items() if re.search(pattern, key)]
+            if matches:
+                candidates.extend(matches)
+            elif isinstance(option.get("additionalProperties"), dict):
+                candidates.append(option["additionalProperties"])
+        if len(candidates) != 1:
+            return None
+        schema = candidates[0]
+    return schema
+
+
 class ServeUpdate(enum.Enum):
     No = 0
     Maybe = enum.auto()
@@ -154,7 +195,7 @@ class Blob(dict):
     def validate(self, product, allowlistedDomains):
         """Raises a BlobValidationError if the blob is invalid."""
         self.log.debug("Validating blob %s" % self)
-        validator = jsonschema.Draft4Validator(self.getSchema(), format_checker=jsonschema.Draft4Validator.FORMAT_CHECKER)
+        validator = self.getValidator()
         # Normal usage is to use .validate(), but errors raised by it return
         # a massive error message that includes the entire blob, which is way
         # too big to be useful in the UI. Instead, we iterate over the
@@ -167,6 +208,44 @@ class Blob(dict):
         if self.containsForbiddenDomain(product, allowlistedDomains):
             raise ValueError("Blob contains forbidden domain(s)")
 
+    def validateSubtrees(self, product, allowlistedDomains, paths):
+        """Like validate, but only checks the parts of the blob found at each of
+        paths (sequences of keys, eg: ("platforms", "WINNT_x86-msvc", "locales", "de")),
+        assuming that the rest of it is already valid. This is much faster than
+        validating the whole blob when only a small part of it has changed.
+
+        If any of the paths can't be matched to a single part of the schema, the
+        whole blob is validated instead. Checks that subclasses add to validate
+        are not run, so this must only be used for parts of the blob that those
+        checks don't look at."""
+        validator = self.getValidator()
+        subschemas = [getSubschema(validator.schema, path) for path in paths]
+        if any(subschema is None for subschema in subschemas):
+            return self.validate(product, allowlistedDomains)
+
+        self.log.debug("Validating %s in blob %s", paths, self.get("name"))
+        errors = []
+        changed = {}
+        for keys, subschema in zip(paths, subschemas):
+            value = get_by_path(self, keys)
+            errors.extend(e.message for e in validator.evolve(schema=subschema).iter_errors(value))
+            ensure_path_exists(changed, keys[:-1])
+            set_by_path(changed, keys, value)
+        if errors:
+            raise BlobValidationError("Invalid blob! See 'errors' for details.", errors)
+
+        # A blob containing only the changed parts has all of the URLs that could
+        # have been added.
+        if self.__class__(**changed).containsForbiddenDomain(product, allowlistedDomains):
+            raise ValueError("Blob contains forbidden domain(s)")
+
+    def getValidator(self):
+        validator = validators.get(self.jsonschema)
+        if validator is None:
+            validator = jsonschema.Draft4Validator(self.getSchema(), format_checker=jsonschema.Draft4Validator.FORMAT_CHECKER)
+            validators.put(self.jsonschema, validator)
+        return validator
+
     def getSchema(self):
         def loadSchema():
             with open(path.join(path.dirname(path.abspath(__file__)), "schemas", self.jsonschema)) as f:
@@ -200,6 +279,12 @@ class Blob(dict):
         """
         return set()
 
+    def precomputeLookups(self):
+        """Works out anything that serving updates from this blob would otherwise
+        work out for every request. This must only be done with blobs that will
+        never be modified, because nothing recomputes it."""
+        pass
+
 
 # We should be able to kill this Blob and its subclasses at some point by using
 # GenericBlob, and fully encapsulating the response in getResponse
@@ -219,6 +304,14 @@ class XMLBlob(Blob):
         """
         return None
 
+    def getFromBuildIDs(self, updateQuery):
+        """
+        :return: Usually returns None. If the patches that this Blob serves for
+                 updateQuery are only served to the buildIDs of other Releases, it
+                 returns those buildIDs, keyed by Release name.
+        """
+        return None
+
     def getInnerHeaderXML(self, updateQuery, update_type, allowlistedDomains, specialForceHosts):
         """
         :return: Releases-specific header should be implemented for individual blobs
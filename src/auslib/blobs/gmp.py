@@ -1,5 +1,5 @@
-from auslib.AUS import isForbiddenUrl
-from auslib.blobs.base import ServeUpdate, XMLBlob
+from auslib.AUS import containsForbiddenUrl, isForbiddenUrl
+from auslib.blobs.base import ServeUpdate, XMLBlob, escapeAmpersands
 from auslib.errors import BadDataError
 from auslib.util.hashes import getHashLen
 
@@ -77,20 +77,22 @@ class GMPBlobV1(XMLBlob):
                         continue
                     mirrorUrls.append(mirrorUrl)
             vendorXML.append(
-                '        <addon id="%s" URL="%s" hashFunction="%s" hashValue="%s" size="%s" version="%s"%s>'
-                % (
-                    vendor,
-                    url,
-                    self["hashFunction"],
-                    platformData["hashValue"],
-                    platformData["filesize"],
-                    vendorInfo["version"],
-                    "" if mirrorUrls else "/",
+                escapeAmpersands(
+                    '        <addon id="%s" URL="%s" hashFunction="%s" hashValue="%s" size="%s" version="%s"%s>'
+                    % (
+                        vendor,
+                        url,
+                        self["hashFunction"],
+                        platformData["hashValue"],
+                        platformData["filesize"],
+                        vendorInfo["version"],
+                        "" if mirrorUrls else "/",
+                    )
                 )
             )
             if mirrorUrls:
                 for mirrorUrl in mirrorUrls:
-                    vendorXML.append('            <mirror URL="%s"/>' % (mirrorUrl))
+                    vendorXML.append(escapeAmpersands('            <mirror URL="%s"/>' % (mirrorUrl)))
                 vendorXML.append("        </addon>")
 
         return vendorXML
@@ -98,13 +100,11 @@ class GMPBlobV1(XMLBlob):
     def containsForbiddenDomain(self, product, allowlistedDomains):
         """Returns True if the blob contains any file URLs that contain a
         domain that we're not allowed to serve updates to."""
+        urls = []
         for vendor in self.get("vendors", {}).values():
             for platform in vendor.get("platforms", {}).values():
                 if "fileUrl" in platform:
-                    if isForbiddenUrl(platform["fileUrl"], product, allowlistedDomains):
-                        return True
+                    urls.append(platform["fileUrl"])
                 if "mirrorUrls" in platform:
-                    for mirrorUrl in platform["mirrorUrls"]:
-                        if isForbiddenUrl(mirrorUrl, product, allowlistedDomains):
-                            return True
-        return False
+                    urls.extend(platform["mirrorUrls"])
+        return containsForbiddenUrl(urls, product, allowlistedDomains)
@@ -1,4 +1,4 @@
-from auslib.AUS import isForbiddenUrl
+from auslib.AUS import containsForbiddenUrl, isForbiddenUrl
 from auslib.blobs.base import GenericBlob, ServeUpdate
 from auslib.util.versions import LooseVersion
 
@@ -8,7 +8,7 @@ class GuardianBlob(GenericBlob):
 
     def containsForbiddenDomain(self, product, allowlistedDomains):
         urls = [p["fileUrl"] for p in self["platforms"].values()]
-        return any([isForbiddenUrl(url, product, allowlistedDomains) for url in urls])
+        return containsForbiddenUrl(urls, product, allowlistedDomains)
 
     def shouldServeUpdate(self, updateQuery):
         if updateQuery["buildTarget"] not in self.get("platforms", {}):
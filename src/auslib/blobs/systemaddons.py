@@ -1,5 +1,5 @@
-from auslib.AUS import isForbiddenUrl
-from auslib.blobs.base import ServeUpdate, XMLBlob
+from auslib.AUS import containsForbiddenUrl, isForbiddenUrl
+from auslib.blobs.base import ServeUpdate, XMLBlob, escapeAmpersands
 from auslib.errors import BadDataError
 
 
@@ -68,8 +68,10 @@ class SystemAddonsBlob(XMLBlob):
             if isForbiddenUrl(url, updateQuery["product"], allowlistedDomains):
                 continue
             addonXML.append(
-                '        <addon id="%s" URL="%s" hashFunction="%s" hashValue="%s" size="%s" version="%s"/>'
-                % (addon, url, self["hashFunction"], platformData["hashValue"], platformData["filesize"], addonInfo["version"])
+                escapeAmpersands(
+                    '        <addon id="%s" URL="%s" hashFunction="%s" hashValue="%s" size="%s" version="%s"/>'
+                    % (addon, url, self["hashFunction"], platformData["hashValue"], platformData["filesize"], addonInfo["version"])
+                )
             )
 
         return addonXML
@@ -89,11 +91,5 @@ class SystemAddonsBlob(XMLBlob):
     def containsForbiddenDomain(self, product, allowlistedDomains):
         """Returns True if the blob contains any file URLs that contain a
         domain that we're not allowed to serve updates to."""
-
-        for addon in self.get("addons", {}).values():
-            for platform in addon.get("platforms", {}).values():
-                if "fileUrl" in platform:
-                    if isForbiddenUrl(platform["fileUrl"], product, allowlistedDomains):
-                        return True
-
-        return False
+        urls = [platform["fileUrl"] for addon in self.get("addons", {}).values() for platform in addon.get("platforms", {}).values() if "fileUrl" in platform]
+        return containsForbiddenUrl(urls, product, allowlistedDomains)
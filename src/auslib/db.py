@@ -5,6 +5,7 @@ import re
 import time
 from collections import defaultdict
 from copy import copy
+from functools import partial
 from os import path
 
 import migrate.versioning.api
@@ -20,18 +21,10 @@ from sqlalchemy.sql.functions import max as sql_max
 from auslib.blobs.base import createBlob, merge_dicts
 from auslib.errors import PermissionDeniedError, ReadOnlyError, SignoffRequiredError
 from auslib.global_state import cache
-from auslib.util.rulematching import (
-    matchBoolean,
-    matchBuildID,
-    matchChannel,
-    matchCsv,
-    matchLocale,
-    matchMemory,
-    matchRegex,
-    matchSimpleExpression,
-    matchVersion,
-)
+from auslib.util.ruleindex import RuleIndex
+from auslib.util.rulematching import CompiledRule, matchRegex
 from auslib.util.signoffs import get_required_signoffs_for_product_channel
+from auslib.util.snapshot import EmergencyShutoffSnapshot, PinSnapshot
 from auslib.util.statsd import statsd
 from auslib.util.timestamp import getMillisecondTimestamp
 from auslib.util.versions import get_version_class
@@ -184,12 +177,16 @@ class AUSTransaction(object):
 
     The connection and transaction are opened lazily on the first call to
     execute().
+
+    Callbacks registered with afterCommit are called once the transaction
+    has been committed, and never if it is rolled back.
     """
 
     def __init__(self, engine):
         self.engine = engine
         self.conn = None
         self.trans = None
+        self.after_commit = []
         self.log = logging.getLogger(self.__class__.__name__)
 
     def _ensure_connection(self):
@@ -235,6 +232,9 @@ class AUSTransaction(object):
             self.rollback()
             raise TransactionError() from exc
 
+    def afterCommit(self, callback):
+        self.after_commit.append(callback)
+
     def commit(self):
         if self.trans is None:
             return
@@ -244,7 +244,17 @@ class AUSTransaction(object):
             self.rollback()
             raise TransactionError() from exc
 
+        callbacks, self.after_commit = self.after_commit, []
+        for callback in callbacks:
+            # The changes have already been committed, so there's no point
+            # in failing the caller if something that reacts to them fails.
+            try:
+                callback()
+            except Exception:
+                self.log.exception("Caught exception in after commit callback")
+
     def rollback(self):
+        self.after_commit = []
         if self.trans is None:
             return
         self.trans.rollback()
@@ -275,8 +285,14 @@ class AUSTable(object):
                               tracks the history of a scheduled change.
 
     :type scheduled_changes: bool
+
+    Tables whose publish_changes is True tell the database's change publisher
+    (if it has one) about every row that is inserted, updated, or deleted
+    once the change has been committed.
     """
 
+    publish_changes = False
+
     def __init__(
         self,
         db,
@@ -379,6 +395,33 @@ class AUSTable(object):
 
         return rows_to_dicts(result)
 
+    def getVersionStamp(self, transaction=None):
+        """Returns a tuple that changes whenever rows in this table are
+        inserted, updated, or deleted. It is built from the number of rows,
+        the sum of their data_versions (for versioned tables), and the most
+        recent change_id in the history table (for tables that have one).
+
+        :rtype: tuple
+        """
+        queries = []
+        columns = [func.count()]
+        if self.versioned:
+            columns.append(func.sum(self.data_version))
+        queries.append(select(columns).select_from(self.t))
+        if isinstance(self.history, HistoryTable):
+            queries.append(select([sql_max(self.history.change_id)]))
+
+        stamp = ()
+        if transaction:
+            for query in queries:
+                stamp += tuple(transaction.execute(query).fetchone())
+        else:
+            with AUSTransaction(self.getEngine()) as trans:
+                for query in queries:
+                    stamp += tuple(trans.execute(query).fetchone())
+
+        return stamp
+
     def _insertStatement(self, **columns):
         """Create an INSERT statement for this table
 
@@ -407,8 +450,14 @@ class AUSTable(object):
             data["data_version"] = 1
         query, unconsumed_columns = self._insertStatement(**data)
         ret = trans.execute(query)
+        self._publishChange(trans, dict(zip([pk.name for pk in self.primary_key], ret.inserted_primary_key)), data.get("data_version"))
         return data, ret
 
+    def _publishChange(self, trans, primary_key, data_version):
+        publisher = getattr(self.db, "changePublisher", None)
+        if self.publish_changes and publisher:
+            trans.afterCommit(partial(publisher.publish, self.t.name, primary_key, data_version))
+
     def _prepareInsert(self, trans, changed_by, **columns):
         data, ret = self._sharedPrepareInsert(trans, changed_by, **columns)
         if self.history:
@@ -521,6 +570,7 @@ class AUSTable(object):
             if self.scheduled_changes.select(where=sc_where, transaction=trans):
                 raise ChangeScheduledError("Cannot delete rows that have changes scheduled.")
 
+        self._publishChange(trans, {pk.name: row[pk.name] for pk in self.primary_key}, None)
         return row, ret
 
     def _prepareDelete(self, trans, where, changed_by, old_data_version):
@@ -678,6 +728,7 @@ class AUSTable(object):
             raise OutdatedDataError("Failed to update row, old_data_version doesn't match current data_version")
         if self.scheduled_changes:
             self.scheduled_changes.mergeUpdate(orig_row, what, changed_by, trans)
+        self._publishChange(trans, {pk.name: new_row[pk.name] for pk in self.primary_key}, new_row.get("data_version"))
         return new_row, ret
 
     def _prepareUpdate(self, trans, where, what, changed_by, old_data_version):
@@ -1734,6 +1785,8 @@ class SignoffsTable(AUSTable):
 
 
 class Rules(AUSTable):
+    publish_changes = True
+
     def __init__(self, db, metadata, dialect):
         self.table = Table(
             "rules",
@@ -1763,6 +1816,14 @@ class Rules(AUSTable):
         )
 
         AUSTable.__init__(self, db, dialect, scheduled_changes=True, historyClass=HistoryTable)
+        self.index = None
+
+    def enableIndex(self, refresh_interval):
+        """Serve getRulesMatchingQuery from an in-memory copy of the whole
+        rules table instead of querying the database (or the "rules" cache).
+        The copy is reloaded when the table changes, which is checked for at
+        most once every refresh_interval seconds."""
+        self.index = RuleIndex(self, refresh_interval)
 
     def getPotentialRequiredSignoffs(self, affected_rows, transaction=None):
         potential_required_signoffs = {}
@@ -1824,88 +1885,99 @@ class Rules(AUSTable):
         """Returns all of the rules, sorted in ascending order"""
         return self.select(where=where, order_by=(self.priority, self.version, self.mapping), transaction=transaction)
 
-    def getRulesMatchingQuery(self, updateQuery, fallbackChannel, transaction=None):
-        """Returns all of the rules that match the given update query.
-        For cases where a particular updateQuery channel has no
-        fallback, fallbackChannel should match the channel from the query."""
+    def _selectRawMatches(self, products, updateQuery, transaction=None):
+        """Selects the Rules that could match updateQuery if its product were any
+        of products, going by the columns that can be checked in the database."""
+        where = [((self.product.in_(products)) | (self.product == null())) & ((self.buildTarget == updateQuery["buildTarget"]) | (self.buildTarget == null()))]
 
-        def getRawMatches():
-            where = [
-                ((self.product == updateQuery["product"]) | (self.product == null()))
-                & ((self.buildTarget == updateQuery["buildTarget"]) | (self.buildTarget == null()))
-            ]
-
-            if "headerArchitecture" in updateQuery:
-                where.extend([(self.headerArchitecture == updateQuery.get("headerArchitecture")) | (self.headerArchitecture == null())])
-            else:
-                where.extend([self.headerArchitecture == null()])
+        if "headerArchitecture" in updateQuery:
+            where.extend([(self.headerArchitecture == updateQuery.get("headerArchitecture")) | (self.headerArchitecture == null())])
+        else:
+            where.extend([self.headerArchitecture == null()])
 
-            if "distVersion" in updateQuery:
-                where.extend([(self.distVersion == updateQuery["distVersion"]) | (self.distVersion == null())])
-            else:
-                where.extend([self.distVersion == null()])
+        if "distVersion" in updateQuery:
+            where.extend([(self.distVersion == updateQuery["distVersion"]) | (self.distVersion == null())])
+        else:
+            where.extend([self.distVersion == null()])
 
-            self.log.debug("where: %s", where)
-            return self.select(where=where, transaction=transaction)
+        self.log.debug("where: %s", where)
+        return [CompiledRule(rule) for rule in self.select(where=where, transaction=transaction)]
 
+    def _rawMatchesCacheKey(self, updateQuery):
         # This cache key is constructed from all parts of the updateQuery that
         # are used in the select() to get the "raw" rule matches. For the most
         # part, product and buildTarget will be the only applicable ones which
         # means we should get very high cache hit rates, as there's not a ton
         # of variability of possible combinations for those.
-        cache_key = "%s:%s:%s:%s:%s" % (
+        return "%s:%s:%s:%s:%s" % (
             updateQuery["product"],
             updateQuery["buildTarget"],
             updateQuery.get("headerArchitecture"),
             updateQuery.get("distVersion"),
             updateQuery.get("force"),
         )
-        rules = cache.get("rules", cache_key, getRawMatches)
 
-        self.log.debug("Raw matches:")
+    def _getRawMatches(self, updateQuery, transaction=None):
+        def getRawMatches(transaction=transaction):
+            return self._selectRawMatches([updateQuery["product"]], updateQuery, transaction)
+
+        # Background refreshes can't use the caller's transaction.
+        return cache.get("rules", self._rawMatchesCacheKey(updateQuery), getRawMatches, lambda: getRawMatches(transaction=None))
+
+    def _getRawMatchesMany(self, updateQueries, transaction=None):
+        """Does the same thing as calling _getRawMatches for each of updateQueries,
+        except that they're looked up in the cache all at once, and the ones that
+        aren't cached are selected together. Queries that only differ by product
+        need just one select between them."""
+        cache_keys = [self._rawMatchesCacheKey(updateQuery) for updateQuery in updateQueries]
+        matches = cache.get_many([("rules", cache_key, None) for cache_key in cache_keys])
+
+        uncached = defaultdict(dict)
+        for updateQuery, cache_key, rules in zip(updateQueries, cache_keys, matches):
+            if rules is None:
+                group = (updateQuery["buildTarget"], updateQuery.get("headerArchitecture"), updateQuery.get("distVersion"))
+                uncached[group][cache_key] = updateQuery
+
+        selected = {}
+        for queries in uncached.values():
+            products = sorted({updateQuery["product"] for updateQuery in queries.values()})
+            rules = self._selectRawMatches(products, next(iter(queries.values())), transaction)
+            for cache_key, updateQuery in queries.items():
+                selected[cache_key] = [rule for rule in rules if rule["product"] in (None, updateQuery["product"])]
+                cache.put("rules", cache_key, selected[cache_key])
+
+        return [selected[cache_key] if rules is None else rules for cache_key, rules in zip(cache_keys, matches)]
+
+    def _ruleMatchesQuery(self, rule, updateQuery, fallbackChannel, versionClass):
+        self.log.debug(rule)
+
+        # Rules that were loaded from a shared cache have been through JSON,
+        # and need to be compiled again.
+        if not isinstance(rule, CompiledRule):
+            rule = CompiledRule(rule)
+
+        # Resolve special means for channel, version, and buildID, and comma
+        # delimited lists of osVersions, locales, etc. - dropping rules that
+        # don't match after resolution.
+        mismatch = rule.findMismatch(updateQuery, fallbackChannel, versionClass)
+        if mismatch:
+            self.log.debug("%s doesn't match %s", rule[mismatch], updateQuery.get(mismatch))
+            return False
+        return True
 
-        matchingRules = []
-        for rule in rules:
-            self.log.debug(rule)
+    def getRulesMatchingQuery(self, updateQuery, fallbackChannel, transaction=None):
+        """Returns all of the rules that match the given update query.
+        For cases where a particular updateQuery channel has no
+        fallback, fallbackChannel should match the channel from the query."""
+        if self.index is not None:
+            rules = self.index.getCandidates(updateQuery, fallbackChannel, transaction)
+        else:
+            rules = self._getRawMatches(updateQuery, transaction)
 
-            # Resolve special means for channel, version, and buildID - dropping
-            # rules that don't match after resolution.
-            if not matchChannel(rule["channel"], updateQuery["channel"], fallbackChannel):
-                self.log.debug("%s doesn't match %s", rule["channel"], updateQuery["channel"])
-                continue
-            if not matchVersion(rule["version"], updateQuery["version"], get_version_class(updateQuery["product"])):
-                self.log.debug("%s doesn't match %s", rule["version"], updateQuery["version"])
-                continue
-            if not matchBuildID(rule["buildID"], updateQuery.get("buildID", "")):
-                self.log.debug("%s doesn't match %s", rule["buildID"], updateQuery.get("buildID"))
-                continue
-            if not matchMemory(rule["memory"], updateQuery.get("memory")):
-                self.log.debug("%s doesn't match %s", rule["memory"], updateQuery.get("memory"))
-                continue
-            # To help keep the rules table compact, multiple OS versions may be
-            # specified in a single rule. They are comma delimited, so we need to
-            # break them out and create clauses for each one.
-            if not matchSimpleExpression(rule["osVersion"], updateQuery.get("osVersion", "")):
-                self.log.debug("%s doesn't match %s", rule["osVersion"], updateQuery.get("osVersion"))
-                continue
-            if not matchCsv(rule["instructionSet"], updateQuery.get("instructionSet", ""), substring=False):
-                self.log.debug("%s doesn't match %s", rule["instructionSet"], updateQuery.get("instructionSet"))
-                continue
-            if not matchCsv(rule["distribution"], updateQuery.get("distribution", ""), substring=False):
-                self.log.debug("%s doesn't match %s", rule["distribution"], updateQuery.get("distribution"))
-                continue
-            # Locales may be a comma delimited rule too, exact matches only
-            if not matchLocale(rule["locale"], updateQuery.get("locale", "")):
-                self.log.debug("%s doesn't match %s", rule["locale"], updateQuery.get("locale"))
-                continue
-            if not matchBoolean(rule["mig64"], updateQuery.get("mig64")):
-                self.log.debug("%s doesn't match %s", rule["mig64"], updateQuery.get("mig64"))
-                continue
-            if not matchBoolean(rule["jaws"], updateQuery.get("jaws")):
-                self.log.debug("%s doesn't match %s", rule["jaws"], updateQuery.get("jaws"))
-                continue
+        self.log.debug("Raw matches:")
 
-            matchingRules.append(rule)
+        versionClass = get_version_class(updateQuery["product"])
+        matchingRules = [rule for rule in rules if self._ruleMatchesQuery(rule, updateQuery, fallbackChannel, versionClass)]
 
         self.log.debug("Reduced matches:")
         if self.log.isEnabledFor(logging.DEBUG):
@@ -1913,6 +1985,38 @@ class Rules(AUSTable):
                 self.log.debug(r)
         return matchingRules
 
+    def getHighestPriorityMatchingRule(self, updateQuery, fallbackChannel, transaction=None):
+        """Returns the highest priority rule that matches the given update
+        query, or None if there isn't one. This is the rule that sorting the
+        results of getRulesMatchingQuery by priority would put first, but
+        candidates are evaluated in priority order, and evaluation stops at
+        the first one that matches."""
+        if self.index is not None:
+            rules = self.index.iterCandidatesByPriority(updateQuery, fallbackChannel, transaction)
+        else:
+            rules = sorted(self._getRawMatches(updateQuery, transaction), key=lambda rule: rule["priority"], reverse=True)
+
+        return self._highestPriorityMatch(rules, updateQuery, fallbackChannel)
+
+    def getHighestPriorityMatchingRules(self, lookups, transaction=None):
+        """Does the same thing as calling getHighestPriorityMatchingRule for each of
+        the (updateQuery, fallbackChannel) tuples in lookups, and returns the results
+        in the same order. The candidates for all of them are looked up at once."""
+        if self.index is not None:
+            candidates = [self.index.iterCandidatesByPriority(updateQuery, fallbackChannel, transaction) for updateQuery, fallbackChannel in lookups]
+        else:
+            raw_matches = self._getRawMatchesMany([updateQuery for updateQuery, _ in lookups], transaction)
+            candidates = [sorted(rules, key=lambda rule: rule["priority"], reverse=True) for rules in raw_matches]
+
+        return [self._highestPriorityMatch(rules, updateQuery, fallbackChannel) for rules, (updateQuery, fallbackChannel) in zip(candidates, lookups)]
+
+    def _highestPriorityMatch(self, rules, updateQuery, fallbackChannel):
+        versionClass = get_version_class(updateQuery["product"])
+        for rule in rules:
+            if self._ruleMatchesQuery(rule, updateQuery, fallbackChannel, versionClass):
+                return rule
+        return None
+
     def getRule(self, id_or_alias, transaction=None):
         """Returns the unique rule that matches the give rule_id or alias."""
         where = []
@@ -1978,6 +2082,8 @@ class Rules(AUSTable):
 
 
 class Releases(AUSTable):
+    publish_changes = True
+
     def __init__(self, db, metadata, dialect, history_buckets, historyClass):
         self.domainAllowlist = []
 
@@ -2137,7 +2243,16 @@ class Releases(AUSTable):
                 return obj
             return obj["data_version"]
 
-        cached_blob = cache.get("blob", name, getBlob)
+        def refreshBlob():
+            # This runs in the background, so it can't use the caller's transaction. It also
+            # can't rely on data_version, which may be older than the blob it's retrieving.
+            try:
+                row = self.select(where=[self.name == name], columns=[self.data, self.data_version], limit=1)[0]
+                return {"data_version": row["data_version"], "blob": row["data"]}
+            except IndexError:
+                raise KeyError("Couldn't find release with name '%s'" % name)
+
+        cached_blob = cache.get("blob", name, getBlob, refreshBlob)
 
         # Even though we may have retrieved a cached blob, we need to make sure
         # that it's not older than the one in the database. If the data version
@@ -2287,8 +2402,12 @@ class Releases(AUSTable):
             raise PermissionDeniedError("%s is not allowed to add builds for product %s" % (changed_by, product))
 
         releaseBlob = self.getReleaseBlob(name, transaction=transaction)
+        # The rest of the Release was validated when it was stored, so only the
+        # parts that we change need to be validated again.
+        changed_paths = []
         if "platforms" not in releaseBlob:
             releaseBlob["platforms"] = {}
+            changed_paths.append(("platforms",))
 
         if platform in releaseBlob["platforms"]:
             # If the platform we're given is aliased to another one, we need
@@ -2298,19 +2417,25 @@ class Releases(AUSTable):
 
         if platform not in releaseBlob["platforms"]:
             releaseBlob["platforms"][platform] = {}
+            changed_paths.append(("platforms", platform))
 
         if "locales" not in releaseBlob["platforms"][platform]:
             releaseBlob["platforms"][platform]["locales"] = {}
+            changed_paths.append(("platforms", platform, "locales"))
 
         releaseBlob["platforms"][platform]["locales"][locale] = data
+        changed_paths.append(("platforms", platform, "locales", locale))
 
         # we don't allow modification of existing platforms (aliased or not)
         if alias:
             for a in alias:
                 if a not in releaseBlob["platforms"]:
                     releaseBlob["platforms"][a] = {"alias": platform}
+                    changed_paths.append(("platforms", a))
 
-        releaseBlob.validate(product, self.domainAllowlist)
+        # Paths that are inside of other changed paths are validated with them.
+        changed_paths = [p for p in changed_paths if not any(p[: len(other)] == other and p != other for other in changed_paths)]
+        releaseBlob.validateSubtrees(product, self.domainAllowlist, changed_paths)
         what = dict(data=releaseBlob)
 
         self.update(where=where, what=what, changed_by=changed_by, old_data_version=old_data_version, transaction=transaction)
@@ -2405,6 +2530,8 @@ class Releases(AUSTable):
 
 
 class ReleasesJSON(AUSTable):
+    publish_changes = True
+
     def __init__(self, db, metadata, dialect, history_buckets, historyClass):
         self.domainAllowlist = []
 
@@ -2504,6 +2631,8 @@ class ReleasesJSON(AUSTable):
 
 
 class ReleaseAssets(AUSTable):
+    publish_changes = True
+
     def __init__(self, db, metadata, dialect, history_buckets, historyClass):
         self.table = Table(
             "release_assets",
@@ -2872,6 +3001,8 @@ class Dockerflow(AUSTable):
 
 
 class EmergencyShutoffs(AUSTable):
+    publish_changes = True
+
     def __init__(self, db, metadata, dialect):
         self.table = Table(
             "emergency_shutoffs",
@@ -2881,6 +3012,18 @@ class EmergencyShutoffs(AUSTable):
             Column("comment", String(500)),
         )
         AUSTable.__init__(self, db, dialect, scheduled_changes=True, scheduled_changes_kwargs={"conditions": ["time"]}, historyClass=HistoryTable)
+        self.snapshot = None
+
+    def enableSnapshot(self, refresh_interval):
+        """Keep the (product, channel) of every emergency shutoff in memory, and
+        check for changes to them at most once every refresh_interval seconds.
+        See updatesAreDisabled."""
+        self.snapshot = EmergencyShutoffSnapshot(self, refresh_interval)
+
+    def updatesAreDisabled(self, product, channel, transaction=None):
+        """Returns whether there's an emergency shutoff for product and channel.
+        This must only be used after enableSnapshot has been called."""
+        return (product, channel) in self.snapshot.get(transaction)
 
     def insert(self, changed_by, transaction=None, dryrun=False, **columns):
         if not self.db.hasPermission(changed_by, "emergency_shutoff", "create", columns.get("product"), transaction):
@@ -2913,6 +3056,8 @@ class EmergencyShutoffs(AUSTable):
 
 
 class PinnableReleasesTable(AUSTable):
+    publish_changes = True
+
     def __init__(self, db, metadata, dialect):
         self.table = Table(
             "pinnable_releases",
@@ -2923,6 +3068,14 @@ class PinnableReleasesTable(AUSTable):
             Column("mapping", String(100), nullable=False),
         )
         AUSTable.__init__(self, db, dialect, scheduled_changes=True, scheduled_changes_kwargs={"conditions": ["time"]}, historyClass=HistoryTable)
+        self.snapshot = None
+
+    def enableSnapshot(self, refresh_interval):
+        """Serve getPinRow, getPinMapping, and mappingHasPin from an in-memory copy
+        of the whole table instead of querying the database. The copy is reloaded
+        when the table changes, which is checked for at most once every
+        refresh_interval seconds."""
+        self.snapshot = PinSnapshot(self, refresh_interval)
 
     def getPotentialRequiredSignoffs(self, affected_rows, transaction=None):
         # Implementing this is required to schedule changes to this table
@@ -2960,6 +3113,10 @@ class PinnableReleasesTable(AUSTable):
         super(PinnableReleasesTable, self).delete(changed_by=changed_by, where=where, old_data_version=old_data_version, transaction=transaction, dryrun=dryrun)
 
     def getPinRow(self, product, channel, version, transaction=None):
+        if self.snapshot is not None:
+            pin = self.snapshot.get(transaction).pins.get((product, channel, version))
+            return dict(pin) if pin else None
+
         rows = self.select(
             where=[self.product == product, self.channel == channel, self.version == version],
             columns=[self.mapping, self.data_version],
@@ -2970,9 +3127,16 @@ class PinnableReleasesTable(AUSTable):
         return rows[0]
 
     def mappingHasPin(self, mapping, transaction=None):
+        if self.snapshot is not None:
+            return mapping in self.snapshot.get(transaction).mappings
+
         return self.count(where=[self.mapping == mapping], transaction=transaction) > 0
 
     def getPinMapping(self, product, channel, version, transaction=None):
+        if self.snapshot is not None:
+            pin = self.snapshot.get(transaction).pins.get((product, channel, version))
+            return pin["mapping"] if pin else None
+
         rows = self.select(where=[self.product == product, self.channel == channel, self.version == version], columns=[self.mapping], transaction=transaction)
         if len(rows) == 0:
             return None
@@ -3006,6 +3170,7 @@ class AUSDatabase(object):
             self.setDburi(dburi, mysql_traditional_mode, releases_history_buckets, releases_history_class, async_releases_history_class)
         self.log = logging.getLogger(self.__class__.__name__)
         self.systemAccounts = []
+        self.changePublisher = None
 
     def setDburi(
         self,
@@ -3046,6 +3211,11 @@ class AUSDatabase(object):
     def setSystemAccounts(self, systemAccounts):
         self.systemAccounts = systemAccounts
 
+    def setChangePublisher(self, changePublisher):
+        """Sets the object (usually an auslib.util.invalidation.ChangePublisher)
+        that is told about committed changes to tables that publish them."""
+        self.changePublisher = changePublisher
+
     def setDomainAllowlist(self, domainAllowlist):
         self.releasesTable.setDomainAllowlist(domainAllowlist)
 
@@ -2,6 +2,7 @@ import asyncio
 import logging
 from collections import defaultdict
 from copy import deepcopy
+from functools import partial
 
 from aiohttp import ClientError
 from deepmerge import Merger
@@ -14,7 +15,7 @@ from auslib.util.signoffs import get_required_signoffs_for_product_channel
 from auslib.util.versions import MozillaVersion
 
 from ..blobs.base import createBlob
-from ..errors import PermissionDeniedError, ReadOnlyError, SignoffRequiredError
+from ..errors import BadDataError, PermissionDeniedError, ReadOnlyError, SignoffRequiredError
 from ..global_state import cache, dbo
 from ..util.data_structures import ensure_path_exists, get_by_path, infinite_defaultdict, set_by_path
 from ..util.signoffs import serialize_signoff_requirements
@@ -365,24 +366,63 @@ def get_asset_data_versions(name, trans):
     )
 
 
+def get_asset_row(name, path, trans):
+    row = dbo.release_assets.select(where={"name": name, "path": path}, transaction=trans)
+    if row:
+        return row[0]
+
+    return None
+
+
+def get_asset_index(name, trans):
+    """Returns the data_version of each of a Release's assets, keyed by path, and the
+    paths of the dicts that contain them (eg: ".platforms.WINNT_x86_64-msvc.locales").
+    This is much smaller than the assets themselves, and is enough to know which of
+    them a particular update request needs, and whether or not a cached copy of them
+    is stale."""
+    rows = dbo.release_assets.select(where={"name": name}, columns=[dbo.release_assets.path, dbo.release_assets.data_version], transaction=trans)
+    return {
+        "data_versions": {row["path"]: row["data_version"] for row in rows},
+        "containers": sorted({row["path"].rsplit(".", 1)[0] for row in rows}),
+    }
+
+
+def base_row_lookups(name, trans):
+    """Returns the cache lookups (see MaybeCacher.get_many) for a Release's base row
+    and its latest data_version, which should be passed to fresh_base_row."""
+    return [
+        # Background refreshes can't use the caller's transaction.
+        ("releases", name, lambda: get_base_row(name, trans), lambda: get_base_row(name, None)),
+        ("releases_data_version", name, lambda: get_base_data_version(name, trans)),
+    ]
+
+
+def fresh_base_row(name, base_row, base_data_version, trans):
+    # base_data_version is cached for a shorter period of time than the overall row
+    # because it's cheap to retrieve. if the cached row's data_version is older than
+    # the cached data_version we will forcibly update it to make sure we minimize
+    # the time we're serving old release data
+    if base_row and base_row["data_version"] < base_data_version:
+        base_row = get_base_row(name, trans)
+    return base_row
+
+
 def get_release(name, trans, include_sc=True):
     # Get all of the base and asset information, potentially from a cache
-    base_row = cache.get("releases", name, lambda: get_base_row(name, trans))
-    base_data_version = cache.get("releases_data_version", name, lambda: get_base_data_version(name, trans))
-    asset_rows = cache.get("release_assets", name, lambda: get_asset_rows(name, trans))
-    asset_data_versions = cache.get("release_assets_data_versions", name, lambda: get_asset_data_versions(name, trans))
+    base_row, base_data_version, asset_rows, asset_data_versions = cache.get_many(
+        base_row_lookups(name, trans)
+        + [
+            ("release_assets", name, lambda: get_asset_rows(name, trans)),
+            ("release_assets_data_versions", name, lambda: get_asset_data_versions(name, trans)),
+        ]
+    )
+    base_row = fresh_base_row(name, base_row, base_data_version, trans)
 
     data_versions = infinite_defaultdict()
     sc_data_versions = infinite_defaultdict()
     base_blob = {}
     sc_blob = {}
     if base_row:
-        # base_data_version is cached for a shorter period of time than the overall row
-        # because it's cheap to retrieve. if the cached row's data_version is older than
-        # the cached data_version we will forcibly update it to make sure we minimize
-        # the time we're serving old release data
-        if base_row["data_version"] < base_data_version:
-            base_row = get_base_row(name, trans)
         base_blob = base_row["data"]
         data_versions["."] = base_row["data_version"]
 
@@ -391,14 +431,7 @@ def get_release(name, trans, include_sc=True):
     if [r["data_version"] for r in asset_rows] != [r["data_version"] for r in asset_data_versions]:
         asset_rows = get_asset_rows(name, trans)
 
-    for asset in asset_rows:
-        path = asset["path"].split(".")[1:]
-        ensure_path_exists(base_blob, path)
-        set_by_path(base_blob, path, asset["data"])
-        set_by_path(data_versions, path, asset["data_version"])
-        if sc_blob:
-            ensure_path_exists(sc_blob, path)
-            set_by_path(sc_blob, path, asset["data"])
+    merge_assets(base_blob, data_versions, asset_rows)
 
     if include_sc:
         scheduled_row = dbo.releases_json.scheduled_changes.select(where={"base_name": name, "complete": False}, transaction=trans)
@@ -427,6 +460,287 @@ def get_release(name, trans, include_sc=True):
         return None
 
 
+def get_release_blob(name, release, parts=None):
+    """Returns the blob of a Release from get_release, get_release_for_locale or
+    get_releases_for_locale as a Blob, with its lookups precomputed. parts must
+    identify which parts of the Release were loaded (eg: the platform and locale
+    given to get_release_for_locale), or be None for the whole Release.
+
+    Blobs are cached in this process by name and parts, and reused for as long
+    as the Release's data_versions don't change, so that serving updates doesn't
+    need to build the same Blob over and over again. Because of this, they are
+    shared, and must not be modified."""
+    cache_key = (name, parts)
+    cached = cache.get("release_blobs", cache_key)
+    if cached and cached["data_versions"] == release["data_versions"]:
+        return cached["blob"]
+
+    blob = createBlob(release["blob"])
+    blob.precomputeLookups()
+    cache.put("release_blobs", cache_key, {"data_versions": release["data_versions"], "blob": blob})
+    return blob
+
+
+def merge_assets(base_blob, data_versions, asset_rows):
+    for asset in asset_rows:
+        path = asset["path"].split(".")[1:]
+        ensure_path_exists(base_blob, path)
+        set_by_path(base_blob, path, asset["data"])
+        set_by_path(data_versions, path, asset["data_version"])
+
+
+def select_by_name(table, names, trans, **kwargs):
+    """Returns the rows of table for all of names, grouped by name."""
+    rows = defaultdict(list)
+    if names:
+        for row in table.select(where=[table.name.in_(names)], transaction=trans, **kwargs):
+            rows[row["name"]].append(row)
+    return rows
+
+
+def get_releases_by_names(names, trans):
+    """Returns the Release (as get_release does, without scheduled changes) and the
+    product of each of names, keyed by name, as {"release": ..., "product": ...}. The
+    Release is a Blob, and the data_versions of it are in "data_versions". Names that
+    aren't in either releases table map to None.
+
+    This uses the same caches as get_release does, but whatever isn't cached (or is
+    stale) is selected for all of the names at once, so it takes the same number of
+    queries however many Releases there are."""
+    names = list(dict.fromkeys(names))
+    cache_names = ("releases", "releases_data_version", "release_assets", "release_assets_data_versions")
+    values = cache.get_many([(cache_name, name, None) for name in names for cache_name in cache_names])
+    cached = {name: dict(zip(cache_names, values[i * len(cache_names) : (i + 1) * len(cache_names)])) for i, name in enumerate(names)}
+
+    def missing(cache_name):
+        return [name for name in names if cached[name][cache_name] is None]
+
+    rjson, assets = dbo.releases_json, dbo.release_assets
+    for name, rows in select_by_name(rjson, missing("releases"), trans).items():
+        cached[name]["releases"] = rows[0]
+        cache.put("releases", name, rows[0])
+    for name, rows in select_by_name(rjson, missing("releases_data_version"), trans, columns=[rjson.name, rjson.data_version]).items():
+        cached[name]["releases_data_version"] = rows[0]["data_version"]
+        cache.put("releases_data_version", name, rows[0]["data_version"])
+
+    # Releases that aren't in the releases_json table don't have any assets.
+    new_names = [name for name in names if cached[name]["releases"]]
+    asset_names = [name for name in new_names if cached[name]["release_assets"] is None]
+    asset_rows = select_by_name(assets, asset_names, trans, order_by=[assets.name, assets.path])
+    asset_dv_names = [name for name in new_names if cached[name]["release_assets_data_versions"] is None]
+    asset_dv_rows = select_by_name(assets, asset_dv_names, trans, columns=[assets.name, assets.data_version], order_by=[assets.name, assets.path])
+    for name in asset_names:
+        cached[name]["release_assets"] = asset_rows[name]
+        cache.put("release_assets", name, asset_rows[name])
+    for name in asset_dv_names:
+        cached[name]["release_assets_data_versions"] = [{"data_version": row["data_version"]} for row in asset_dv_rows[name]]
+        cache.put("release_assets_data_versions", name, cached[name]["release_assets_data_versions"])
+
+    # Just like get_release, anything that's older than its latest data_version is
+    # reloaded.
+    stale = [name for name in new_names if cached[name]["releases"]["data_version"] < (cached[name]["releases_data_version"] or 0)]
+    for name, rows in select_by_name(rjson, stale, trans).items():
+        cached[name]["releases"] = rows[0]
+    stale = [
+        name
+        for name in new_names
+        if [r["data_version"] for r in cached[name]["release_assets"]] != [r["data_version"] for r in cached[name]["release_assets_data_versions"]]
+    ]
+    asset_rows = select_by_name(assets, stale, trans, order_by=[assets.name, assets.path])
+    for name in stale:
+        cached[name]["release_assets"] = asset_rows[name]
+
+    releases = {}
+    for name in new_names:
+        base_row = cached[name]["releases"]
+        data_versions = infinite_defaultdict()
+        data_versions["."] = base_row["data_version"]
+        blob = base_row["data"]
+        merge_assets(blob, data_versions, cached[name]["release_assets"])
+        release = get_release_blob(name, {"blob": blob, "data_versions": data_versions})
+        releases[name] = {"release": release, "data_versions": data_versions, "product": base_row["product"]}
+
+    # TODO: remove me when old releases table dies
+    legacy_names = [name for name in names if name not in releases]
+    for name, info in zip(legacy_names, cache.get_many([("blob", name, None) for name in legacy_names])):
+        cached[name]["blob"] = info
+    legacy_columns = [dbo.releases.name, dbo.releases.product, dbo.releases.data_version]
+    legacy_rows = {name: rows[0] for name, rows in select_by_name(dbo.releases, legacy_names, trans, columns=legacy_columns).items()}
+
+    def cached_blob_version(name):
+        # Releases.getReleaseBlob caches the whole data_version row along with the blob
+        data_version = cached[name]["blob"]["data_version"]
+        return data_version if isinstance(data_version, int) else data_version["data_version"]
+
+    stale = [name for name in legacy_rows if not cached[name]["blob"] or cached_blob_version(name) < legacy_rows[name]["data_version"]]
+    for name, rows in select_by_name(dbo.releases, stale, trans, columns=[dbo.releases.name, dbo.releases.data]).items():
+        cached[name]["blob"] = {"data_version": legacy_rows[name]["data_version"], "blob": rows[0]["data"]}
+        cache.put("blob", name, cached[name]["blob"])
+    for name in legacy_names:
+        row = legacy_rows.get(name)
+        if row:
+            releases[name] = {"release": cached[name]["blob"]["blob"], "data_versions": row["data_version"], "product": row["product"]}
+        else:
+            releases[name] = None
+
+    return {name: releases[name] for name in names}
+
+
+def get_release_for_locale(name, platforms, locale, trans):
+    """Returns a Release the same way that get_release does (without scheduled changes),
+    except that the only assets included are the ones for `locale` on each of `platforms`
+    (and on the platforms that those are aliases of). Every other platform that has
+    assets is present, but with an empty "locales", so that lookups for other locales
+    or platforms fail in the same way they would with the full Release.
+
+    The base Release and each asset are cached separately, and checked against their
+    latest data_version, so that serving an update request only ever needs to load the
+    small part of a Release that it looks at.
+
+    The returned blob is a copy of the cached data (only as deep as needed to add the
+    assets to it), but the assets themselves are shared, and must not be modified."""
+    return get_releases_for_locale([name], platforms, locale, trans)[name]
+
+
+def get_releases_for_locale(names, platforms, locale, trans):
+    """Does the same thing as calling get_release_for_locale for each of names, and
+    returns the results keyed by name. The cached parts of all of the Releases are
+    looked up at once: one round trip for their base rows and asset indexes, and
+    one more for the assets that they need."""
+    names = list(dict.fromkeys(names))
+    lookups = []
+    for name in names:
+        lookups.extend(base_row_lookups(name, trans) + [("release_assets_index", name, partial(get_asset_index, name, trans))])
+    values = cache.get_many(lookups)
+
+    releases = {}
+    asset_paths = []
+    for i, name in enumerate(names):
+        base_row, base_data_version, index = values[i * 3 : i * 3 + 3]
+        base_row = fresh_base_row(name, base_row, base_data_version, trans)
+        if not base_row:
+            releases[name] = None
+            continue
+
+        release = _LocaleRelease(base_row, index)
+        releases[name] = release
+        asset_paths.extend((name, path) for path in release.wanted_paths(platforms, locale))
+
+    rows = cache.get_many([("release_assets_by_path", f"{name}:{path}", partial(get_asset_row, name, path, trans)) for name, path in asset_paths])
+    for (name, path), row in zip(asset_paths, rows):
+        release = releases[name]
+        data_version = release.index["data_versions"][path]
+        # The index is cached for a shorter period of time than the assets,
+        # so just like with the base row, a cached asset that's older than
+        # the index says it should be is replaced.
+        if not row or row["data_version"] < data_version:
+            row = get_asset_row(name, path, trans)
+            cache.put("release_assets_by_path", f"{name}:{path}", row)
+        if row:
+            release.add_asset(path, row)
+
+    return {name: release and release.as_release() for name, release in releases.items()}
+
+
+class _LocaleRelease(object):
+    """A copy of a cached base Release that the assets for a single locale are
+    added to, without modifying the cached data (see get_release_for_locale)."""
+
+    def __init__(self, base_row, index):
+        self.base_blob = base_row["data"]
+        self.index = index
+        self.blob = self.base_blob
+        self.data_versions = infinite_defaultdict()
+        self.data_versions["."] = base_row["data_version"]
+        self.copied = set()
+
+        if index["data_versions"]:
+            self.blob = dict(self.base_blob)
+            # The assets always live in these containers, so they start out empty,
+            # even if get_release has already merged assets into the cached base blob.
+            for container_path in index["containers"]:
+                parts = container_path.split(".")[1:]
+                container = {}
+                self.get_container(parts[:-1])[parts[-1]] = container
+                self.copied.add(id(container))
+
+    def get_container(self, path):
+        node = self.blob
+        for key in path:
+            child = node.get(key)
+            if id(child) not in self.copied:
+                child = dict(child or {})
+                node[key] = child
+                self.copied.add(id(child))
+            node = child
+        return node
+
+    def wanted_paths(self, platforms, locale):
+        if not self.index["data_versions"]:
+            return []
+
+        platforms_data = self.base_blob.get("platforms", {})
+        wanted = set()
+        for platform in platforms:
+            wanted.add(platform)
+            wanted.add(platforms_data.get(platform, {}).get("alias", platform))
+
+        paths = [f".platforms.{platform}.locales.{locale}" for platform in sorted(wanted)]
+        return [path for path in paths if path in self.index["data_versions"]]
+
+    def add_asset(self, path, row):
+        parts = path.split(".")[1:]
+        self.get_container(parts[:-1])[parts[-1]] = row["data"]
+        set_by_path(self.data_versions, parts, row["data_version"])
+
+    def as_release(self):
+        return {"blob": self.blob, "data_versions": self.data_versions, "sc_blob": {}, "sc_data_versions": infinite_defaultdict()}
+
+
+def get_build_ids(name, locale, trans):
+    """Returns the buildID that each platform of a Release (including aliases) has
+    for `locale`, or None if the Release doesn't exist. Platforms that don't have
+    the locale, or a buildID for it, are left out.
+
+    This is all that's needed to know whether a partial update from the Release
+    applies to an update request, and is much smaller than the Release itself. It's
+    cached, along with the data_versions of the base Release and the assets that it
+    was built from, and rebuilt when either of them changes."""
+    base_data_version, index = cache.get_many(
+        [
+            ("releases_data_version", name, lambda: get_base_data_version(name, trans)),
+            ("release_assets_index", name, lambda: get_asset_index(name, trans)),
+        ]
+    )
+    if base_data_version is None:
+        return None
+
+    suffix = f".locales.{locale}"
+    data_versions = {path: data_version for path, data_version in index["data_versions"].items() if path.endswith(suffix)}
+    data_versions["."] = base_data_version
+
+    cache_key = f"{name}:{locale}"
+    cached = cache.get("release_build_ids", cache_key)
+    if cached and cached["data_versions"] == data_versions:
+        return cached["build_ids"]
+
+    platforms = [path.split(".")[2] for path in data_versions if path != "."]
+    release = get_release_for_locale(name, platforms, locale, trans)
+    if not release:
+        return None
+
+    blob = get_release_blob(name, release, (tuple(platforms), locale))
+    build_ids = {}
+    for platform in blob.get("platforms", {}):
+        try:
+            build_ids[platform] = blob.getBuildID(platform, locale)
+        except BadDataError:
+            pass
+
+    cache.put("release_build_ids", cache_key, {"data_versions": data_versions, "build_ids": build_ids})
+    return build_ids
+
+
 def get_product(name, trans):
     if not exists(name, trans):
         return None
@@ -507,6 +821,7 @@ def update_release(name, blob, old_data_versions, when, changed_by, trans):
             new_data_versions["."] += 1
 
     current_assets = get_assets(name, trans)
+    changed_asset_paths = []
     for path, item in assets:
         str_path = "." + ".".join(path)
 
@@ -519,6 +834,7 @@ def update_release(name, blob, old_data_versions, when, changed_by, trans):
                 release_merger.merge(new_assets, item)
                 ensure_path_exists(full_blob, path)
                 set_by_path(full_blob, path, new_assets)
+                changed_asset_paths.append(path)
                 if when:
                     sc_id = dbo.release_assets.scheduled_changes.insert(
                         name=name,
@@ -545,6 +861,9 @@ def update_release(name, blob, old_data_versions, when, changed_by, trans):
                     coros.append(coro)
                     set_by_path(new_data_versions, path, old_data_version + 1)
         else:
+            ensure_path_exists(full_blob, path)
+            set_by_path(full_blob, path, item)
+            changed_asset_paths.append(path)
             if when:
                 sc_id = dbo.release_assets.scheduled_changes.insert(
                     name=name,
@@ -564,8 +883,12 @@ def update_release(name, blob, old_data_versions, when, changed_by, trans):
                 coros.append(coro)
                 set_by_path(new_data_versions, path, 1)
 
-    # Raises if there are errors
-    createBlob(full_blob).validate(current_product, app.config["ALLOWLISTED_DOMAINS"])
+    # Raises if there are errors. If the base wasn't changed, it was already
+    # valid, and only the assets that were changed need to be looked at.
+    if base_blob and current_base_blob != base_blob:
+        createBlob(full_blob).validate(current_product, app.config["ALLOWLISTED_DOMAINS"])
+    else:
+        createBlob(full_blob).validateSubtrees(current_product, app.config["ALLOWLISTED_DOMAINS"], changed_asset_paths)
 
     await_coroutines(coros)
 
@@ -1,3 +1,6 @@
+import os
+import queue
+import threading
 from base64 import b64encode
 from hashlib import sha384
 
@@ -9,25 +12,142 @@ from auslib.util.statsd import statsd
 
 SIGNATURE_PREFIX = "Content-Signature:\x00"
 
+# The most hashes that a SigningQueue sends to Autograph in one request.
+MAX_SIGNING_BATCH = 50
 
-def make_hash(content):
-    assert isinstance(content, str)
-    templated = f"{SIGNATURE_PREFIX}{content}".encode("ascii")
-    return sha384(templated).digest()
+# How long (in seconds) SigningQueue.sign waits for the background thread before
+# it gives up and signs the hash itself.
+SIGNING_QUEUE_TIMEOUT = 10
 
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
 
-def _sign_hash(autograph_uri, keyid, id_, key, hash_):
+
+def make_hash(*fragments):
+    """Returns the hash that Autograph signs for content that is made up of
+    fragments, which are hashed one after the other instead of being joined."""
+    hash_ = sha384(SIGNATURE_PREFIX.encode("ascii"))
+    for fragment in fragments:
+        assert isinstance(fragment, str)
+        hash_.update(fragment.encode("ascii"))
+    return hash_.digest()
+
+
+def get_session():
+    """Returns the Session that this process talks to Autograph with, which keeps
+    its connections open between signatures. Processes that are forked after
+    it's created get their own."""
+    global _session, _session_pid
+    with _session_lock:
+        if _session_pid != os.getpid():
+            _session = requests.Session()
+            _session_pid = os.getpid()
+        return _session
+
+
+def _sign_hashes(autograph_uri, keyid, id_, key, hashes):
     auth = HawkAuth(id=id_, key=key)
-    with requests.Session() as session:
-        body = [{"input": b64encode(hash_).decode("ascii"), "keyid": keyid}]
-        r = session.post(f"{autograph_uri}/sign/hash", json=body, auth=auth)
-        statsd.incr(f"autograph.code.{r.status_code}")
-        r.raise_for_status()
-        response = r.json()
-        if len(response) != 1:
-            raise Exception("Response is not length 1, cannot parse it")
-        return response[0]["signature"], response[0]["x5u"]
+    body = [{"input": b64encode(hash_).decode("ascii"), "keyid": keyid} for hash_ in hashes]
+    r = get_session().post(f"{autograph_uri}/sign/hash", json=body, auth=auth)
+    statsd.incr(f"autograph.code.{r.status_code}")
+    r.raise_for_status()
+    response = r.json()
+    if len(response) != len(hashes):
+        raise Exception(f"Response is not length {len(hashes)}, cannot parse it")
+    return [(signature["signature"], signature["x5u"]) for signature in response]
+
+
+def sign_hashes(autograph_uri, keyid, id, key, hashes):
+    """Returns the signature and x5u for each of hashes, which are signed with
+    a single request to Autograph."""
+    return retry_sync(_sign_hashes, args=(autograph_uri, keyid, id, key, hashes), attempts=3, sleeptime_kwargs={"delay_factor": 2.0})
 
 
 def sign_hash(autograph_uri, keyid, id, key, hash):
-    return retry_sync(_sign_hash, args=(autograph_uri, keyid, id, key, hash), attempts=3, sleeptime_kwargs={"delay_factor": 2.0})
+    return sign_hashes(autograph_uri, keyid, id, key, [hash])[0]
+
+
+class _Signing(object):
+    """A hash that is waiting to be signed by a SigningQueue."""
+
+    def __init__(self, credentials, hash_):
+        self.credentials = credentials
+        self.hash = hash_
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+        self.abandoned = False
+
+
+class SigningQueue(object):
+    """Signs hashes on a background thread. Everything that is waiting to be
+    signed with the same key when the thread gets to it is signed with one
+    request to Autograph, so a burst of new responses (eg: after a Release
+    changes) doesn't cost a request to Autograph each.
+
+    The thread is started when the first hash is signed, so that each process
+    that uses the queue has its own. If it doesn't sign a hash within timeout
+    seconds (eg: because Autograph is slow, or the thread has died), the hash is
+    signed directly instead.
+
+    Hashes are only signed once a client asks for a response that needs them;
+    responses aren't signed ahead of time, when a Release changes. Their bodies
+    depend on the queries that clients send, which the public app can't know
+    before the first of them arrives."""
+
+    def __init__(self, max_batch=MAX_SIGNING_BATCH, timeout=SIGNING_QUEUE_TIMEOUT):
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _getQueue(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                threading.Thread(target=self.run, args=(self._queue,), name="SigningQueue", daemon=True).start()
+            return self._queue
+
+    def sign(self, autograph_uri, keyid, id, key, hash):
+        """Returns the same thing as sign_hash, once the background thread has
+        signed hash."""
+        signing = _Signing((autograph_uri, keyid, id, key), hash)
+        self._getQueue().put(signing)
+        if not signing.done.wait(self.timeout):
+            signing.abandoned = True
+            statsd.incr("autograph.signing_queue.timeout")
+            return sign_hash(autograph_uri, keyid, id, key, hash)
+        if signing.exception:
+            raise signing.exception
+        return signing.result
+
+    def signBatch(self, batch):
+        groups = {}
+        for signing in batch:
+            if signing.abandoned:
+                continue
+            groups.setdefault(signing.credentials, []).append(signing)
+        for credentials, signings in groups.items():
+            try:
+                results = sign_hashes(*credentials, [signing.hash for signing in signings])
+                for signing, result in zip(signings, results):
+                    signing.result = result
+            except Exception as e:
+                for signing in signings:
+                    signing.exception = e
+            finally:
+                for signing in signings:
+                    signing.done.set()
+
+    def run(self, queue_):
+        while True:
+            batch = [queue_.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(queue_.get_nowait())
+                except queue.Empty:
+                    break
+            self.signBatch(batch)
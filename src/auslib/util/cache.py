@@ -1,13 +1,49 @@
+import logging
+import math
+import threading
 import time
 from copy import deepcopy
+from functools import partial
+from uuid import uuid4
 
 import orjson
+from redis.exceptions import WatchError
 from repoze.lru import ExpiringLRUCache
 
+from auslib.util.memo import memoize
 from auslib.util.statsd import statsd
 
+log = logging.getLogger(__name__)
+
 uncached_sentinel = object()
 
+# The length of the stamps that UwsgiCache stores its values with.
+STAMP_LENGTH = 32
+
+# The most keys that a thread remembers the change counts of while it looks them
+# up (see RedisCache.put).
+MAX_PENDING_LOADS = 1000
+
+# How often (in seconds) a process waiting for another one to load a key checks
+# Redis for the new value.
+LEASE_POLL_INTERVAL = 0.05
+
+
+class _Load(object):
+    """A lookup of a key that is in progress, which other threads that want the
+    same key can wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exception = None
+
+    def wait(self):
+        self.done.wait()
+        if self.exception:
+            raise self.exception
+        return self.value
+
 
 class MaybeCacher(object):
     """MaybeCacher is a very simple wrapper to work around the fact that we
@@ -38,6 +74,11 @@ class MaybeCacher(object):
         # to allow the caller to provide it in a closure, hence we end up
         # making this a callable instead of a simple class.
         self._factory = lambda _, maxsize, timeout, _post_load=None: ExpiringLRUCache(maxsize, timeout)
+        # The lookups that are currently running, keyed by cache name and key.
+        self._loads = {}
+        self._loads_lock = threading.Lock()
+        # The refresh times and soft timeout of caches that have one, by cache name.
+        self.refresh_times = {}
 
     @property
     def factory(self):
@@ -59,20 +100,44 @@ class MaybeCacher(object):
             raise TypeError("make_copies must be True or False")
         self._make_copies = value
 
-    def make_cache(self, name, maxsize, timeout, post_load=None):
+    def make_cache(self, name, maxsize, timeout, post_load=None, soft_timeout=None, shared=True):
+        """Creates a cache whose items expire after timeout seconds. If soft_timeout
+        is given, items that are older than that are still returned by get, but are
+        refreshed in the background (see get).
+
+        If shared is False, the cache is kept in this process' memory, whatever
+        factory makes. Its values are never serialized, so they can be objects that
+        are expensive to build (or can't be rebuilt) from JSON."""
         if name in self.caches:
             raise Exception()
 
-        self.caches[name] = self.factory(name, maxsize, timeout, post_load)
+        if shared:
+            self.caches[name] = self.factory(name, maxsize, timeout, post_load)
+        else:
+            self.caches[name] = ExpiringLRUCache(maxsize, timeout)
+        if soft_timeout:
+            # When each item in the cache should be refreshed. These are only
+            # useful for as long as the items themselves are cached.
+            self.refresh_times[name] = (ExpiringLRUCache(maxsize, timeout), soft_timeout)
 
     def reset(self):
         self.caches.clear()
+        self.refresh_times.clear()
 
-    def get(self, name, key, value_getter=None):
+    def get(self, name, key, value_getter=None, refresh_getter=None):
         """Returns the value of the specified key from the named cache.
         If value_getter is provided and no cache is found, or no value is
         found for the key, the return value of value_getter will be returned
-        instead."""
+        instead.
+
+        If many threads miss on the same key at the same time, only one of them
+        calls value_getter, and the rest return its result.
+
+        If the cache has a soft_timeout, refresh_getter is provided, and the
+        cached value is older than the soft_timeout, the cached value is returned,
+        and refresh_getter is called in another thread to replace it. Because of
+        this, refresh_getter must not use anything that belongs to the caller,
+        like a database transaction."""
 
         if name not in self.caches:
             if callable(value_getter):
@@ -80,17 +145,39 @@ class MaybeCacher(object):
             else:
                 return None
 
+        return self._finish_get(name, key, self.caches[name].get(key, uncached_sentinel), value_getter, refresh_getter)
+
+    def get_many(self, lookups):
+        """Does the same thing as calling get for each of the (name, key,
+        value_getter[, refresh_getter]) tuples in lookups, and returns the values
+        in the same order. Lookups in caches that share a Redis server are sent
+        to it all at once, rather than one at a time."""
+        values = [None] * len(lookups)
+        cached = []
+        for i, (name, key, value_getter, *refresh_getter) in enumerate(lookups):
+            if name in self.caches:
+                cached.append((i, name, key, value_getter, *refresh_getter))
+            elif callable(value_getter):
+                values[i] = value_getter()
+
+        cached_values = multi_get([(self.caches[name], key) for _, name, key, *_ in cached], uncached_sentinel)
+        for (i, name, key, *getters), cached_value in zip(cached, cached_values):
+            values[i] = self._finish_get(name, key, cached_value, *getters)
+
+        return values
+
+    def _finish_get(self, name, key, cached_value, value_getter=None, refresh_getter=None):
         value = None
-        cached_value = self.caches[name].get(key, uncached_sentinel)
         # If we got something other than a sentinel value, the key was in the cache, and we should return it
         if cached_value != uncached_sentinel:
             value = cached_value
             statsd.incr(f"cache.{name}.hits")
+            if callable(refresh_getter) and self._needs_refresh(name, key):
+                self._refresh(name, key, refresh_getter)
         else:
             # If we know how to look up the value, go do it, cache it, and return it
             if callable(value_getter):
-                value = value_getter()
-                self.put(name, key, value)
+                value = self._load(name, key, value_getter)
             statsd.incr(f"cache.{name}.misses")
 
         if self.make_copies:
@@ -98,29 +185,145 @@ class MaybeCacher(object):
         else:
             return value
 
+    def _set_refresh_time(self, name, key):
+        if name in self.refresh_times:
+            refresh_times, soft_timeout = self.refresh_times[name]
+            refresh_times.put(key, time.time() + soft_timeout)
+
+    def _needs_refresh(self, name, key):
+        if name not in self.refresh_times:
+            return False
+
+        refresh_time = self.refresh_times[name][0].get(key)
+        if refresh_time is None:
+            # The item was cached by another process (or we've forgotten when
+            # we cached it), so we don't know how old it is. We treat it as
+            # fresh rather than refreshing everything we find in a shared cache.
+            self._set_refresh_time(name, key)
+            return False
+
+        return time.time() >= refresh_time
+
+    def _fetch(self, name, key, value_getter):
+        value = value_getter()
+        self.put(name, key, value)
+        return value
+
+    def _finish_load(self, name, key, load, loader):
+        try:
+            load.value = loader()
+        except Exception as e:
+            load.exception = e
+            raise
+        finally:
+            with self._loads_lock:
+                del self._loads[(name, key)]
+            load.done.set()
+
+        return load.value
+
+    def _load(self, name, key, value_getter):
+        with self._loads_lock:
+            load = self._loads.get((name, key))
+            leader = load is None
+            if leader:
+                load = self._loads[(name, key)] = _Load()
+
+        # Another thread is already looking this key up, there's no point in
+        # doing it again.
+        if not leader:
+            statsd.incr(f"cache.{name}.coalesced")
+            return load.wait()
+
+        fetch = partial(self._fetch, name, key, value_getter)
+        # Some caches are shared between processes, and can coordinate
+        # lookups among all of them.
+        c = self.caches[name]
+        if hasattr(c, "load"):
+            return self._finish_load(name, key, load, lambda: c.load(key, fetch))
+        return self._finish_load(name, key, load, fetch)
+
+    def _refresh(self, name, key, refresh_getter):
+        with self._loads_lock:
+            # Someone is already refreshing (or looking up) this key
+            if (name, key) in self._loads:
+                return
+            load = self._loads[(name, key)] = _Load()
+
+        # If the refresh fails, we'll keep using the cached value until it's time to
+        # try again, or the value expires.
+        self._set_refresh_time(name, key)
+        statsd.incr(f"cache.{name}.refreshes")
+
+        def refresh():
+            try:
+                self._finish_load(name, key, load, partial(self._fetch, name, key, refresh_getter))
+            except Exception:
+                log.exception("Failed to refresh %s in the %s cache", key, name)
+
+        self.run_in_background(refresh)
+
+    def run_in_background(self, func):
+        threading.Thread(target=func, daemon=True).start()
+
     def put(self, name, key, value):
         if name not in self.caches:
             return
 
         if self.make_copies:
             value = deepcopy(value)
+        self._set_refresh_time(name, key)
         return self.caches[name].put(key, value)
 
-    def clear(self, name=None):
+    def clear(self, name=None, local_only=False):
+        """Clears one cache, or all of them if no name is given. If local_only is
+        True, the values that TwoLayerCaches share with other processes in Redis
+        are left alone."""
         if name and name not in self.caches:
             return
 
         if not name:
             for c in self.caches.values():
-                c.clear()
+                _clear(c, local_only)
+            for refresh_times, _ in self.refresh_times.values():
+                refresh_times.clear()
         else:
-            self.caches[name].clear()
+            _clear(self.caches[name], local_only)
+            if name in self.refresh_times:
+                self.refresh_times[name][0].clear()
 
-    def invalidate(self, name, key):
+    def invalidate(self, name, key, local_only=False):
+        """Drops a key from a cache. local_only is the same as it is for clear."""
         if name not in self.caches:
             return
 
-        self.caches[name].invalidate(key)
+        if local_only and isinstance(self.caches[name], TwoLayerCache):
+            self.caches[name].invalidate(key, local_only=True)
+        else:
+            self.caches[name].invalidate(key)
+        if name in self.refresh_times:
+            self.refresh_times[name][0].invalidate(key)
+
+
+def _clear(c, local_only):
+    if local_only and isinstance(c, TwoLayerCache):
+        c.clear(local_only=True)
+    else:
+        c.clear()
+
+
+def redis_key(name, key):
+    """Returns the Redis key that a RedisCache called name stores key under."""
+    return f"v2-{name}-{key}"
+
+
+def redis_change_key(name, key=None):
+    """Returns the Redis key that counts the changes that have made key stale in
+    the RedisCache called name, or, if key is None, the ones that have made all
+    of it stale (see ChangePublisher)."""
+    if key is None:
+        return f"v2-changes-{name}"
+    return f"v2-changes-{name}-{key}"
 
 
 class RedisCache:
@@ -131,6 +334,9 @@ class RedisCache:
 
     This cache can be used on its own, but ideally it is only used through a
     TwoLayerCache (see below).
+
+    A value that was looked up because it wasn't cached is only stored if the
+    key hasn't been made stale since it was found missing (see put).
     """
 
     def __init__(self, redis, name, timeout, post_load=None):
@@ -143,16 +349,35 @@ class RedisCache:
         # behaviour is slightly confusing, so we make this small improvement
         # since we're wrapping it anyways.
         self._timeout = timeout - 1
+        # The change counts of the keys that each thread found missing, and is
+        # presumably looking up.
+        self._loading = threading.local()
         self.lookups = 0
         self.hits = 0
         self.misses = 0
 
     def fullkey(self, key):
-        return f"v2-{self._name}-{key}"
+        return redis_key(self._name, key)
+
+    def changekeys(self, key):
+        return [redis_change_key(self._name, key), redis_change_key(self._name)]
+
+    def _pendingLoads(self):
+        pending = getattr(self._loading, "changes", None)
+        if pending is None or len(pending) >= MAX_PENDING_LOADS:
+            pending = self._loading.changes = {}
+        return pending
 
     def get(self, key, default=None):
+        pipeline = self._redis.pipeline(transaction=False)
+        self.queue_get(pipeline, key)
+        value, _, changes = pipeline.execute()
+        return self.parse(key, value, changes, default)
+
+    def parse(self, key, value, changes, default=None):
+        """Returns the value of a key, given what Redis returned for it and its
+        change counts."""
         self.lookups += 1
-        value = self._redis.get(self.fullkey(key))
         if value is not None:
             self.hits += 1
             data = orjson.loads(value)
@@ -161,69 +386,345 @@ class RedisCache:
             return data
 
         self.misses += 1
+        self._pendingLoads()[key] = tuple(changes)
         return default
 
     def put(self, key, value):
-        self._redis.setex(self.fullkey(key), self._timeout, orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS))
+        """Stores value, and returns whether it was stored. If this thread found
+        key missing, it's only stored if nothing has made key stale since then.
+        Otherwise, value may have been looked up before the change that made key
+        stale, and storing it would undo the ChangePublisher's expiry of it."""
+        value = orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        changes = self._pendingLoads().pop(key, None)
+        if changes is None:
+            self._redis.setex(self.fullkey(key), self._timeout, value)
+            return True
+
+        changekeys = self.changekeys(key)
+        with self._redis.pipeline() as pipeline:
+            try:
+                pipeline.watch(*changekeys)
+                if tuple(pipeline.mget(*changekeys)) == changes:
+                    pipeline.multi()
+                    pipeline.setex(self.fullkey(key), self._timeout, value)
+                    pipeline.execute()
+                    return True
+            except WatchError:
+                pass
+
+        statsd.incr(f"cache.{self._name}.stale_not_stored")
+        return False
 
     def clear(self):
-        self._redis.delete(*self._redis.keys(f"v2-{self._name}"))
+        keys = list(self._redis.scan_iter(match=redis_key(self._name, "*")))
+        if keys:
+            self._redis.delete(*keys)
 
     def invalidate(self, key):
         self._redis.delete(self.fullkey(key))
 
     def remaining_timeout(self, key):
-        absolute_timeout = self._redis.expiretime(self.fullkey(key))
+        return self.remaining_timeout_from(self._redis.expiretime(self.fullkey(key)))
+
+    def queue_get(self, pipeline, key):
+        """Adds the commands needed to get a key, its remaining timeout and its
+        change counts to a pipeline. Their results should be passed to parse and
+        remaining_timeout_from."""
+        pipeline.get(self.fullkey(key))
+        pipeline.expiretime(self.fullkey(key))
+        pipeline.mget(*self.changekeys(key))
+
+    def remaining_timeout_from(self, absolute_timeout):
         return absolute_timeout - time.time()
 
+    def leasekey(self, key):
+        return f"{self.fullkey(key)}-lease"
+
+    def acquire_lease(self, key, timeout):
+        """Tries to take the lease on looking up a key, which expires after
+        timeout seconds. Returns a token to release it with if it was taken,
+        or None if someone else holds it."""
+        token = uuid4().hex
+        if self._redis.set(self.leasekey(key), token, nx=True, px=int(timeout * 1000)):
+            return token
+        return None
+
+    def release_lease(self, key, token):
+        # This isn't atomic, but the worst that can happen is that we release
+        # a lease that someone else took after ours expired, which lets one
+        # more process look up the key.
+        if self._redis.get(self.leasekey(key)) == token.encode():
+            self._redis.delete(self.leasekey(key))
+
+    def has_lease(self, key):
+        return bool(self._redis.exists(self.leasekey(key)))
+
+
+class UwsgiCache:
+    """A cache that lives in one of uwsgi's caches (see its cache2 option), which
+    is shared memory that every worker process of the app can read from and write
+    to. With one of these instead of an ExpiringLRUCache, each value is only looked
+    up by the first worker that needs it. Like RedisCache, values are stored as
+    JSON.
+
+    Each worker still keeps its own parsed copy (ie: after post_load) of up to
+    maxsize of the values that it has used, like a TwoLayerCache does, so a pod's
+    memory still grows with its number of workers. Every value is stored with a
+    random stamp, which is also stored by itself, under a key of its own. A
+    parsed copy is only used while the stamp in the uwsgi cache still matches the
+    one it was parsed with, which is much cheaper than retrieving and parsing the
+    value again.
+
+    Every cache that a MaybeCacher makes can share a single uwsgi cache; their
+    keys are prefixed with their names. The uwsgi cache's size and item size
+    (ie: blocksize, or blocks, with bitmap mode) bound what can be stored, rather
+    than maxsize. Values that don't fit simply aren't cached.
+
+    uwsgi is the uwsgi module, which can only be imported by code that uwsgi runs.
+
+    If lease_timeout is given, only one worker at a time looks up a key that
+    isn't cached (see load)."""
+
+    def __init__(self, uwsgi, cache_name, name, timeout, post_load=None, lease_timeout=None, maxsize=500):
+        self._uwsgi = uwsgi
+        self._cache_name = cache_name
+        self._name = name
+        self._timeout = int(timeout)
+        self._post_load = post_load
+        self._lease_timeout = lease_timeout
+        self._lru_cache = ExpiringLRUCache(maxsize, timeout)
+        self.lookups = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _generation(self):
+        # uwsgi can't clear the keys that belong to just one of the caches that
+        # share it, so instead, each key includes a random generation, which
+        # clear replaces. Anything from an older generation is never looked up
+        # again, and is dropped once it expires (or uwsgi needs the space).
+        # A request only looks up the generation once, so a clear takes effect
+        # from the next request on.
+        return memoize("cache_generation", self._name, self._currentGeneration)
+
+    def _currentGeneration(self):
+        key = f"{self._name}-generation"
+        generation = self._uwsgi.cache_get(key, self._cache_name)
+        if generation is None:
+            # If another worker starts a generation at the same time, the
+            # first one wins.
+            self._uwsgi.cache_set(key, uuid4().hex.encode(), 0, self._cache_name)
+            generation = self._uwsgi.cache_get(key, self._cache_name) or b""
+        return generation.decode()
+
+    def fullkey(self, key):
+        return f"{self._name}-{self._generation()}-{key}"
+
+    def get(self, key, default=None):
+        self.lookups += 1
+        fullkey = self.fullkey(key)
+        parsed = self._lru_cache.get(key)
+        if parsed and parsed[0] == self._uwsgi.cache_get(f"{fullkey}-stamp", self._cache_name):
+            self.hits += 1
+            return parsed[1]
+
+        value = self._uwsgi.cache_get(fullkey, self._cache_name)
+        if value is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        stamp = value[:STAMP_LENGTH]
+        if parsed and parsed[0] == stamp:
+            return parsed[1]
+        data = orjson.loads(memoryview(value)[STAMP_LENGTH:])
+        if self._post_load:
+            data = self._post_load(data)
+        self._lru_cache.put(key, (stamp, data))
+        return data
+
+    def put(self, key, value):
+        fullkey = self.fullkey(key)
+        stamp = uuid4().hex.encode()
+        value = stamp + orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        # Drop the old stamp first, so that nothing trusts the old value if the
+        # new one is stored but its stamp isn't.
+        self._uwsgi.cache_del(f"{fullkey}-stamp", self._cache_name)
+        if self._uwsgi.cache_update(fullkey, value, self._timeout, self._cache_name):
+            self._uwsgi.cache_update(f"{fullkey}-stamp", stamp, self._timeout, self._cache_name)
+        else:
+            log.debug("Couldn't store %s (%d bytes) in the %s cache", key, len(value), self._name)
+            statsd.incr(f"cache.{self._name}.not_stored")
+
+    def clear(self):
+        self._uwsgi.cache_del(f"{self._name}-generation", self._cache_name)
+        self._lru_cache.clear()
+
+    def invalidate(self, key):
+        fullkey = self.fullkey(key)
+        self._uwsgi.cache_del(fullkey, self._cache_name)
+        self._uwsgi.cache_del(f"{fullkey}-stamp", self._cache_name)
+        self._lru_cache.invalidate(key)
+
+    def leasekey(self, key):
+        return f"{self.fullkey(key)}-lease"
+
+    def load(self, key, value_getter):
+        """Returns the result of value_getter, which is expected to look up the
+        value of key and put it in this cache. If this cache has a lease_timeout,
+        workers that don't get the lease on this key wait for the one that does
+        to put the new value in the cache, and return that instead. If it doesn't
+        show up before the lease is released or expires, they call value_getter
+        themselves."""
+        if not self._lease_timeout:
+            return value_getter()
+
+        token = uuid4().hex.encode()
+        if self._uwsgi.cache_set(self.leasekey(key), token, math.ceil(self._lease_timeout), self._cache_name):
+            try:
+                return value_getter()
+            finally:
+                # This isn't atomic, but the worst that can happen is that we
+                # release a lease that someone else took after ours expired.
+                if self._uwsgi.cache_get(self.leasekey(key), self._cache_name) == token:
+                    self._uwsgi.cache_del(self.leasekey(key), self._cache_name)
+
+        deadline = time.monotonic() + self._lease_timeout
+        while time.monotonic() < deadline:
+            time.sleep(LEASE_POLL_INTERVAL)
+            value = self.get(key, uncached_sentinel)
+            if value is not uncached_sentinel:
+                return value
+            if not self._uwsgi.cache_exists(self.leasekey(key), self._cache_name):
+                break
+
+        return value_getter()
+
 
 class TwoLayerCache:
     """A cache that wraps both a RedisCache and ExpiringLRUCache. The
     former is treated as authoritative, while the latter is used to minimize
     unnecessary fetches from Redis. This design allows caches to be shared
     across many pods while minimizing the perf impact of having an off-machine
-    cache."""
+    cache.
 
-    def __init__(self, redis, name, maxsize, timeout, post_load=None):
+    If lease_timeout is given, only one process at a time looks up a key that
+    isn't in either cache (see load)."""
+
+    def __init__(self, redis, name, maxsize, timeout, post_load=None, lease_timeout=None):
         self._redis_cache = RedisCache(redis, name, timeout, post_load)
         self._lru_cache = ExpiringLRUCache(maxsize, timeout)
+        self._lease_timeout = lease_timeout
         self.lookups = 0
         self.hits = 0
         self.misses = 0
 
     def get(self, key, default=None):
+        return self.get_many([key], default)[0]
+
+    def get_many(self, keys, default=None):
+        """Returns the values of many keys, fetching all of the ones that aren't
+        in memory from Redis at once."""
+        return multi_get([(self, key) for key in keys], default)
+
+    def _get_from_memory(self, key, default):
+        """Returns the in-memory value of key, or default if it has to be fetched
+        from Redis, in which case the commands to do that should be queued with
+        self._redis_cache.queue_get, and their results passed to _got_from_redis."""
         self.lookups += 1
         value = self._lru_cache.get(key, default)
+        if value != default:
+            self.hits += 1
+        return value
+
+    def _got_from_redis(self, key, default, value, absolute_timeout, changes):
+        value = self._redis_cache.parse(key, value, changes, default)
+        # ensure the LRU cache timeout matches the one in redis
+        # this is important to ensure that when new pods spin up that
+        # they will not cache keys for longer than redis
+        # this ensures that we don't have to wait for multiple caches
+        # to expire to refresh data.
+        # in practice there will be a very small difference between the
+        # timeouts, because the value we pass to put here is a relative
+        # timeout in seconds, which the lru cache recalculates against
+        # `time.time()`. this small (probably 1s in most cases) difference
+        # is unlikely to be problematic in practice.
+        self._lru_cache.put(key, value, self._redis_cache.remaining_timeout_from(absolute_timeout))
         if value == default:
-            value = self._redis_cache.get(key, default)
-            # ensure the LRU cache timeout matches the one in redis
-            # this is important to ensure that when new pods spin up that
-            # they will not cache keys for longer than redis
-            # this ensures that we don't have to wait for multiple caches
-            # to expire to refresh data.
-            # in practice there will be a very small difference between the
-            # timeouts, because the value we pass to put here is a relative
-            # timeout in seconds, which the lru cache recalculates against
-            # `time.time()`. this small (probably 1s in most cases) difference
-            # is unlikely to be problematic in practice.
-            self._lru_cache.put(key, value, self._redis_cache.remaining_timeout(key))
-            if value == default:
-                self.misses += 1
-            else:
-                self.hits += 1
+            self.misses += 1
         else:
             self.hits += 1
-
         return value
 
-    def put(self, key, value):
-        self._redis_cache.put(key, value)
-        self._lru_cache.put(key, value)
+    def load(self, key, value_getter):
+        """Returns the result of value_getter, which is expected to look up the
+        value of key and put it in this cache. If this cache has a lease_timeout,
+        processes that don't get the lease on this key wait for the one that does
+        to put the new value in Redis, and return that instead. If it doesn't show
+        up before the lease is released or expires, they call value_getter
+        themselves."""
+        if not self._lease_timeout:
+            return value_getter()
+
+        token = self._redis_cache.acquire_lease(key, self._lease_timeout)
+        if token:
+            try:
+                return value_getter()
+            finally:
+                self._redis_cache.release_lease(key, token)
 
-    def clear(self):
-        self._redis_cache.clear()
+        deadline = time.monotonic() + self._lease_timeout
+        while time.monotonic() < deadline:
+            time.sleep(LEASE_POLL_INTERVAL)
+            value = self._redis_cache.get(key, uncached_sentinel)
+            if value is not uncached_sentinel:
+                self._lru_cache.put(key, value, self._redis_cache.remaining_timeout(key))
+                return value
+            if not self._redis_cache.has_lease(key):
+                break
+
+        return value_getter()
+
+    def put(self, key, value):
+        if self._redis_cache.put(key, value):
+            self._lru_cache.put(key, value)
+
+    def clear(self, local_only=False):
+        """Clears this cache. If local_only is True, only this process's copies of
+        its values are dropped, and they're looked up in Redis again."""
+        if not local_only:
+            self._redis_cache.clear()
         self._lru_cache.clear()
 
-    def invalidate(self, key):
-        self._redis_cache.invalidate(key)
+    def invalidate(self, key, local_only=False):
+        if not local_only:
+            self._redis_cache.invalidate(key)
         self._lru_cache.invalidate(key)
+
+
+def multi_get(lookups, default=None):
+    """Returns the value of each of the (cache, key) pairs in lookups, or default
+    if the key isn't in that cache. Any keys that TwoLayerCaches need to fetch
+    from Redis are fetched with one pipeline per Redis client, no matter how many
+    caches or keys there are."""
+    values = [default] * len(lookups)
+    pipelines = {}
+    for i, (c, key) in enumerate(lookups):
+        if not isinstance(c, TwoLayerCache):
+            values[i] = c.get(key, default)
+            continue
+
+        values[i] = c._get_from_memory(key, default)
+        if values[i] == default:
+            redis = c._redis_cache._redis
+            if id(redis) not in pipelines:
+                pipelines[id(redis)] = (redis.pipeline(transaction=False), [])
+            pipeline, pending = pipelines[id(redis)]
+            c._redis_cache.queue_get(pipeline, key)
+            pending.append((i, c, key))
+
+    for pipeline, pending in pipelines.values():
+        results = pipeline.execute()
+        for n, (i, c, key) in enumerate(pending):
+            values[i] = c._got_from_redis(key, default, *results[n * 3 : n * 3 + 3])
+
+    return values
@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from auslib.util.cache import redis_change_key, redis_key
+from auslib.util.statsd import statsd
+
+log = logging.getLogger(__name__)
+
+CHANNEL = "balrog-changes"
+
+# How long (in seconds) the counts of changes to cached keys are kept. Lookups
+# that take longer than this could store a stale value.
+CHANGE_COUNT_TIMEOUT = 24 * 60 * 60
+
+
+def stale_entries(table, primary_key):
+    """Returns the (cache name, key) of each cache entry that a change to a row of
+    table makes stale, and the names of the caches that it makes entirely stale."""
+    if table == "releases":
+        return [("blob", primary_key["name"]), ("blob_version", primary_key["name"])], []
+    if table == "releases_json":
+        return [("releases", primary_key["name"]), ("releases_data_version", primary_key["name"])], []
+    if table == "release_assets":
+        name = primary_key["name"]
+        entries = [(cache_name, name) for cache_name in ("release_assets", "release_assets_data_versions", "release_assets_index")]
+        return entries + [("release_assets_by_path", f"{name}:{primary_key['path']}")], []
+    if table == "rules":
+        # Rules are cached by the parts of update queries that they could match,
+        # which can't be worked out from a single Rule, so all of them go.
+        return [], ["rules"]
+    if table == "emergency_shutoffs":
+        return [("updates_disabled", (primary_key["product"], primary_key["channel"]))], []
+    return [], []
+
+
+class ChangePublisher(object):
+    """Publishes the primary key and new data_version (None for deletions) of
+    changed rows to a Redis channel, for ChangeSubscribers to pick up. This is
+    meant to be given to AUSDatabase.setChangePublisher in the admin app.
+
+    Before each change is published, anything that it makes stale is deleted
+    from the caches that the public app shares in Redis (see TwoLayerCache), so
+    redis must be the one that the public app caches in. That way, it's done
+    once, instead of by every public process that gets the change. Each of them
+    also has its change count bumped, so that a public process which was looking
+    it up before the change doesn't store what it found (see RedisCache.put)."""
+
+    def __init__(self, redis, channel=CHANNEL):
+        self.redis = redis
+        self.channel = channel
+
+    def expireSharedEntries(self, table, primary_key):
+        keys, names = stale_entries(table, primary_key)
+        pipeline = self.redis.pipeline()
+        for change_key in [redis_change_key(name, key) for name, key in keys] + [redis_change_key(name) for name in names]:
+            pipeline.incr(change_key)
+            pipeline.expire(change_key, CHANGE_COUNT_TIMEOUT)
+        if keys:
+            pipeline.delete(*[redis_key(name, key) for name, key in keys])
+        pipeline.execute()
+        for name in names:
+            shared_keys = list(self.redis.scan_iter(match=redis_key(name, "*")))
+            if shared_keys:
+                self.redis.delete(*shared_keys)
+
+    def publish(self, table, primary_key, data_version):
+        # This happens after the change has been committed, so there's nothing to
+        # be done about a failure except to make some noise. The public app will
+        # still notice the change once the data_versions that it cached expire.
+        try:
+            self.expireSharedEntries(table, primary_key)
+            self.redis.publish(self.channel, json.dumps({"table": table, "primary_key": primary_key, "data_version": data_version}))
+        except Exception:
+            log.exception("Failed to publish change to %s: %s", table, primary_key)
+            statsd.incr("invalidation.publish_failed")
+
+
+class ChangeSubscriber(threading.Thread):
+    """Listens for changes published by a ChangePublisher, and drops anything
+    that they make stale from this process's caches (and the rule index and the
+    emergency shutoff and pin snapshots, if they're enabled). The publisher has
+    already dropped it from the caches that are shared in Redis, so every process
+    doesn't have to.
+    This lets the public app cache data_versions and rules for longer than it
+    could if it had to poll the database to find out about changes.
+
+    Changes that are published while the subscriber isn't connected to Redis
+    are missed, so everything that this process has cached is cleared whenever
+    it reconnects."""
+
+    def __init__(self, redis, cache, dbo, channel=CHANNEL, retry_interval=5):
+        super(ChangeSubscriber, self).__init__(name="ChangeSubscriber", daemon=True)
+        self.redis = redis
+        self.cache = cache
+        self.dbo = dbo
+        self.channel = channel
+        self.retry_interval = retry_interval
+        self.invalidators = {
+            "releases": self.invalidateCaches,
+            "releases_json": self.invalidateCaches,
+            "release_assets": self.invalidateCaches,
+            "rules": self.invalidateRules,
+            "emergency_shutoffs": self.invalidateEmergencyShutoff,
+            "pinnable_releases": self.invalidatePins,
+        }
+
+    def invalidateCaches(self, table, primary_key):
+        keys, names = stale_entries(table, primary_key)
+        for name, key in keys:
+            self.cache.invalidate(name, key, local_only=True)
+        for name in names:
+            self.cache.clear(name, local_only=True)
+
+    def invalidateRules(self, table, primary_key):
+        self.invalidateCaches(table, primary_key)
+        if self.dbo.rules.index:
+            self.dbo.rules.index.invalidate()
+
+    def invalidateEmergencyShutoff(self, table, primary_key):
+        self.invalidateCaches(table, primary_key)
+        if self.dbo.emergencyShutoffs.snapshot:
+            self.dbo.emergencyShutoffs.snapshot.invalidate()
+
+    def invalidatePins(self, table, primary_key):
+        if self.dbo.pinnable_releases.snapshot:
+            self.dbo.pinnable_releases.snapshot.invalidate()
+
+    def invalidateEverything(self):
+        self.cache.clear(local_only=True)
+        if self.dbo.rules.index:
+            self.dbo.rules.index.invalidate()
+        if self.dbo.emergencyShutoffs.snapshot:
+            self.dbo.emergencyShutoffs.snapshot.invalidate()
+        if self.dbo.pinnable_releases.snapshot:
+            self.dbo.pinnable_releases.snapshot.invalidate()
+
+    def handle(self, message):
+        try:
+            change = json.loads(message["data"])
+            table, primary_key = change["table"], change["primary_key"]
+        except (ValueError, KeyError, TypeError):
+            log.warning("Ignoring malformed change: %r", message)
+            return
+
+        if table in self.invalidators:
+            log.debug("Invalidating caches for change to %s: %s", table, primary_key)
+            self.invalidators[table](table, primary_key)
+            statsd.incr(f"invalidation.{table}")
+
+    def listen(self, reconnected=False):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(self.channel)
+            # Anything could have changed while we weren't subscribed.
+            if reconnected:
+                self.invalidateEverything()
+            for message in pubsub.listen():
+                self.handle(message)
+        finally:
+            pubsub.close()
+
+    def run(self):
+        reconnected = False
+        while True:
+            try:
+                self.listen(reconnected)
+            except Exception:
+                log.exception("Lost connection to the change channel, reconnecting in %s seconds", self.retry_interval)
+                time.sleep(self.retry_interval)
+            reconnected = True
+
+
+def subscribe_in_each_process(app, redis, cache, dbo):
+    """Makes sure that a ChangeSubscriber is running in whichever process handles
+    each of app's requests. uwsgi loads the app before it forks its workers, and
+    threads don't survive a fork, so one that was started when the app was loaded
+    would only ever run in the master process, which doesn't serve anything."""
+    subscribed = {"pid": None}
+    lock = threading.Lock()
+
+    @app.before_request
+    def subscribe():
+        pid = os.getpid()
+        if subscribed["pid"] == pid:
+            return
+        with lock:
+            if subscribed["pid"] != pid:
+                ChangeSubscriber(redis, cache, dbo).start()
+                subscribed["pid"] = pid
@@ -0,0 +1,46 @@
+from flask import g, has_app_context
+
+from auslib.util.statsd import statsd
+
+
+def enable_request_memo():
+    """Starts a fresh memo for the current request. Only apps that don't
+    modify anything that they look up (ie: the public app) should do this,
+    because nothing that's memoized is ever invalidated."""
+    g.memo = {}
+
+
+def memoize(kind, key, getter):
+    """Returns the result of getter(), which is only called the first time that
+    kind and key are looked up within the current request. A single update
+    request can otherwise end up looking up the same Release, Rule, pin or
+    emergency shutoff several times. Outside of a request that has a memo
+    (see enable_request_memo), getter() is always called."""
+    memo = g.get("memo") if has_app_context() else None
+    if memo is None:
+        return getter()
+
+    memo_key = (kind, key)
+    if memo_key in memo:
+        statsd.incr(f"memo.{kind}.saved")
+        return memo[memo_key]
+
+    value = memo[memo_key] = getter()
+    return value
+
+
+def memoize_many(kind, keys, getter):
+    """Does the same thing as calling memoize for each of keys, except that
+    getter is called just once, with a list of the keys that aren't memoized
+    yet (which may be empty), and must return their values in the same order.
+    The values are returned in the same order as keys."""
+    memo = g.get("memo") if has_app_context() else None
+    if memo is None:
+        return getter(keys)
+
+    missing = [key for key in dict.fromkeys(keys) if (kind, key) not in memo]
+    if len(keys) > len(missing):
+        statsd.incr(f"memo.{kind}.saved", len(keys) - len(missing))
+    for key, value in zip(missing, getter(missing)):
+        memo[(kind, key)] = value
+    return [memo[(kind, key)] for key in keys]
@@ -0,0 +1,89 @@
+import heapq
+import itertools
+from collections import defaultdict
+
+from auslib.util.rulematching import CompiledRule
+from auslib.util.snapshot import TableSnapshot
+
+
+def priorityOrder(rule):
+    """Sort key that puts Rules in the order they should be evaluated in:
+    highest priority first, with ties broken by rule_id."""
+    return (-rule["priority"], rule["rule_id"])
+
+
+class RuleBucket(object):
+    """The Rules for one (product, buildTarget) pair. Rules with a concrete
+    channel are grouped by that channel; Rules with no channel or a globbed
+    one must be considered for every channel. Every list is kept in
+    priorityOrder."""
+
+    __slots__ = ("channels", "wildcards")
+
+    def __init__(self):
+        self.channels = defaultdict(list)
+        self.wildcards = []
+
+    def add(self, rule):
+        channel = rule["channel"]
+        if channel is None or channel.endswith("*"):
+            self.wildcards.append(rule)
+        else:
+            self.channels[channel].append(rule)
+
+    def candidateLists(self, channels):
+        for channel in channels:
+            if channel in self.channels:
+                yield self.channels[channel]
+        yield self.wildcards
+
+
+class RuleIndex(TableSnapshot):
+    """An in-memory copy of the rules table, bucketed by product, buildTarget
+    and channel. It returns the same candidates that Rules.getRulesMatchingQuery
+    would otherwise select from the database, without a round trip and
+    without looking at Rules for other products, buildTargets or channels."""
+
+    def build(self, rows):
+        buckets = defaultdict(RuleBucket)
+        for rule in sorted(rows, key=priorityOrder):
+            buckets[(rule["product"], rule["buildTarget"])].add(CompiledRule(rule))
+        return dict(buckets)
+
+    def _candidates(self, rules, updateQuery):
+        headerArchitecture = updateQuery.get("headerArchitecture")
+        distVersion = updateQuery.get("distVersion")
+        for rule in rules:
+            if rule["headerArchitecture"] not in (None, headerArchitecture):
+                continue
+            if rule["distVersion"] not in (None, distVersion):
+                continue
+            yield rule
+
+    def _candidateLists(self, updateQuery, fallbackChannel, transaction):
+        buckets = self.get(transaction)
+        product = updateQuery["product"]
+        buildTarget = updateQuery["buildTarget"]
+        channels = {updateQuery["channel"], fallbackChannel}
+        lists = []
+        for key in ((product, buildTarget), (product, None), (None, buildTarget), (None, None)):
+            bucket = buckets.get(key)
+            if bucket is not None:
+                lists.extend(bucket.candidateLists(channels))
+        return lists
+
+    def getCandidates(self, updateQuery, fallbackChannel, transaction=None):
+        """Returns the Rules whose product, buildTarget, headerArchitecture,
+        and distVersion are compatible with the query, and whose channel could
+        match the query's channel or fallbackChannel. The remaining columns
+        are left for the caller to check. Rules are returned in rule_id order."""
+        lists = self._candidateLists(updateQuery, fallbackChannel, transaction)
+        candidates = list(self._candidates(itertools.chain.from_iterable(lists), updateQuery))
+        candidates.sort(key=lambda r: r["rule_id"])
+        return candidates
+
+    def iterCandidatesByPriority(self, updateQuery, fallbackChannel, transaction=None):
+        """Like getCandidates, but lazily yields the Rules in priorityOrder, so
+        that callers that only want the best match can stop early."""
+        lists = self._candidateLists(updateQuery, fallbackChannel, transaction)
+        return self._candidates(heapq.merge(*lists, key=priorityOrder), updateQuery)
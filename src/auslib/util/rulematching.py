@@ -1,7 +1,8 @@
+import functools
 import logging
 import re
 
-from auslib.util.comparison import int_compare, string_compare, version_compare
+from auslib.util.comparison import get_op, int_compare, string_compare, version_compare
 from auslib.util.versions import MozillaVersion
 
 log = logging.getLogger(__name__)
@@ -169,3 +170,145 @@ def matchBoolean(ruleValue, queryValue):
         if queryValue is None or ruleValue != queryValue:
             return False
     return True
+
+
+# Everything below is a compiled equivalent of the functions above. Rule columns
+# only change when a Rule does, so rather than re-parsing them for every update
+# request, each column value is turned into a predicate once (and shared by all
+# Rules with the same value). The predicates must always give the same answer as
+# the match* functions; if a column can't be compiled, its predicate falls back to
+# calling the match* function, so that any error is raised at the same point, too.
+
+
+@functools.lru_cache(maxsize=1024)
+def compileGlob(pattern):
+    """Returns a callable that decides whether a string matches the pattern,
+    with the same semantics as matchRegex."""
+    if pattern.endswith("*"):
+        if len(pattern) >= 3:
+            test = pattern.replace(".", r"\.").replace("*", r"\*", pattern.count("*") - 1)
+            regex = re.compile("^{}.*$".format(test[:-1]))
+            return lambda value: regex.match(value) is not None
+        return lambda value: False
+    return lambda value: value == pattern
+
+
+@functools.lru_cache(maxsize=1024)
+def compileChannel(ruleChannel):
+    match = compileGlob(ruleChannel)
+    return lambda queryChannel, fallbackChannel: match(queryChannel) or match(fallbackChannel)
+
+
+@functools.lru_cache(maxsize=1024)
+def compileVersion(ruleVersion):
+    ops = tuple(get_op(rule) for rule in ruleVersion.split(","))
+    if None in ops:
+        return lambda queryVersion, versionClass: matchVersion(ruleVersion, queryVersion, versionClass)
+
+    def match(queryVersion, versionClass):
+        for opfunc, operand in ops:
+            if opfunc(versionClass(queryVersion), versionClass(operand)):
+                return True
+        return False
+
+    return match
+
+
+@functools.lru_cache(maxsize=1024)
+def compileBuildID(ruleBuildID):
+    op = get_op(ruleBuildID)
+    if op is None:
+        return lambda queryBuildID: matchBuildID(ruleBuildID, queryBuildID)
+    opfunc, operand = op
+    return lambda queryBuildID: opfunc(queryBuildID, operand)
+
+
+@functools.lru_cache(maxsize=1024)
+def compileMemory(ruleMemory):
+    op = get_op(ruleMemory)
+    try:
+        opfunc, operand = op[0], int(op[1])
+    except (TypeError, ValueError):
+        return lambda queryMemory: matchMemory(ruleMemory, queryMemory)
+
+    def match(queryMemory):
+        if queryMemory is None:
+            return True
+        try:
+            queryMemory = int(queryMemory)
+        except (TypeError, ValueError):
+            return True
+        return opfunc(queryMemory, operand)
+
+    return match
+
+
+@functools.lru_cache(maxsize=1024)
+def compileSimpleExpression(ruleString):
+    decomposedRules = tuple(tuple(rule.strip() for rule in subRule.split("&&")) for subRule in ruleString.split(","))
+    return lambda queryString: any(all(rule in queryString for rule in subRule) for subRule in decomposedRules)
+
+
+@functools.lru_cache(maxsize=1024)
+def compileCsv(csvString):
+    parts = frozenset(csvString.split(","))
+    return lambda queryString: queryString in parts
+
+
+class CompiledRule(dict):
+    """A Rule, as returned by Rules.select, along with predicates for each of
+    its columns that update queries are matched against. Each predicate is None
+    if its column is, which means the column matches everything.
+
+    CompiledRules must not be modified after they are created; changing a column
+    does not recompile its predicate."""
+
+    def __init__(self, *args, **kwargs):
+        super(CompiledRule, self).__init__(*args, **kwargs)
+        self.channelMatches = self._compile(compileChannel, "channel")
+        self.versionMatches = self._compile(compileVersion, "version")
+        self.buildIDMatches = self._compile(compileBuildID, "buildID")
+        self.memoryMatches = self._compile(compileMemory, "memory")
+        self.osVersionMatches = self._compile(compileSimpleExpression, "osVersion")
+        self.instructionSetMatches = self._compile(compileCsv, "instructionSet")
+        self.distributionMatches = self._compile(compileCsv, "distribution")
+        self.localeMatches = self._compile(compileCsv, "locale")
+
+    def _compile(self, compiler, column):
+        value = self.get(column)
+        if value is None:
+            return None
+        return compiler(value)
+
+    def findMismatch(self, updateQuery, fallbackChannel, versionClass=MozillaVersion):
+        """Returns the name of the first column of this Rule that does not
+        match the update query, or None if the whole Rule matches it. Columns
+        are matched with the same semantics as the match* functions in this
+        module. Channel and version are checked first, as getRulesMatchingQuery
+        always has, so an invalid version raises a BadDataError for any Rule with
+        a version whose channel matches. The other columns are checked cheapest
+        first."""
+        if self.channelMatches and not self.channelMatches(updateQuery["channel"], fallbackChannel):
+            return "channel"
+        if self.versionMatches and not self.versionMatches(updateQuery["version"], versionClass):
+            return "version"
+        if not matchBoolean(self.get("mig64"), updateQuery.get("mig64")):
+            return "mig64"
+        if not matchBoolean(self.get("jaws"), updateQuery.get("jaws")):
+            return "jaws"
+        if self.localeMatches and not self.localeMatches(updateQuery.get("locale", "")):
+            return "locale"
+        if self.instructionSetMatches and not self.instructionSetMatches(updateQuery.get("instructionSet", "")):
+            return "instructionSet"
+        if self.distributionMatches and not self.distributionMatches(updateQuery.get("distribution", "")):
+            return "distribution"
+        if self.buildIDMatches and not self.buildIDMatches(updateQuery.get("buildID", "")):
+            return "buildID"
+        if self.memoryMatches and not self.memoryMatches(updateQuery.get("memory")):
+            return "memory"
+        if self.osVersionMatches and not self.osVersionMatches(updateQuery.get("osVersion", "")):
+            return "osVersion"
+        return None
+
+    def matchesQuery(self, updateQuery, fallbackChannel, versionClass=MozillaVersion):
+        return self.findMismatch(updateQuery, fallbackChannel, versionClass) is None
@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+
+
+class TableSnapshot(object):
+    """An in-process copy of a whole table, for small tables that are read on
+    (almost) every request. Subclasses implement `build`, which turns the rows
+    of the table into whatever structure lookups should be served from.
+
+    The table is only reread when its version stamp (see
+    AUSTable.getVersionStamp) has moved, and the stamp itself is checked at
+    most once every `refresh_interval` seconds. New snapshots are built off
+    to the side and swapped in with a single assignment, so readers always see
+    a complete and consistent copy of the table. While one thread is checking
+    for or loading a new snapshot, other threads keep serving the old one."""
+
+    def __init__(self, table, refresh_interval):
+        self.table = table
+        self.refresh_interval = refresh_interval
+        self._data = None
+        self._stamp = None
+        self._next_check = 0
+        self._lock = threading.Lock()
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def build(self, rows):
+        raise NotImplementedError()
+
+    def load(self, transaction=None):
+        return self.table.select(transaction=transaction)
+
+    def invalidate(self):
+        """Makes the next lookup check the version stamp, regardless of when
+        it was last checked."""
+        self._next_check = 0
+
+    def get(self, transaction=None):
+        if time.time() >= self._next_check:
+            self.refresh(transaction)
+        return self._data
+
+    def refresh(self, transaction=None):
+        # There's nothing to serve until the first load has finished, so
+        # everybody has to wait for that one. After that, only one thread needs
+        # to look for changes.
+        if not self._lock.acquire(blocking=self._data is None):
+            return
+        try:
+            # Another thread may have refreshed while we were waiting for the lock.
+            if self._data is not None and time.time() < self._next_check:
+                return
+            stamp = self.table.getVersionStamp(transaction=transaction)
+            if self._data is None or stamp != self._stamp:
+                self.log.debug("Loading new snapshot of %s (version stamp: %s)", self.table.t.name, stamp)
+                self._data = self.build(self.load(transaction=transaction))
+                self._stamp = stamp
+            self._next_check = time.time() + self.refresh_interval
+        finally:
+            self._lock.release()
+
+
+class EmergencyShutoffSnapshot(TableSnapshot):
+    """The (product, channel) of every emergency shutoff, so that checking
+    whether updates are disabled is a single set lookup."""
+
+    def load(self, transaction=None):
+        return self.table.select(columns=[self.table.product, self.table.channel], transaction=transaction)
+
+    def build(self, rows):
+        return frozenset((row["product"], row["channel"]) for row in rows)
+
+
+class PinMap(object):
+    """The mapping and data_version of every pin, keyed by (product, channel,
+    version), and the set of Releases that are pinned to."""
+
+    __slots__ = ("pins", "mappings")
+
+    def __init__(self, pins):
+        self.pins = pins
+        self.mappings = frozenset(pin["mapping"] for pin in pins.values())
+
+
+class PinSnapshot(TableSnapshot):
+    """An in-memory copy of the pinnable_releases table."""
+
+    def build(self, rows):
+        return PinMap({(row["product"], row["channel"], row["version"]): {"mapping": row["mapping"], "data_version": row["data_version"]} for row in rows})
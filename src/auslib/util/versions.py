@@ -1,3 +1,4 @@
+import functools
 import re
 
 from auslib.errors import BadDataError
@@ -5,43 +6,99 @@ from auslib.errors import BadDataError
 # Version/StrictVersion/LooseVersion classes are lifted from distutils which
 # deprecated them
 
+# The number of version objects that each class keeps around for reuse.
+INTERNED_VERSIONS = 4096
+
+
+class InternedVersion(type):
+    """Makes calling a Version class return the same instance each time that
+    it's given the same version string (for as long as that string is among the
+    class' INTERNED_VERSIONS most recently used ones). Update requests compare
+    the same handful of versions over and over again, so this saves parsing
+    them each time. Because instances are shared, they can't be modified once
+    they've been parsed."""
+
+    def __init__(cls, name, bases, namespace):
+        super().__init__(name, bases, namespace)
+        cls._interned = functools.lru_cache(maxsize=INTERNED_VERSIONS)(super().__call__)
+
+    def __call__(cls, vstring=None):
+        # Versions made without a string are parsed later, so each needs to be
+        # its own object.
+        if not vstring:
+            return super().__call__(vstring)
+        return cls._interned(vstring)
+
+
+class Version(metaclass=InternedVersion):
+    # Subclasses whose instances can be ordered by a single tuple set sort_key
+    # to it when they're parsed, and set _family to the class whose instances
+    # they can be compared with that way.
+    __slots__ = ()
+    sort_key = None
+    _family = None
 
-class Version:
     def __init__(self, vstring=None):
         if vstring:
             self.parse(vstring)
 
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            raise AttributeError(f"{self.__class__.__name__} objects are immutable")
+        super().__setattr__(name, value)
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{self.__class__.__name__} objects are immutable")
+
     def parse(self, vstring):
         return NotImplemented
 
     def __repr__(self):
         return "{} ('{}')".format(self.__class__.__name__, str(self))
 
+    def _keyed(self, other):
+        try:
+            return self.sort_key is not None and isinstance(other, self._family) and other.sort_key is not None
+        except AttributeError:
+            # sort_key is a slot in the classes that use it, which is only set
+            # once a version string has been parsed.
+            raise ValueError(f"{self.__class__.__name__} objects can't be compared before a version has been parsed") from None
+
     def __eq__(self, other):
+        if self._keyed(other):
+            return self.sort_key == other.sort_key
         c = self._cmp(other)
         if c is NotImplemented:
             return c
         return c == 0
 
     def __lt__(self, other):
+        if self._keyed(other):
+            return self.sort_key < other.sort_key
         c = self._cmp(other)
         if c is NotImplemented:
             return c
         return c < 0
 
     def __le__(self, other):
+        if self._keyed(other):
+            return self.sort_key <= other.sort_key
         c = self._cmp(other)
         if c is NotImplemented:
             return c
         return c <= 0
 
     def __gt__(self, other):
+        if self._keyed(other):
+            return self.sort_key > other.sort_key
         c = self._cmp(other)
         if c is NotImplemented:
             return c
         return c > 0
 
     def __ge__(self, other):
+        if self._keyed(other):
+            return self.sort_key >= other.sort_key
         c = self._cmp(other)
         if c is NotImplemented:
             return c
@@ -49,6 +106,7 @@ class Version:
 
 
 class StrictVersion(Version):
+    __slots__ = ("version", "prerelease", "sort_key")
     version_re = re.compile(r"^(\d+) \. (\d+) (\. (\d+))? ([ab](\d+))?$", re.VERBOSE | re.ASCII)
 
     def parse(self, vstring):
@@ -65,8 +123,11 @@ class StrictVersion(Version):
 
         if prerelease:
             self.prerelease = (prerelease[0], int(prerelease_num))
+            self.sort_key = (self.version, 0, self.prerelease)
         else:
             self.prerelease = None
+            # Releases sort after all of their prereleases.
+            self.sort_key = (self.version, 1)
 
     def __str__(self):
         if self.version[2] == 0:
@@ -117,6 +178,7 @@ class StrictVersion(Version):
 
 
 class LooseVersion(Version):
+    __slots__ = ("vstring", "version", "sort_key")
     component_re = re.compile(r"(\d+ | [a-z]+ | \.)", re.VERBOSE)
 
     def parse(self, vstring):
@@ -131,7 +193,7 @@ class LooseVersion(Version):
             except ValueError:
                 pass
 
-        self.version = components
+        self.version = self.sort_key = tuple(components)
 
     def __str__(self):
         return self.vstring
@@ -157,6 +219,7 @@ class PostModernMozillaVersion(StrictVersion):
     """A version class that supports Firefox versions 5.0 and up, which
     may have "a1" but not "b2" tags in them"""
 
+    __slots__ = ()
     version_re = re.compile(
         r"""^(\d+) \. (\d+) (\. (\d+))?
                                 (a(\d+))?$""",
@@ -170,6 +233,7 @@ class ModernMozillaVersion(StrictVersion):
     alpha. This allows us to support the once-shipped "3.6.3plugin1" and
     similar versions."""
 
+    __slots__ = ()
     version_re = re.compile(
         r"""^(\d+) \. (\d+) (\. (\d+))?
                                 ([a-zA-Z]+(\d+))?$""",
@@ -185,6 +249,7 @@ class AncientMozillaVersion(StrictVersion):
     It also supports versions w.x.y.z by transmuting to w.x.z, which
     is useful for versions like 1.5.0.x and 2.0.0.y"""
 
+    __slots__ = ()
     version_re = re.compile(
         r"""^(\d+) \. (\d+) \. \d (\. (\d+))
                                 ([a-zA-Z]+(\d+))?$""",
@@ -208,7 +273,11 @@ class GlobVersionTuple(tuple):
 class GlobVersion(StrictVersion):
     """A version class that supports Firefox versions 5.0 and up, which ends
     with a glob `*`. Not really a StrictVersion at all, but it needs to be
-    to compare with other MozillaVersions."""
+    to compare with other MozillaVersions. It has no sort_key, because globs
+    don't have a place in the order of versions."""
+
+    __slots__ = ("vstring",)
+    sort_key = None
 
     version_re = re.compile(
         r"""^(\d+) \. (\d+\.\*|\*)$""",
@@ -231,6 +300,7 @@ class GlobVersion(StrictVersion):
         return self.vstring
 
 
+@functools.lru_cache(maxsize=INTERNED_VERSIONS)
 def MozillaVersion(version):
     try:
         if version.count(".") in (1, 2):
@@ -307,6 +377,7 @@ class PinVersion(Version):
     auslib.util.comparison.version_compare, which only supports equality
     checking for GlobVersion."""
 
+    __slots__ = ("version",)
     version_re = re.compile(r"^(\d+) \. ((\d+) \.)?$", re.VERBOSE)
 
     def parse(self, vstring):
@@ -348,3 +419,7 @@ class PinVersion(Version):
         elif self.version > other_trimmed_version:
             return 1
         return 0
+
+
+StrictVersion._family = StrictVersion
+LooseVersion._family = LooseVersion
@@ -11,6 +11,7 @@ from statsd.defaults.env import statsd
 
 import auslib.web
 from auslib.errors import BadDataError
+from auslib.util.memo import enable_request_memo
 from auslib.web.admin.views.problem import problem
 
 log = logging.getLogger(__name__)
@@ -112,6 +113,10 @@ def create_app():
     def create_statsd_pipeline():
         g.statsd = statsd.pipeline()
 
+    @flask_app.before_request
+    def create_request_memo():
+        enable_request_memo()
+
     @flask_app.after_request
     def send_statsd_pipeline(response):
         g.statsd.send()
@@ -1,3 +1,5 @@
+import hashlib
+import json
 import logging
 import re
 import sys
@@ -6,14 +8,19 @@ from flask import current_app as app
 from flask import g, make_response, request
 
 from auslib.AUS import FORCE_FALLBACK_MAPPING, FORCE_MAIN_MAPPING
-from auslib.blobs.base import XMLBlob, createBlob
+from auslib.blobs.base import XMLBlob
 from auslib.errors import BadDataError
-from auslib.global_state import dbo
+from auslib.global_state import cache
 from auslib.services import releases
+from auslib.util.memo import memoize_many
 from auslib.web.public.helpers import AUS, get_aus_metadata_headers, get_content_signature_headers, with_transaction
 
 LOG = logging.getLogger(__name__)
 
+# The parts of an update query that the XML for a given set of Releases can
+# depend on. Everything else only affects which Rule and Releases are chosen.
+RESPONSE_QUERY_FIELDS = ("product", "buildTarget", "locale", "channel", "version", "buildID", "queryVersion")
+
 
 def getHeaderArchitecture(buildTarget, ua):
     if buildTarget.startswith("Darwin"):
@@ -172,7 +179,14 @@ def get_update_blob(transaction, **url):
                 response_blobs.extend(evaluate_response_blobs(response_blob_names, update_type, query, transaction))
         else:
             # if we just have a plain old single blob, just add it
-            response_blobs.append({"product_query": query, "response_release": release, "response_update_type": update_type})
+            response_blobs.append(
+                {
+                    "product_query": query,
+                    "response_release": release,
+                    "response_update_type": update_type,
+                    "response_release_version": (eval_metadata["release"], eval_metadata["release_data_version"]),
+                }
+            )
             # Bug 1517743 - we want a cheap test because this will be run on each request
             if release["name"] == "Firefox-mozilla-central-nightly-latest" and query["buildID"] in ("20190103220533", "20190104093221"):
                 squash_response = True
@@ -184,42 +198,85 @@ def get_update_blob(transaction, **url):
 
 def evaluate_response_products(response_products, query, transaction):
     response_blobs = []
+    product_queries = []
     for product in response_products:
         product_query = query.copy()
         product_query["product"] = product
-        response_release, response_update_type, _ = AUS.evaluateRules(product_query, transaction=transaction)
+        product_queries.append(product_query)
+
+    results = AUS.evaluateRulesBatch(product_queries, transaction=transaction)
+    for product_query, (response_release, response_update_type, eval_metadata) in zip(product_queries, results):
         if not response_release:
             continue
 
-        response_blobs.append({"product_query": product_query, "response_release": response_release, "response_update_type": response_update_type})
+        response_blobs.append(
+            {
+                "product_query": product_query,
+                "response_release": response_release,
+                "response_update_type": response_update_type,
+                "response_release_version": (eval_metadata["release"], eval_metadata["release_data_version"]),
+            }
+        )
 
     return response_blobs
 
 
 def evaluate_response_blobs(response_blob_names, update_type, query, transaction):
     response_blobs = []
-    for blob_name in response_blob_names:
-        product_query = query.copy()
-        release_row = releases.get_release(blob_name, transaction, include_sc=False)
-        response_release = None
-        if release_row:
-            product_query["product"] = releases.get_product(blob_name, transaction)
-            response_release = createBlob(release_row["blob"])
-        # TODO: remove me when old releases table dies
-        else:
-            product = dbo.releases.getReleases(name=blob_name, limit=1, transaction=transaction)[0]["product"]
-            product_query["product"] = product
-            response_release = dbo.releases.getReleaseBlob(name=blob_name, transaction=transaction)
-        if not response_release:
+
+    def get_releases(names):
+        found = releases.get_releases_by_names(names, transaction)
+        return [found[name] for name in names]
+
+    for blob_name, release in zip(response_blob_names, memoize_many("response_blob", response_blob_names, get_releases)):
+        if not release or not release["release"]:
             LOG.warning("No release found with name: %s", blob_name)
             continue
 
-        response_blobs.append({"product_query": product_query, "response_release": response_release, "response_update_type": update_type})
+        product_query = query.copy()
+        product_query["product"] = release["product"]
+        response_blobs.append(
+            {
+                "product_query": product_query,
+                "response_release": release["release"],
+                "response_update_type": update_type,
+                "response_release_version": (blob_name, release["data_versions"]),
+            }
+        )
 
     return response_blobs
 
 
-def construct_response(release, query, update_type, response_blobs, squash_response, eval_metadata):
+def get_response_cache_key(release, query, update_type, response_blobs, squash_response, eval_metadata):
+    """Returns the key that the response to a query is cached with. The rendered XML
+    only depends on the Rule, the data_versions of the Releases that were chosen, and
+    a handful of query fields, so many queries end up sharing a response.
+
+    Partial updates are only included if the query's buildID matches the Release they
+    are from, so the buildIDs of those Releases are part of the key too."""
+    signature = {
+        "rule": (eval_metadata["rule_id"], eval_metadata["rule_data_version"]),
+        "release": (eval_metadata["release"], eval_metadata["release_data_version"]),
+        "update_type": update_type,
+        "query": [query.get(field) for field in RESPONSE_QUERY_FIELDS],
+        "force": query["force"].query_value if query["force"] else None,
+        "response_blobs": [
+            (
+                blob["response_release_version"],
+                blob["response_update_type"],
+                blob["product_query"]["product"],
+                blob["response_release"].getFromBuildIDs(blob["product_query"]),
+            )
+            for blob in response_blobs
+        ],
+        "squash": squash_response,
+    }
+    return hashlib.sha256(json.dumps(signature, sort_keys=True).encode()).hexdigest()
+
+
+def render_response(release, query, update_type, response_blobs, squash_response):
+    """Returns the XML response for a query, and the content signature headers to
+    send with it."""
     if release:
         # getHeaderXML() returns outermost header for an update which
         # is same for all release type
@@ -240,24 +297,52 @@ def construct_response(release, query, update_type, response_blobs, squash_respo
         # In case of superblob Extracting Header form parent release
         xml.append(release.getInnerFooterXML(query, update_type, app.config["ALLOWLISTED_DOMAINS"], app.config["SPECIAL_FORCE_HOSTS"]))
         xml.append(release.getFooterXML())
-        # ensure valid xml by using the right entity for ampersand
-        xml = re.sub("&(?!amp;)", "&amp;", "\n".join(xml))
     else:
         xml = ['<?xml version="1.0"?>']
         xml.append("<updates>")
         xml.append("</updates>")
-        xml = "\n".join(xml)
 
+    # The blobs have already escaped everything that they returned.
+    lines = xml
+    xml = "\n".join(lines)
     # Bug 1517743 - remove newlines and 4 space indents
     if squash_response:
         xml = xml.replace("\n", "").replace("    ", "")
+        lines = [xml]
+
+    headers = {}
+    if query["product"] in app.config.get("CONTENT_SIGNATURE_PRODUCTS", []):
+        # Hashing the lines that make up the response saves making another copy of
+        # it, which can be large.
+        headers = get_content_signature_headers(joined(lines, "\n"), query["product"])
+    return {"xml": xml, "headers": headers}
+
+
+def joined(fragments, separator):
+    """Yields the pieces of separator.join(fragments), without joining them."""
+    for i, fragment in enumerate(fragments):
+        if i:
+            yield separator
+        yield fragment
+
 
+def construct_response(release, query, update_type, response_blobs, squash_response, eval_metadata):
+    def render():
+        return render_response(release, query, update_type, response_blobs, squash_response)
+
+    # Responses for queries that didn't get an update are cheap to build, and
+    # aren't worth caching.
+    if release:
+        rendered = cache.get("responses", get_response_cache_key(release, query, update_type, response_blobs, squash_response, eval_metadata), render)
+    else:
+        rendered = render()
+
+    xml = rendered["xml"]
     LOG.debug("Sending XML: %s", xml)
     response = make_response(xml)
     response.headers["Cache-Control"] = app.cacheControl
     response.headers.extend(get_aus_metadata_headers(eval_metadata))
-    if query["product"] in app.config.get("CONTENT_SIGNATURE_PRODUCTS", []):
-        response.headers.extend(get_content_signature_headers(xml, query["product"]))
+    response.headers.extend(rendered["headers"])
     response.mimetype = "text/xml"
     return response
 
@@ -28,22 +28,27 @@ def get_aus_metadata_headers(eval_metadata):
 
 
 def get_content_signature_headers(content, product):
+    """content may be a string, or an iterable of the fragments that make it up,
+    which are hashed without being joined."""
     headers = {}
     if product:
         product += "_"
     if app.config.get("AUTOGRAPH_%sURL" % product):
-        hash_ = make_hash(content)
+        hash_ = make_hash(content) if isinstance(content, str) else make_hash(*content)
 
         keyref = "AUTOGRAPH_%sKEYID" % product
 
         def sign():
-            return sign_hash(
+            args = (
                 app.config["AUTOGRAPH_%sURL" % product],
                 app.config[keyref],
                 app.config["AUTOGRAPH_%sUSERNAME" % product],
                 app.config["AUTOGRAPH_%sPASSWORD" % product],
                 hash_,
             )
+            if app.config.get("SIGNING_QUEUE"):
+                return app.config["SIGNING_QUEUE"].sign(*args)
+            return sign_hash(*args)
 
         # cache with hash+keyref since headers will change based on the key
         signature, x5u = cache.get("content_signatures", f"{hash_}{keyref}", sign)
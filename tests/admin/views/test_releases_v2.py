@@ -4,6 +4,7 @@ import pytest
 from aiohttp import ClientError
 from mock import MagicMock, mock
 
+import auslib.blobs.base
 import auslib.services.releases
 import auslib.util.timestamp
 from auslib.blobs.base import createBlob
@@ -1000,6 +1001,33 @@ def test_post_fails_for_invalid_release_locale(api):
     assert ret.json["detail"] == "Invalid Blob", ret.json
 
 
+@pytest.mark.usefixtures("releases_db", "mock_verified_userinfo")
+def test_post_fails_for_invalid_new_release_locale(api):
+    data = {"platforms": {"Linux_x86_64-gcc3": {"locales": {"newde": {"foo": "foo"}}}}}
+    old_data_versions = versions_dict()
+    old_data_versions["."] = 1
+    assert old_data_versions["platforms"]["Linux_x86_64-gcc3"]["locales"]["de"]
+
+    ret = api.post("/v2/releases/Firefox-60.0b3-build1", json={"blob": data, "old_data_versions": old_data_versions})
+    assert ret.status_code == 400, ret.data
+    assert ret.json["detail"] == "Invalid Blob", ret.json
+
+
+@pytest.mark.usefixtures("releases_db", "mock_verified_userinfo")
+def test_post_validates_only_changed_locales(api, monkeypatch):
+    def validate(*args, **kwargs):
+        raise AssertionError("the whole Release shouldn't be validated")
+
+    monkeypatch.setattr(auslib.blobs.base.Blob, "validate", validate)
+    data = {"platforms": {"Linux_x86_64-gcc3": {"locales": {"de": {"buildID": "7777777777"}}}}}
+    old_data_versions = versions_dict()
+    old_data_versions["."] = 1
+    assert old_data_versions["platforms"]["Linux_x86_64-gcc3"]["locales"]["de"]
+
+    ret = api.post("/v2/releases/Firefox-60.0b3-build1", json={"blob": data, "old_data_versions": old_data_versions})
+    assert ret.status_code == 200, ret.data
+
+
 @pytest.mark.usefixtures("releases_db", "mock_verified_userinfo")
 def test_post_fails_for_readonly_release(api, firefox_60_0b3_build1):
     dbo.releases_json.t.update(values={"read_only": True}).where(dbo.releases_json.name == "Firefox-60.0b3-build1").execute()
@@ -47,6 +47,45 @@ class TestReleaseBlobBase(unittest.TestCase):
         blob = SimpleBlob(platforms=dict(a=dict(), b=dict(alias="a")))
         self.assertRaises(BadDataError, blob.getResolvedPlatform, "d")
 
+    def testPrecomputedLookups(self):
+        blob = SimpleBlob(platforms=dict(a=dict(), b=dict(alias="a"), c=dict(alias="a"), d=dict(alias="e"), f=dict()))
+        precomputed = deepcopy(blob)
+        precomputed.precomputeLookups()
+        for platform in ("a", "b", "c", "d", "f"):
+            self.assertEqual(precomputed.getResolvedPlatform(platform), blob.getResolvedPlatform(platform))
+            self.assertEqual(precomputed.getPlatformAliases(platform), blob.getPlatformAliases(platform))
+        self.assertEqual(precomputed.getPlatformAliases("b"), {"a", "b", "c"})
+        self.assertEqual(precomputed.getPlatformAliases("d"), {"e", "d"})
+        self.assertRaises(BadDataError, precomputed.getResolvedPlatform, "e")
+        self.assertRaises(KeyError, precomputed.getPlatformAliases, "e")
+
+    def testPrecomputedLocaleLookups(self):
+        blob = SimpleBlob(
+            foo=1,
+            bar=2,
+            platforms=dict(
+                a=dict(buildID="1", locales=dict(de=dict(foo=3), fr=dict(buildID="2"))),
+                b=dict(alias="a"),
+                c=dict(locales=dict(de=dict(), fr=dict(buildID="3"))),
+                d=dict(alias="e"),
+            ),
+        )
+        precomputed = deepcopy(blob)
+        precomputed.precomputeLookups()
+        for platform in ("a", "b", "c", "d", "x"):
+            for locale in ("de", "fr", "ja"):
+                for method in ("getLocaleData", "getBuildID"):
+                    try:
+                        expected = getattr(blob, method)(platform, locale)
+                    except BadDataError:
+                        self.assertRaises(BadDataError, getattr(precomputed, method), platform, locale)
+                    else:
+                        self.assertEqual(getattr(precomputed, method)(platform, locale), expected)
+                for param in ("foo", "bar", "buildID", "baz"):
+                    self.assertEqual(precomputed.getLocaleOrTopLevelParam(platform, locale, param), blob.getLocaleOrTopLevelParam(platform, locale, param))
+        # Aliases share the data of the platforms that they resolve to
+        self.assertIs(precomputed.servingView.locales[("b", "de")], precomputed.servingView.locales[("a", "de")])
+
     def testGetPlatformData(self):
         blob = SimpleBlob(platforms=dict(a=dict(foo=1)))
         self.assertEqual(blob.getPlatformData("a"), dict(foo=1))
@@ -576,7 +615,7 @@ class TestSpecialQueryParams(unittest.TestCase):
 """
         expected = [
             """
-<patch type="complete" URL="http://a.com/?foo=a&force=1" hashFunction="sha512" hashValue="1" size="1"/>
+<patch type="complete" URL="http://a.com/?foo=a&amp;force=1" hashFunction="sha512" hashValue="1" size="1"/>
 """
         ]
         expected = [x.strip() for x in expected]
@@ -607,7 +646,7 @@ class TestSpecialQueryParams(unittest.TestCase):
 """
         expected = [
             """
-<patch type="complete" URL="http://a.com/?foo=a&force=-1" hashFunction="sha512" hashValue="1" size="1"/>
+<patch type="complete" URL="http://a.com/?foo=a&amp;force=-1" hashFunction="sha512" hashValue="1" size="1"/>
 """
         ]
         expected = [x.strip() for x in expected]
@@ -3395,6 +3434,73 @@ class TestSchema9Blob(unittest.TestCase):
         expected_footer = "</update>"
         self.assertEqual(returned_footer.strip(), expected_footer.strip())
 
+    def testServingView(self):
+        precomputed = deepcopy(self.blobH2)
+        precomputed.precomputeLookups()
+        for locale in ("l", "de", "m"):
+            for channel in ("release", "c1", "c1-cck-foo"):
+                updateQuery = {
+                    "product": "h",
+                    "buildID": "10",
+                    "version": "30.0",
+                    "buildTarget": "p",
+                    "locale": locale,
+                    "channel": channel,
+                    "osVersion": "a",
+                    "distribution": "a",
+                    "distVersion": "a",
+                    "force": None,
+                }
+                for method in ("getInnerHeaderXML", "getInnerXML", "getInnerFooterXML"):
+                    try:
+                        expected = getattr(self.blobH2, method)(updateQuery, "minor", self.allowlistedDomains, self.specialForceHosts)
+                    except BadDataError:
+                        self.assertRaises(BadDataError, getattr(precomputed, method), updateQuery, "minor", self.allowlistedDomains, self.specialForceHosts)
+                    else:
+                        self.assertEqual(getattr(precomputed, method)(updateQuery, "minor", self.allowlistedDomains, self.specialForceHosts), expected)
+                self.assertEqual(precomputed.shouldServeUpdate(updateQuery), self.blobH2.shouldServeUpdate(updateQuery))
+
+        # The patch XML is only rendered once
+        updateQuery["locale"] = "de"
+        expected = self.blobH2.getInnerXML(updateQuery, "minor", self.allowlistedDomains, self.specialForceHosts)
+        self.assertIn(expected[0], [value for _, value in precomputed.servingView.patchFragments.data.values()])
+        with mock.patch.object(precomputed, "_getUrl") as getUrl, mock.patch("auslib.blobs.apprelease.isForbiddenUrl") as isForbiddenUrl:
+            self.assertEqual(precomputed.getInnerXML(updateQuery, "minor", self.allowlistedDomains, self.specialForceHosts), expected)
+            self.assertEqual(getUrl.call_count, 0)
+            self.assertEqual(isForbiddenUrl.call_count, 0)
+
+        # ...unless it's checked against different allowlisted domains
+        self.assertEqual(precomputed.getInnerXML(updateQuery, "minor", {"b.com": ("h",)}, self.specialForceHosts), [])
+        self.assertEqual(precomputed.getInnerXML(updateQuery, "minor", self.allowlistedDomains, self.specialForceHosts), expected)
+
+    def testServingViewKeepsRecentPatchFragments(self):
+        precomputed = deepcopy(self.blobH2)
+        precomputed.precomputeLookups()
+        updateQuery = {
+            "product": "h",
+            "buildID": "10",
+            "version": "30.0",
+            "buildTarget": "p",
+            "locale": "de",
+            "channel": "c1",
+            "osVersion": "a",
+            "distribution": "a",
+            "distVersion": "a",
+            "force": None,
+        }
+        with mock.patch("auslib.blobs.apprelease.MAX_PATCH_FRAGMENTS", 10):
+            # Serve more channels than the view has room for...
+            for i in range(30):
+                precomputed.getInnerXML(dict(updateQuery, channel=f"c1-cck-{i}"), "minor", self.allowlistedDomains, self.specialForceHosts)
+            # ...and the ones served after it's full are still remembered.
+            updateQuery["channel"] = "c1-cck-new"
+            expected = precomputed.getInnerXML(updateQuery, "minor", self.allowlistedDomains, self.specialForceHosts)
+            self.assertEqual(len(expected), 2)
+            with mock.patch.object(precomputed, "_getUrl") as getUrl:
+                self.assertEqual(precomputed.getInnerXML(updateQuery, "minor", self.allowlistedDomains, self.specialForceHosts), expected)
+                self.assertEqual(getUrl.call_count, 0)
+            self.assertLessEqual(len(precomputed.servingView.patchFragments.data), 10)
+
     def testWithoutActionsByChannel(self):
         updateQuery = {
             "product": "h",
@@ -3790,6 +3896,34 @@ class TestSchema9Blob(unittest.TestCase):
         )
         self.assertRaises(BlobValidationError, blob.validate, "h", self.allowlistedDomains)
 
+    def testValidateSubtrees(self):
+        blob = ReleaseBlobV9(
+            name="bbb",
+            schema_version=9,
+            hashFunction="sha512",
+            appVersion="68.0",
+            displayVersion="68.0",
+            # Invalid, but it's not part of what's being validated.
+            updateLine="bad",
+            platforms={
+                "p": {
+                    "buildID": 50,
+                    "locales": {
+                        "en-US": {"completes": [{"filesize": 40, "from": "*", "hashValue": "41", "fileUrl": "http://a.com/complete"}]},
+                        "de": {"completes": [{"filesize": "big", "from": "*", "hashValue": "42"}]},
+                        "fr": {"completes": [{"filesize": 40, "from": "*", "hashValue": "43", "fileUrl": "http://evil.com/complete"}]},
+                    },
+                },
+                "q": {"alias": "p"},
+            },
+        )
+        self.assertRaises(BlobValidationError, blob.validate, "h", self.allowlistedDomains)
+        blob.validateSubtrees("h", self.allowlistedDomains, [("platforms", "p", "locales", "en-US"), ("platforms", "q")])
+        self.assertRaises(BlobValidationError, blob.validateSubtrees, "h", self.allowlistedDomains, [("platforms", "p", "locales", "de")])
+        self.assertRaises(ValueError, blob.validateSubtrees, "h", self.allowlistedDomains, [("platforms", "p", "locales", "fr")])
+        # Paths that aren't in the schema fall back to validating everything
+        self.assertRaises(BlobValidationError, blob.validateSubtrees, "h", self.allowlistedDomains, [("foo",)])
+
 
 @pytest.mark.parametrize(
     "for1,for2",
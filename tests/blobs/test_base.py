@@ -2,10 +2,12 @@ import unittest
 from copy import deepcopy
 
 import hypothesis.strategies as st
+import jsonschema
 import mock
+import pytest
 from hypothesis import HealthCheck, assume, given, settings
 
-from auslib.blobs.base import createBlob, merge_dicts, merge_lists
+from auslib.blobs.base import createBlob, escapeAmpersands, getSubschema, merge_dicts, merge_lists, validators
 from auslib.global_state import cache
 
 
@@ -13,9 +15,11 @@ class TestCreateBlob(unittest.TestCase):
     def setUp(self):
         cache.reset()
         cache.make_cache("blob_schema", 50, 10000)
+        validators.clear()
 
     def tearDown(self):
         cache.reset()
+        validators.clear()
 
     def testLoadString(self):
         data = """{
@@ -51,6 +55,51 @@ class TestCreateBlob(unittest.TestCase):
 
             self.assertEqual(yaml_load.call_count, 1)
 
+    def testValidatorCaching(self):
+        with mock.patch("jsonschema.Draft4Validator", wraps=jsonschema.Draft4Validator) as Draft4Validator:
+            for _ in range(2):
+                createBlob(dict(schema_version=50, name="foo", detailsUrl="https://a.com", displayVersion="1")).validate("fake", [])
+                createBlob(dict(schema_version=4000, name="foo", products=["a"])).validate("fake", [])
+
+            self.assertEqual(Draft4Validator.call_count, 2)
+
+
+class TestGetSubschema(unittest.TestCase):
+    schema = {
+        "type": "object",
+        "additionalProperties": False,
+        "properties": {
+            "name": {"type": "string"},
+            "platforms": {
+                "type": "object",
+                "patternProperties": {
+                    "^.+$": {
+                        "oneOf": [
+                            {"type": "object", "required": ["alias"], "properties": {"alias": {"type": "string"}}},
+                            {"type": "object", "properties": {"locales": {"type": "object", "additionalProperties": {"type": "integer"}}}},
+                        ]
+                    }
+                },
+            },
+            "ambiguous": {"type": "object", "patternProperties": {"^a": {"type": "string"}, "b$": {"type": "integer"}}},
+        },
+    }
+
+    def testProperties(self):
+        self.assertEqual(getSubschema(self.schema, ("name",)), {"type": "string"})
+        self.assertEqual(getSubschema(self.schema, ()), self.schema)
+
+    def testPatternPropertiesAndOneOf(self):
+        self.assertEqual(getSubschema(self.schema, ("platforms", "p")), self.schema["properties"]["platforms"]["patternProperties"]["^.+$"])
+        self.assertEqual(getSubschema(self.schema, ("platforms", "p", "locales")), {"type": "object", "additionalProperties": {"type": "integer"}})
+        self.assertEqual(getSubschema(self.schema, ("platforms", "p", "locales", "de")), {"type": "integer"})
+        self.assertEqual(getSubschema(self.schema, ("platforms", "p", "alias")), {"type": "string"})
+
+    def testNoSingleMatch(self):
+        self.assertIsNone(getSubschema(self.schema, ("foo",)))
+        self.assertIsNone(getSubschema(self.schema, ("ambiguous", "ab")))
+        self.assertEqual(getSubschema(self.schema, ("ambiguous", "aa")), {"type": "string"})
+
 
 # Things we consider to be useful values in testing blobs. Basically, these
 # are things would actually show up in real blobs. Nesting is handled
@@ -202,3 +251,15 @@ def test_merge_dicts_unicode_and_str_are_equal():
     expected = {"foo": "bar", "blah": "crap", "abc": "def", "ghi": "jkl"}
     got = merge_dicts(base, left, right)
     assert got == expected
+
+
+@pytest.mark.parametrize(
+    "xml,expected",
+    [
+        ('<patch URL="http://a.com/?b=c"/>', '<patch URL="http://a.com/?b=c"/>'),
+        ('<patch URL="http://a.com/?b=c&d=e&f=g"/>', '<patch URL="http://a.com/?b=c&amp;d=e&amp;f=g"/>'),
+        ('<patch URL="http://a.com/?b=c&amp;d=e&f=g"/>', '<patch URL="http://a.com/?b=c&amp;d=e&amp;f=g"/>'),
+    ],
+)
+def test_escape_ampersands(xml, expected):
+    assert escapeAmpersands(xml) == expected
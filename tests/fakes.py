@@ -1,4 +1,5 @@
 import json
+import time
 
 from auslib.db import GCSHistory, GCSHistoryAsync
 
@@ -65,3 +66,41 @@ class FakeGCSHistoryAsync(GCSHistoryAsync):
 
     def _getBucket(self, identifier):
         return lambda session: self.bucket
+
+
+class FakeUwsgi:
+    """The parts of the uwsgi module that manage its caches, which only exists
+    in processes that uwsgi runs. Like uwsgi, cache_set doesn't replace values,
+    and values that are bigger than max_item_size aren't stored."""
+
+    def __init__(self, max_item_size=None):
+        self.caches = {}
+        self.max_item_size = max_item_size
+
+    def _get_item(self, key, cache_name):
+        item = self.caches.setdefault(cache_name, {}).get(key)
+        if item and item[1] and item[1] <= time.time():
+            del self.caches[cache_name][key]
+            return None
+        return item
+
+    def cache_get(self, key, cache_name=None):
+        item = self._get_item(key, cache_name)
+        return item[0] if item else None
+
+    def cache_exists(self, key, cache_name=None):
+        return self._get_item(key, cache_name) is not None
+
+    def cache_set(self, key, value, expires=0, cache_name=None):
+        if self._get_item(key, cache_name):
+            return None
+        return self.cache_update(key, value, expires, cache_name)
+
+    def cache_update(self, key, value, expires=0, cache_name=None):
+        if self.max_item_size is not None and len(value) > self.max_item_size:
+            return None
+        self.caches.setdefault(cache_name, {})[key] = (value, time.time() + expires if expires else 0)
+        return True
+
+    def cache_del(self, key, cache_name=None):
+        self.caches.setdefault(cache_name, {}).pop(key, None)
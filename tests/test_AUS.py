@@ -4,7 +4,7 @@ import unittest
 import mock
 import pytest
 
-from auslib.AUS import AUS, FORCE_FALLBACK_MAPPING, FORCE_MAIN_MAPPING, isForbiddenUrl
+from auslib.AUS import AUS, FORCE_FALLBACK_MAPPING, FORCE_MAIN_MAPPING, DomainAllowlist, containsForbiddenUrl, isForbiddenUrl
 from auslib.blobs.base import createBlob
 from auslib.global_state import dbo
 
@@ -56,11 +56,11 @@ class TestAUSThrottlingWithoutFallback(unittest.TestCase):
     def random_aus_test(self, background_rate, force=None, fallback=False, pin=False):
         mapping = "b"
         pin_mapping = "pinned"
-        with mock.patch("auslib.db.Rules.getRulesMatchingQuery") as m:
+        with mock.patch("auslib.db.Rules.getHighestPriorityMatchingRule") as m:
             fallback = fallback and "fallback"  # convert True to string
-            m.return_value = [
-                dict(rule_id=1, data_version=1, backgroundRate=background_rate, priority=1, mapping=mapping, update_type="minor", fallbackMapping=fallback)
-            ]
+            m.return_value = dict(
+                rule_id=1, data_version=1, backgroundRate=background_rate, priority=1, mapping=mapping, update_type="minor", fallbackMapping=fallback
+            )
 
             results = list(ENTIRE_RANGE)
             resultsLength = len(results)
@@ -213,19 +213,51 @@ class TestAUSThrottlingWithoutFallback(unittest.TestCase):
         self.assertEqual(tested, 1)
 
 
-class TestForbiddenUrl(unittest.TestCase):
-    def test_urls(self):
-        allowlist = {
-            "ignore.net": ("c", "d"),
-            "b.org": ("e", "f"),
-            "a.com": {
-                "/path/[\\w\\.]+/[\\w\\.]+\\.bin": (
-                    "a",
-                    "b",
-                ),
-            },
-        }
+@pytest.mark.usefixtures("current_db_schema")
+class TestEvaluateRulesBatch(unittest.TestCase):
+    def setUp(self):
+        dbo.setDb("sqlite:///:memory:")
+        self.metadata.create_all(dbo.engine)
+        for name, product in (("b", "b"), ("c", "c"), ("d", "d")):
+            dbo.releases.t.insert().execute(
+                name=name,
+                product=product,
+                data_version=1,
+                data=createBlob({"name": name, "extv": "2.0", "schema_version": 1, "platforms": {"a": {"buildID": "1", "locales": {"a": {}}}}}),
+            )
+            dbo.rules.t.insert().execute(product=product, priority=100, backgroundRate=100, mapping=name, update_type="minor", data_version=1)
+        dbo.rules.t.insert().execute(product="e", priority=100, backgroundRate=100, mapping=None, update_type="minor", data_version=1)
+        dbo.emergencyShutoffs.t.insert().execute(product="d", channel="foo", data_version=1)
+
+    def tearDown(self):
+        dbo.reset()
+
+    def testEvaluateRulesBatch(self):
+        query = dict(channel="foo", force=None, buildTarget="a", buildID="0", locale="a", version="1.0")
+        queries = [dict(query, product=product) for product in ("b", "c", "d", "e", "f")]
+        aus = AUS()
+
+        with mock.patch("auslib.db.Rules.select", wraps=dbo.rules.select) as select:
+            results = aus.evaluateRulesBatch(queries)
+            self.assertEqual(select.call_count, 1)
+
+        self.assertEqual([r["name"] if r else None for r, _, _ in results], ["b", "c", None, None, None])
+        self.assertEqual(results, [aus.evaluateRules(query) for query in queries])
 
+
+class TestForbiddenUrl(unittest.TestCase):
+    allowlist = {
+        "ignore.net": ("c", "d"),
+        "b.org": ("e", "f"),
+        "a.com": {
+            "/path/[\\w\\.]+/[\\w\\.]+\\.bin": (
+                "a",
+                "b",
+            ),
+        },
+    }
+
+    def assertUrls(self, allowlist):
         # Unmatched domain
         self.assertTrue(isForbiddenUrl("https://b.com/path/foo/bar.bin", "c", allowlist))
 
@@ -244,3 +276,26 @@ class TestForbiddenUrl(unittest.TestCase):
 
         # Matches domain, path and product
         self.assertFalse(isForbiddenUrl("https://a.com/path/foo/bar.bin", "b", allowlist))
+
+    def test_urls(self):
+        self.assertUrls(self.allowlist)
+
+    def test_compiled_allowlist(self):
+        allowlist = DomainAllowlist(self.allowlist)
+        self.assertUrls(allowlist)
+
+        # Verdicts are remembered, including the warnings for forbidden URLs
+        with mock.patch("auslib.AUS.urlparse") as urlparse, mock.patch("auslib.AUS.logging") as logging:
+            self.assertUrls(allowlist)
+            self.assertEqual(urlparse.call_count, 0)
+            self.assertEqual(logging.warning.call_count, 5)
+        self.assertTrue(isForbiddenUrl("https://a.com/path/foo/bar.bin", "a", {}))
+        self.assertFalse(isForbiddenUrl("https://a.com/path/foo/bar.bin", "a", allowlist))
+
+    def test_contains_forbidden_url(self):
+        allowlist = DomainAllowlist(self.allowlist)
+        urls = ["https://b.org/anything/I/want.exe"] * 100
+        with mock.patch.object(allowlist, "check", wraps=allowlist.check) as check:
+            self.assertFalse(containsForbiddenUrl(urls, "e", allowlist))
+            self.assertEqual(check.call_count, 1)
+        self.assertTrue(containsForbiddenUrl(urls + ["https://b.com/foo.bin"], "e", allowlist))
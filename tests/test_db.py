@@ -35,7 +35,7 @@ from auslib.db import (
     UpdateMergeError,
     verify_signoffs,
 )
-from auslib.errors import BlobValidationError, ReadOnlyError
+from auslib.errors import BadDataError, BlobValidationError, ReadOnlyError
 from auslib.global_state import cache, dbo
 from auslib.services import releases
 
@@ -172,6 +172,32 @@ class TestAUSTransaction(unittest.TestCase, MemoryDatabaseMixin):
             pass
         self.assertIsNone(trans.conn, "Connection should remain None when no queries were executed")
 
+    def testAfterCommit(self):
+        callback = mock.Mock()
+        with AUSTransaction(self.metadata.bind) as trans:
+            trans.execute(self.table.insert(values=dict(id=5, foo=41)))
+            trans.afterCommit(callback)
+            self.assertFalse(callback.called)
+        callback.assert_called_once_with()
+
+    def testAfterCommitNotCalledOnRollback(self):
+        callback = mock.Mock()
+        with self.assertRaises(ValueError):
+            with AUSTransaction(self.metadata.bind) as trans:
+                trans.execute(self.table.insert(values=dict(id=5, foo=41)))
+                trans.afterCommit(callback)
+                raise ValueError()
+        self.assertFalse(callback.called)
+
+    def testAfterCommitFailureDoesntFailCommit(self):
+        callback = mock.Mock()
+        with AUSTransaction(self.metadata.bind) as trans:
+            trans.execute(self.table.insert(values=dict(id=5, foo=41)))
+            trans.afterCommit(mock.Mock(side_effect=Exception("boom")))
+            trans.afterCommit(callback)
+        callback.assert_called_once_with()
+        self.assertEqual(self.table.select().where(self.table.c.id == 5).execute().fetchall(), [(5, 41)])
+
 
 class TestAUSTransactionRequiresRealFile(unittest.TestCase, NamedFileDatabaseMixin):
     def setUp(self):
@@ -1844,12 +1870,9 @@ class RulesTestMixin(object):
     def _stripNullColumns(self, rules):
         # We know a bunch of columns are going to be empty...easier to strip them out
         # than to be super verbose (also should let this test continue to work even
-        # if the schema changes).
-        for rule in rules:
-            for key in rule.copy().keys():
-                if rule[key] is None:
-                    del rule[key]
-        return rules
+        # if the schema changes). The rules themselves are left untouched, because
+        # they may be shared with the rule index.
+        return [{k: v for k, v in rule.items() if v is not None} for rule in rules]
 
 
 @pytest.mark.usefixtures("current_db_schema")
@@ -1987,6 +2010,66 @@ class TestRulesSimple(unittest.TestCase, RulesTestMixin, MemoryDatabaseMixin):
         sc_history_columns = [c.name for c in self.db.rules.scheduled_changes.history.t.columns]
         self.assertTrue(set(sc_expected).issubset(set(sc_history_columns)))
 
+    def testInvalidVersionOnlyRaisesWhenAVersionIsCompared(self):
+        query = dict(
+            product="a",
+            version="bogus",
+            channel="a",
+            buildTarget="d",
+            buildID="",
+            locale="foo",
+            osVersion="foo 1",
+            distribution="",
+            distVersion="",
+            headerArchitecture="",
+            force=False,
+            queryVersion=3,
+        )
+        self.assertRaises(BadDataError, self.paths.getRulesMatchingQuery, query, "a")
+        self.assertRaises(BadDataError, self.paths.getHighestPriorityMatchingRule, query, "a")
+
+        # Rules that have a lower priority than the first match aren't evaluated,
+        # so their versions aren't compared.
+        self.paths.t.insert().execute(
+            rule_id=99, priority=200, buildTarget="d", backgroundRate=100, mapping="a", update_type="z", product="a", channel="a", data_version=1
+        )
+        cache.reset()
+        self.assertEqual(self.paths.getHighestPriorityMatchingRule(query, "a")["rule_id"], 99)
+        self.assertRaises(BadDataError, self.paths.getRulesMatchingQuery, query, "a")
+
+    def testGetHighestPriorityMatchingRule(self):
+        base = dict(
+            product="a",
+            version="3.5",
+            channel="a",
+            buildTarget="d",
+            buildID="",
+            locale="foo",
+            osVersion="foo 1",
+            distribution="",
+            distVersion="",
+            headerArchitecture="",
+            force=False,
+            queryVersion=3,
+        )
+        queries = [
+            base,
+            dict(base, version="3.3"),
+            dict(base, osVersion="bar && baz"),
+            dict(base, buildTarget="e"),
+            dict(base, buildTarget="e", locale="bar"),
+            dict(base, product="foo", channel="foo-cck-bar", buildTarget="g"),
+            dict(base, product="b", buildTarget="x"),
+        ]
+        for query in queries:
+            fallbackChannel = query["channel"].split("-cck-")[0]
+            matching = sorted(self.paths.getRulesMatchingQuery(query, fallbackChannel), key=lambda r: r["priority"], reverse=True)
+            expected = matching[0] if matching else None
+            self.assertEqual(self.paths.getHighestPriorityMatchingRule(query, fallbackChannel), expected, query)
+
+        lookups = [(query, query["channel"].split("-cck-")[0]) for query in queries]
+        self.assertEqual(self.paths.getHighestPriorityMatchingRules(lookups), [self.paths.getHighestPriorityMatchingRule(*lookup) for lookup in lookups])
+
     def testGetOrderedRules(self):
         rules = self._stripNullColumns(self.paths.getOrderedRules())
         expected = [
@@ -3484,6 +3567,190 @@ class TestRulesSpecial(unittest.TestCase, RulesTestMixin, MemoryDatabaseMixin):
         self.assertEqual(rules, [])
 
 
+# Run all of the rule matching tests again with the in-memory rule index enabled,
+# to make sure that it matches exactly the same rules as the database does.
+class TestRulesSimpleWithIndex(TestRulesSimple):
+    def setUp(self):
+        super(TestRulesSimpleWithIndex, self).setUp()
+        self.db.rules.enableIndex(0)
+
+
+class TestJawsRulesWithIndex(TestJawsRules):
+    def setUp(self):
+        super(TestJawsRulesWithIndex, self).setUp()
+        self.db.rules.enableIndex(0)
+
+
+class TestMig64RulesWithIndex(TestMig64Rules):
+    def setUp(self):
+        super(TestMig64RulesWithIndex, self).setUp()
+        self.db.rules.enableIndex(0)
+
+
+class TestRulesSpecialWithIndex(TestRulesSpecial):
+    def setUp(self):
+        super(TestRulesSpecialWithIndex, self).setUp()
+        self.db.rules.enableIndex(0)
+
+
+@pytest.mark.usefixtures("current_db_schema")
+class TestRuleIndex(unittest.TestCase, MemoryDatabaseMixin):
+    def setUp(self):
+        MemoryDatabaseMixin.setUp(self)
+        self.db = AUSDatabase(self.dburi)
+        self.metadata.create_all(self.db.engine)
+        self.db.permissions.t.insert().execute(permission="admin", username="bill", data_version=1)
+        self.rules = self.db.rules
+        self.rules.t.insert().execute(
+            rule_id=1, priority=100, buildTarget="d", backgroundRate=100, mapping="a", update_type="minor", product="a", channel="ab", data_version=1
+        )
+        self.rules.t.insert().execute(
+            rule_id=2, priority=90, buildTarget="d", backgroundRate=100, mapping="b", update_type="minor", product="a", channel="ab*", data_version=1
+        )
+        self.rules.t.insert().execute(rule_id=3, priority=80, backgroundRate=100, mapping="c", update_type="minor", data_version=1)
+        self.rules.t.insert().execute(
+            rule_id=4, priority=100, buildTarget="d", backgroundRate=100, mapping="d", update_type="minor", product="b", channel="ab", data_version=1
+        )
+        self.rules.t.insert().execute(
+            rule_id=5, priority=100, backgroundRate=100, mapping="e", update_type="minor", product="a", channel="ab", headerArchitecture="Intel", data_version=1
+        )
+        self.query = dict(product="a", version="1.0", channel="ab", buildTarget="d", buildID="1", locale="l", osVersion="", force=None)
+
+    def _matchingRuleIds(self, query=None):
+        return [r["rule_id"] for r in self.rules.getRulesMatchingQuery(query or self.query, fallbackChannel="ab")]
+
+    def testCandidates(self):
+        self.rules.enableIndex(0)
+        self.assertEqual([r["rule_id"] for r in self.rules.index.getCandidates(self.query, "ab")], [1, 2, 3])
+        self.assertEqual([r["rule_id"] for r in self.rules.index.getCandidates(dict(self.query, channel="abc"), "abc")], [2, 3])
+        self.assertEqual([r["rule_id"] for r in self.rules.index.getCandidates(dict(self.query, headerArchitecture="Intel"), "ab")], [1, 2, 3, 5])
+        self.assertEqual([r["rule_id"] for r in self.rules.index.getCandidates(dict(self.query, product="c", buildTarget="x"), "ab")], [3])
+
+    def testChangesAreSeenAfterRefreshInterval(self):
+        self.rules.enableIndex(0)
+        self.assertEqual(self._matchingRuleIds(), [1, 2, 3])
+        self.rules.update(where={"rule_id": 1}, what={"channel": "b"}, changed_by="bill", old_data_version=1)
+        self.assertEqual(self._matchingRuleIds(), [2, 3])
+        self.rules.delete(where={"rule_id": 2}, changed_by="bill", old_data_version=1)
+        self.assertEqual(self._matchingRuleIds(), [3])
+
+    def testChangesAreNotSeenBeforeRefreshInterval(self):
+        self.rules.enableIndex(3600)
+        self.assertEqual(self._matchingRuleIds(), [1, 2, 3])
+        with mock.patch.object(self.rules, "getVersionStamp", wraps=self.rules.getVersionStamp) as getVersionStamp:
+            self.rules.t.delete().where(self.rules.rule_id == 1).execute()
+            self.assertEqual(self._matchingRuleIds(), [1, 2, 3])
+            self.assertEqual(getVersionStamp.call_count, 0)
+            self.rules.index.invalidate()
+            self.assertEqual(self._matchingRuleIds(), [2, 3])
+            self.assertEqual(getVersionStamp.call_count, 1)
+
+    def testHighestPriorityMatchStopsEarly(self):
+        self.rules.enableIndex(0)
+        with mock.patch.object(self.rules, "_ruleMatchesQuery", wraps=self.rules._ruleMatchesQuery) as ruleMatchesQuery:
+            self.assertEqual(self.rules.getHighestPriorityMatchingRule(self.query, "ab")["rule_id"], 1)
+            self.assertEqual(ruleMatchesQuery.call_count, 1)
+        with mock.patch.object(self.rules, "_ruleMatchesQuery", wraps=self.rules._ruleMatchesQuery) as ruleMatchesQuery:
+            self.assertEqual(self.rules.getHighestPriorityMatchingRule(dict(self.query, locale="l", version="0.5", channel="ab-cck-foo"), "ab")["rule_id"], 1)
+            self.assertEqual(ruleMatchesQuery.call_count, 1)
+        self.rules.update(where={"rule_id": 1}, what={"locale": "de"}, changed_by="bill", old_data_version=1)
+        with mock.patch.object(self.rules, "_ruleMatchesQuery", wraps=self.rules._ruleMatchesQuery) as ruleMatchesQuery:
+            self.assertEqual(self.rules.getHighestPriorityMatchingRule(self.query, "ab")["rule_id"], 2)
+            self.assertEqual(ruleMatchesQuery.call_count, 2)
+
+    def testNoReloadWhenTableIsUnchanged(self):
+        self.rules.enableIndex(0)
+        self.assertEqual(self._matchingRuleIds(), [1, 2, 3])
+        with mock.patch.object(self.rules, "select", wraps=self.rules.select) as select:
+            self.assertEqual(self._matchingRuleIds(), [1, 2, 3])
+            self.assertEqual(select.call_count, 0)
+
+
+@pytest.mark.usefixtures("current_db_schema")
+class TestEmergencyShutoffSnapshot(unittest.TestCase, MemoryDatabaseMixin):
+    def setUp(self):
+        MemoryDatabaseMixin.setUp(self)
+        self.db = AUSDatabase(self.dburi)
+        self.metadata.create_all(self.db.engine)
+        self.db.permissions.t.insert().execute(permission="admin", username="bill", data_version=1)
+        self.shutoffs = self.db.emergencyShutoffs
+        self.shutoffs.t.insert().execute(product="Firefox", channel="release", data_version=1)
+
+    def testUpdatesAreDisabled(self):
+        self.shutoffs.enableSnapshot(0)
+        self.assertTrue(self.shutoffs.updatesAreDisabled("Firefox", "release"))
+        self.assertFalse(self.shutoffs.updatesAreDisabled("Firefox", "beta"))
+        self.assertFalse(self.shutoffs.updatesAreDisabled("Thunderbird", "release"))
+
+        self.shutoffs.insert(changed_by="bill", product="Firefox", channel="beta")
+        self.assertTrue(self.shutoffs.updatesAreDisabled("Firefox", "beta"))
+        self.shutoffs.delete(where={"product": "Firefox", "channel": "release"}, changed_by="bill", old_data_version=1)
+        self.assertFalse(self.shutoffs.updatesAreDisabled("Firefox", "release"))
+
+    def testChangesAreNotSeenBeforeRefreshInterval(self):
+        self.shutoffs.enableSnapshot(3600)
+        self.assertFalse(self.shutoffs.updatesAreDisabled("Firefox", "beta"))
+        with mock.patch.object(self.shutoffs, "select", wraps=self.shutoffs.select) as select:
+            self.shutoffs.insert(changed_by="bill", product="Firefox", channel="beta")
+            self.assertFalse(self.shutoffs.updatesAreDisabled("Firefox", "beta"))
+            self.assertEqual(select.call_count, 0)
+            self.shutoffs.snapshot.invalidate()
+            self.assertTrue(self.shutoffs.updatesAreDisabled("Firefox", "beta"))
+            self.assertEqual(select.call_count, 1)
+
+
+@pytest.mark.usefixtures("current_db_schema")
+class TestChangePublishing(unittest.TestCase, MemoryDatabaseMixin):
+    def setUp(self):
+        MemoryDatabaseMixin.setUp(self)
+        self.db = AUSDatabase(self.dburi)
+        self.metadata.create_all(self.db.engine)
+        self.db.permissions.t.insert().execute(permission="admin", username="bill", data_version=1)
+        self.publisher = mock.Mock()
+        self.db.setChangePublisher(self.publisher)
+
+    def testRuleChangesArePublished(self):
+        rule_id = self.db.rules.insert(changed_by="bill", backgroundRate=100, priority=100, update_type="minor", product="a")
+        self.db.rules.update(where={"rule_id": rule_id}, what={"priority": 50}, changed_by="bill", old_data_version=1)
+        self.db.rules.delete(where={"rule_id": rule_id}, changed_by="bill", old_data_version=2)
+        self.assertEqual(
+            self.publisher.publish.call_args_list,
+            [
+                mock.call("rules", {"rule_id": rule_id}, 1),
+                mock.call("rules", {"rule_id": rule_id}, 2),
+                mock.call("rules", {"rule_id": rule_id}, None),
+            ],
+        )
+
+    def testCompositePrimaryKeysArePublished(self):
+        self.db.emergencyShutoffs.insert(changed_by="bill", product="Firefox", channel="release")
+        self.db.release_assets.insert(changed_by="bill", name="a", path=".platforms.p.locales.l", data={}, data_version=1)
+        self.assertEqual(
+            self.publisher.publish.call_args_list,
+            [
+                mock.call("emergency_shutoffs", {"product": "Firefox", "channel": "release"}, 1),
+                mock.call("release_assets", {"name": "a", "path": ".platforms.p.locales.l"}, 1),
+            ],
+        )
+
+    def testChangesArePublishedAfterCommit(self):
+        with self.db.begin() as trans:
+            self.db.rules.insert(changed_by="bill", backgroundRate=100, priority=100, update_type="minor", transaction=trans)
+            self.assertFalse(self.publisher.publish.called)
+        self.assertEqual(self.publisher.publish.call_count, 1)
+
+    def testRolledBackChangesArentPublished(self):
+        with self.assertRaises(ValueError):
+            with self.db.begin() as trans:
+                self.db.rules.insert(changed_by="bill", backgroundRate=100, priority=100, update_type="minor", transaction=trans)
+                raise ValueError()
+        self.assertFalse(self.publisher.publish.called)
+
+    def testOtherTablesArentPublished(self):
+        self.db.permissions.insert(changed_by="bill", permission="rule", username="bob")
+        self.assertFalse(self.publisher.publish.called)
+
+
 @pytest.mark.usefixtures("current_db_schema")
 class TestReleases(unittest.TestCase, MemoryDatabaseMixin):
     def setUp(self):
@@ -4070,6 +4337,34 @@ class TestRulesCaching(unittest.TestCase, MemoryDatabaseMixin, RulesTestMixin):
 
             self._checkCacheStats(cache.caches["rules"], 5, 3, 2)
 
+    def testGetHighestPriorityMatchingRulesSelectsOnce(self):
+        query = dict(
+            version="3.5",
+            channel="",
+            buildTarget="d",
+            buildID="",
+            locale="",
+            osVersion="",
+            distribution="",
+            distVersion="",
+            headerArchitecture="",
+            force=False,
+            queryVersion=3,
+        )
+        lookups = [(dict(query, product=product), "") for product in ("a", "b", "c")]
+        with mock.patch.object(self.rules, "select", wraps=self.rules.select) as select:
+            rules = self.rules.getHighestPriorityMatchingRules(lookups)
+            self.assertEqual([rule["rule_id"] for rule in rules], [1, 1, 1])
+            self.assertEqual(select.call_count, 1)
+
+            # Each product's candidates are cached separately...
+            self.assertEqual(self.rules.getHighestPriorityMatchingRule(*lookups[1])["rule_id"], 1)
+            self.assertEqual(select.call_count, 1)
+
+            # ...so only new ones need to be selected.
+            self.rules.getHighestPriorityMatchingRules(lookups + [(dict(query, product="d"), "")])
+            self.assertEqual(select.call_count, 2)
+
     def testGetRulesMatchingQueryRefreshesAfterExpiry(self):
         """Ensure that getRulesMatchingQuery picks up changes to the rules table after expiry"""
         with mock.patch("time.time") as t:
@@ -4233,6 +4528,29 @@ class TestBlobCaching(unittest.TestCase, MemoryDatabaseMixin):
             # miss, the next three hit, and then the last one miss again.
             self._checkCacheStats(cache.caches["blob_version"], 5, 3, 2)
 
+    def testGetReleaseBlobRefreshesInBackground(self):
+        cache.reset()
+        cache.make_cache("blob", 10, 10, soft_timeout=5)
+        cache.make_cache("blob_version", 10, 10)
+        cache.run_in_background = lambda f: f()
+        newBlob = createBlob(dict(name="a", schema_version=1, hashFunction="sha256"))
+        try:
+            with mock.patch("time.time") as t:
+                t.return_value = 0
+                self.assertEqual(self.releases.getReleaseBlob(name="a")["hashFunction"], "sha512")
+                # Change the blob without changing its data_version, so that only a refresh will pick it up
+                self.releases.t.update(values=dict(data=newBlob)).where(self.releases.name == "a").execute()
+                t.return_value = 3
+                self.assertEqual(self.releases.getReleaseBlob(name="a")["hashFunction"], "sha512")
+                # After the soft timeout, the cached blob is returned one more time, while it is being refreshed
+                t.return_value = 6
+                self.assertEqual(self.releases.getReleaseBlob(name="a")["hashFunction"], "sha512")
+                t.return_value = 7
+                self.assertEqual(self.releases.getReleaseBlob(name="a")["hashFunction"], "sha256")
+                self._checkCacheStats(cache.caches["blob"], 4, 3, 1)
+        finally:
+            del cache.run_in_background
+
     def testGetReleasesUsesBlobCache(self):
         with mock.patch("time.time") as t:
             t.return_value = 0
@@ -5336,6 +5654,33 @@ class TestPinnableReleases(unittest.TestCase, MemoryDatabaseMixin):
         dbo.releases_json.t.delete().where(dbo.releases_json.name == "Firefox-60.0-build1").execute()
         self.assertEqual(dbo.releases_json.count(where=[dbo.releases_json.name == "Firefox-60.0-build1"]), 0)
 
+    def testGetPinRow(self):
+        self.assertIsNone(self.pinnable_releases.getPinRow("Firefox", "beta", "60."))
+        self.assertFalse(self.pinnable_releases.mappingHasPin("Firefox-60.0-build1"))
+        self.pinnable_releases.insert(changed_by="bob", product="Firefox", version="60.", channel="beta", mapping="Firefox-60.0-build1")
+        self.assertEqual(self.pinnable_releases.getPinRow("Firefox", "beta", "60."), {"mapping": "Firefox-60.0-build1", "data_version": 1})
+        self.assertIsNone(self.pinnable_releases.getPinRow("Firefox", "release", "60."))
+        self.assertTrue(self.pinnable_releases.mappingHasPin("Firefox-60.0-build1"))
+        self.assertFalse(self.pinnable_releases.mappingHasPin("Firefox-60.0-build2"))
+
+
+# Run the same tests with the in-memory copy of the table enabled.
+class TestPinnableReleasesWithSnapshot(TestPinnableReleases):
+    def setUp(self):
+        super(TestPinnableReleasesWithSnapshot, self).setUp()
+        self.pinnable_releases.enableSnapshot(0)
+
+    def testChangesAreNotSeenBeforeRefreshInterval(self):
+        self.pinnable_releases.enableSnapshot(3600)
+        self.assertIsNone(self.pinnable_releases.getPinMapping("Firefox", "beta", "60."))
+        with mock.patch.object(self.pinnable_releases, "select", wraps=self.pinnable_releases.select) as select:
+            self.pinnable_releases.insert(changed_by="bob", product="Firefox", version="60.", channel="beta", mapping="Firefox-60.0-build1")
+            self.assertIsNone(self.pinnable_releases.getPinMapping("Firefox", "beta", "60."))
+            self.assertEqual(select.call_count, 0)
+            self.pinnable_releases.snapshot.invalidate()
+            self.assertEqual(self.pinnable_releases.getPinMapping("Firefox", "beta", "60."), "Firefox-60.0-build1")
+            self.assertEqual(select.call_count, 1)
+
 
 @pytest.mark.usefixtures("current_db_schema")
 class TestPermissions(unittest.TestCase, MemoryDatabaseMixin):
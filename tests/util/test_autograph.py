@@ -0,0 +1,109 @@
+import json
+import threading
+import time
+from base64 import b64encode
+
+import mock
+import pytest
+import requests
+
+import auslib.util.autograph
+from auslib.util.autograph import SigningQueue, get_session, sign_hash, sign_hashes
+
+
+@pytest.fixture
+def autograph(responses):
+    def sign(request):
+        body = json.loads(request.body)
+        return (200, {}, json.dumps([{"signature": f"sig-{item['input']}", "x5u": f"https://x5u/{item['keyid']}"} for item in body]))
+
+    responses.add_callback(responses.POST, "https://autograph/sign/hash", callback=sign)
+    return responses
+
+
+def signature(hash_, keyid="key"):
+    return (f"sig-{b64encode(hash_).decode('ascii')}", f"https://x5u/{keyid}")
+
+
+def test_sign_hashes(autograph):
+    assert sign_hashes("https://autograph", "key", "id", "secret", [b"a", b"b"]) == [signature(b"a"), signature(b"b")]
+    assert len(autograph.calls) == 1
+    assert sign_hash("https://autograph", "key", "id", "secret", b"c") == signature(b"c")
+
+
+def test_session_is_reused(autograph, monkeypatch):
+    monkeypatch.setattr(auslib.util.autograph, "_session_pid", None)
+    with mock.patch("auslib.util.autograph.requests.Session", wraps=requests.Session) as Session:
+        for hash_ in (b"a", b"b"):
+            sign_hash("https://autograph", "key", "id", "secret", hash_)
+        assert get_session() is get_session()
+    assert Session.call_count == 1
+
+
+def test_signing_queue_batches_waiting_hashes(autograph):
+    signing_queue = SigningQueue()
+    first_batch_started = threading.Event()
+    release_first_batch = threading.Event()
+    batch_sizes = []
+
+    def sign_hashes_(*args):
+        batch_sizes.append(len(args[4]))
+        if len(batch_sizes) == 1:
+            first_batch_started.set()
+            release_first_batch.wait()
+        return sign_hashes(*args)
+
+    results = {}
+
+    def sign(hash_, keyid="key"):
+        results[hash_] = signing_queue.sign("https://autograph", keyid, "id", "secret", hash_)
+
+    with mock.patch("auslib.util.autograph.sign_hashes", side_effect=sign_hashes_):
+        threads = [threading.Thread(target=sign, args=(b"a",))]
+        threads[0].start()
+        first_batch_started.wait(5)
+        # Everything that queues up while the first batch is being signed is
+        # signed together, unless it needs a different key.
+        threads.extend(threading.Thread(target=sign, args=args) for args in ((b"b",), (b"c",), (b"d", "otherkey")))
+        for thread in threads[1:]:
+            thread.start()
+        for _ in range(500):
+            if signing_queue._queue.qsize() == 3:
+                break
+            time.sleep(0.01)
+        release_first_batch.set()
+        for thread in threads:
+            thread.join(5)
+
+    assert batch_sizes == [1, 2, 1]
+    assert results == {b"a": signature(b"a"), b"b": signature(b"b"), b"c": signature(b"c"), b"d": signature(b"d", "otherkey")}
+
+
+def test_signing_queue_raises_failures(responses, monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda _: None)
+    responses.add(responses.POST, "https://autograph/sign/hash", status=500)
+    with pytest.raises(requests.HTTPError):
+        SigningQueue().sign("https://autograph", "key", "id", "secret", b"a")
+
+
+def test_signing_queue_signs_directly_after_timeout(autograph):
+    signing_queue = SigningQueue(timeout=0.1)
+    release_thread = threading.Event()
+
+    def stuck(batch):
+        release_thread.wait(5)
+
+    with mock.patch.object(signing_queue, "signBatch", side_effect=stuck) as signBatch, mock.patch("auslib.util.autograph.statsd.incr") as incr:
+        assert signing_queue.sign("https://autograph", "key", "id", "secret", b"a") == signature(b"a")
+        release_thread.set()
+    incr.assert_any_call("autograph.signing_queue.timeout")
+    batch = signBatch.call_args[0][0]
+    assert batch[0].abandoned
+
+
+def test_signing_queue_skips_abandoned_hashes(responses):
+    signing = auslib.util.autograph._Signing(("https://autograph", "key", "id", "secret"), b"a")
+    signing.abandoned = True
+    SigningQueue().signBatch([signing])
+    assert len(responses.calls) == 0
+    assert signing.exception is None
@@ -1,10 +1,17 @@
+import threading
+import time
 import unittest
 
+import fakeredis
 import mock
 import orjson
+from flask import Flask, g
 
 from auslib.blobs.base import Blob, createBlob
-from auslib.util.cache import MaybeCacher, RedisCache, TwoLayerCache
+from auslib.util.cache import MaybeCacher, RedisCache, TwoLayerCache, UwsgiCache, multi_get
+from auslib.util.memo import enable_request_memo
+
+from ..fakes import FakeUwsgi
 
 
 class TestMaybeCacher(unittest.TestCase):
@@ -65,6 +72,185 @@ class TestMaybeCacher(unittest.TestCase):
         cached_obj = cache.get("cache1", "foo")
         self.assertNotEqual(id(obj), id(cached_obj))
 
+    @mock.patch("auslib.util.cache.statsd.incr")
+    def testConcurrentMissesLoadOnce(self, incr):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 5)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def getter():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return [1, 2, 3]
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(cache.get("cache1", "foo", getter)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(cache.get("cache1", "foo", getter))) for _ in range(4)]
+        for t in followers:
+            t.start()
+        # Give the followers a chance to start waiting on the leader
+        while incr.call_args_list.count(mock.call("cache.cache1.coalesced")) < 4:
+            time.sleep(0.001)
+        release.set()
+        for t in [leader] + followers:
+            t.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(cache._loads, {})
+        self.assertEqual(cache.get("cache1", "foo"), [1, 2, 3])
+
+    @mock.patch("auslib.util.cache.statsd.incr")
+    def testConcurrentMissesShareException(self, incr):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 5)
+        started = threading.Event()
+        release = threading.Event()
+
+        def getter():
+            started.set()
+            release.wait(5)
+            raise ValueError("db is down")
+
+        errors = []
+
+        def get():
+            try:
+                cache.get("cache1", "foo", getter)
+            except ValueError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=get)
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=get)
+        follower.start()
+        while incr.call_args_list.count(mock.call("cache.cache1.coalesced")) < 1:
+            time.sleep(0.001)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(cache._loads, {})
+        # Nothing was cached, so the next lookup tries again
+        self.assertEqual(cache.get("cache1", "foo", lambda: "bar"), "bar")
+
+    def testSoftTimeoutRefreshesInBackground(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 10, soft_timeout=5)
+        background = []
+        cache.run_in_background = background.append
+        with mock.patch("time.time") as t:
+            t.return_value = 100
+            self.assertEqual(cache.get("cache1", "foo", lambda: "bar", lambda: "baz"), "bar")
+            # Before the soft timeout, nothing is refreshed
+            t.return_value = 104
+            self.assertEqual(cache.get("cache1", "foo", lambda: "bar", lambda: "baz"), "bar")
+            self.assertEqual(background, [])
+            # After it, we still get the cached value, but a refresh is started,
+            # and only one no matter how many times we get the value.
+            t.return_value = 106
+            self.assertEqual(cache.get("cache1", "foo", lambda: "bar", lambda: "baz"), "bar")
+            self.assertEqual(cache.get("cache1", "foo", lambda: "bar", lambda: "baz"), "bar")
+            self.assertEqual(len(background), 1)
+            background[0]()
+            self.assertEqual(cache.get("cache1", "foo", lambda: "bar", lambda: "baz"), "baz")
+            self.assertEqual(cache._loads, {})
+            # And the refreshed value is good until its own soft timeout.
+            t.return_value = 110
+            self.assertEqual(cache.get("cache1", "foo", lambda: "bar", lambda: "baz"), "baz")
+            self.assertEqual(len(background), 1)
+            self.assertEqual(cache.caches["cache1"].misses, 1)
+
+    def testSoftTimeoutWithoutRefreshGetter(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 10, soft_timeout=5)
+        cache.run_in_background = mock.Mock()
+        with mock.patch("time.time") as t:
+            t.return_value = 100
+            cache.put("cache1", "foo", "bar")
+            t.return_value = 106
+            self.assertEqual(cache.get("cache1", "foo", lambda: "baz"), "bar")
+            # Hard timeouts still apply
+            t.return_value = 111
+            self.assertEqual(cache.get("cache1", "foo", lambda: "baz"), "baz")
+        self.assertFalse(cache.run_in_background.called)
+
+    def testSoftTimeoutRefreshFailureKeepsValue(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 10, soft_timeout=2)
+        cache.run_in_background = lambda f: f()
+
+        def fail():
+            raise ValueError("db is down")
+
+        with mock.patch("time.time") as t:
+            t.return_value = 100
+            cache.put("cache1", "foo", "bar")
+            t.return_value = 103
+            with mock.patch("auslib.util.cache.log") as log:
+                self.assertEqual(cache.get("cache1", "foo", refresh_getter=fail), "bar")
+                self.assertEqual(log.exception.call_count, 1)
+            self.assertEqual(cache.get("cache1", "foo", refresh_getter=lambda: "baz"), "bar")
+            # We try again after another soft_timeout
+            t.return_value = 105
+            self.assertEqual(cache.get("cache1", "foo", refresh_getter=lambda: "baz"), "bar")
+            self.assertEqual(cache.get("cache1", "foo"), "baz")
+
+    def testSoftTimeoutUnknownAgeIsFresh(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 10, soft_timeout=5)
+        cache.run_in_background = mock.Mock()
+        with mock.patch("time.time") as t:
+            t.return_value = 100
+            # Put directly into the underlying cache, like another process sharing it would
+            cache.caches["cache1"].put("foo", "bar")
+            t.return_value = 103
+            self.assertEqual(cache.get("cache1", "foo", refresh_getter=lambda: "baz"), "bar")
+            t.return_value = 107
+            self.assertEqual(cache.get("cache1", "foo", refresh_getter=lambda: "baz"), "bar")
+            self.assertFalse(cache.run_in_background.called)
+            t.return_value = 108
+            self.assertEqual(cache.get("cache1", "foo", refresh_getter=lambda: "baz"), "bar")
+            self.assertTrue(cache.run_in_background.called)
+
+    def testGetMany(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 5)
+        cache.make_cache("cache2", 5, 5)
+        cache.put("cache1", "foo", "bar")
+        values = cache.get_many(
+            [
+                ("cache1", "foo", lambda: "not called"),
+                ("cache2", "foo", lambda: "baz"),
+                ("cache3", "foo", lambda: "uncached"),
+                ("cache1", "missing", None),
+            ]
+        )
+        self.assertEqual(values, ["bar", "baz", "uncached", None])
+        self.assertEqual(cache.get("cache2", "foo"), "baz")
+        self.assertEqual(cache.caches["cache1"].hits, 1)
+        self.assertEqual(cache.caches["cache1"].misses, 1)
+        self.assertEqual(cache.caches["cache2"].misses, 1)
+
+    def testGetManyRefreshes(self):
+        cache = MaybeCacher()
+        cache.make_cache("cache1", 5, 10, soft_timeout=5)
+        cache.run_in_background = lambda f: f()
+        with mock.patch("time.time") as t:
+            t.return_value = 100
+            cache.put("cache1", "foo", "bar")
+            t.return_value = 106
+            self.assertEqual(cache.get_many([("cache1", "foo", None, lambda: "baz")]), ["bar"])
+            self.assertEqual(cache.get("cache1", "foo"), "baz")
+
     def testCopyOnPut(self):
         cache = MaybeCacher()
         cache.make_cache("cache1", 5, 5)
@@ -318,3 +504,332 @@ def test_redis_cache_custom_loads(fake_redis, firefox_100_0_build1):
     assert result["data_version"] == 42
     assert isinstance(result["blob"], Blob)
     assert result["blob"] == blob
+
+
+def test_redis_cache_clear(fake_redis):
+    cache = RedisCache(fake_redis, "test", 30)
+    other = RedisCache(fake_redis, "other", 30)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    other.put("a", 3)
+
+    cache.clear()
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+    assert other.get("a") == 3
+    # Clearing an empty cache is fine too
+    cache.clear()
+
+
+def test_two_layer_cache_load_without_lease(fake_redis):
+    cache = TwoLayerCache(fake_redis, "test", 5, 30)
+    getter = mock.Mock(return_value="value")
+
+    assert cache.load("key", getter) == "value"
+    assert getter.call_count == 1
+    assert fake_redis.keys() == []
+
+
+def test_two_layer_cache_load_takes_and_releases_lease(fake_redis):
+    cache = TwoLayerCache(fake_redis, "test", 5, 30, lease_timeout=5)
+
+    def getter():
+        assert cache._redis_cache.has_lease("key")
+        cache.put("key", "value")
+        return "value"
+
+    assert cache.load("key", getter) == "value"
+    assert not cache._redis_cache.has_lease("key")
+    assert cache.get("key") == "value"
+
+
+def test_two_layer_cache_load_waits_for_lease_holder(fake_redis):
+    holder = TwoLayerCache(fake_redis, "test", 5, 30, lease_timeout=5)
+    waiter = TwoLayerCache(fake_redis, "test", 5, 30, lease_timeout=5)
+    token = holder._redis_cache.acquire_lease("key", 5)
+    getter = mock.Mock(return_value="other value")
+
+    def poll(_):
+        # The lease holder finishes its lookup while we're waiting
+        holder.put("key", "value")
+        holder._redis_cache.release_lease("key", token)
+
+    with mock.patch("time.sleep", side_effect=poll):
+        assert waiter.load("key", getter) == "value"
+
+    assert getter.call_count == 0
+    # And the value we waited for is cached locally, too
+    assert waiter._lru_cache.get("key") == "value"
+
+
+def test_two_layer_cache_load_lease_released_without_value(fake_redis):
+    holder = TwoLayerCache(fake_redis, "test", 5, 30, lease_timeout=5)
+    waiter = TwoLayerCache(fake_redis, "test", 5, 30, lease_timeout=5)
+    token = holder._redis_cache.acquire_lease("key", 5)
+    getter = mock.Mock(return_value="value")
+
+    # The lease holder failed to look the value up, so we do it ourselves
+    with mock.patch("time.sleep", side_effect=lambda _: holder._redis_cache.release_lease("key", token)) as sleep:
+        assert waiter.load("key", getter) == "value"
+
+    assert sleep.call_count == 1
+    assert getter.call_count == 1
+
+
+def test_two_layer_cache_load_lease_times_out(fake_redis):
+    holder = TwoLayerCache(fake_redis, "test", 5, 30, lease_timeout=5)
+    waiter = TwoLayerCache(fake_redis, "test", 5, 30, lease_timeout=0.2)
+    # The lease holder is stuck, so we give up on it after our lease_timeout
+    holder._redis_cache.acquire_lease("key", 60)
+    getter = mock.Mock(return_value="value")
+
+    assert waiter.load("key", getter) == "value"
+
+    assert getter.call_count == 1
+
+
+def test_redis_cache_release_lease_only_releases_own_lease(fake_redis):
+    cache = RedisCache(fake_redis, "test", 30)
+    token = cache.acquire_lease("key", 5)
+    assert token
+    assert cache.acquire_lease("key", 5) is None
+
+    cache.release_lease("key", "someone else's token")
+    assert cache.has_lease("key")
+    cache.release_lease("key", token)
+    assert not cache.has_lease("key")
+
+
+def test_two_layer_cache_get_many(fake_redis):
+    cache = TwoLayerCache(fake_redis, "test", 5, 30)
+    cache.put("in_memory", "value1")
+    fake_redis.setex("v2-test-in_redis", 30, orjson.dumps("value2"))
+
+    with mock.patch.object(fake_redis, "pipeline", wraps=fake_redis.pipeline) as pipeline:
+        assert cache.get_many(["in_memory", "in_redis", "missing"], "default") == ["value1", "value2", "default"]
+        # Only the keys that weren't in memory were looked up in Redis, all at once
+        assert pipeline.call_count == 1
+
+    assert cache.lookups == 3
+    assert cache.hits == 2
+    assert cache.misses == 1
+    assert cache._redis_cache.lookups == 2
+    assert cache._redis_cache.hits == 1
+    # And the value from Redis is now in memory, with Redis' timeout
+    assert cache._lru_cache.get("in_redis") == "value2"
+    assert 28 <= cache._lru_cache.data["in_redis"][2] - time.time() <= 30
+
+
+def test_multi_get_pipelines_caches_sharing_redis(fake_redis, firefox_100_0_build1):
+    other_redis = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    cache1 = TwoLayerCache(fake_redis, "cache1", 5, 30)
+    cache2 = TwoLayerCache(fake_redis, "cache2", 5, 30, lambda data: createBlob(data))
+    cache3 = TwoLayerCache(other_redis, "cache3", 5, 30)
+    lru = MaybeCacher().factory("lru", 5, 30)
+    fake_redis.setex("v2-cache1-foo", 30, orjson.dumps("bar"))
+    fake_redis.setex("v2-cache2-foo", 30, orjson.dumps(firefox_100_0_build1))
+    other_redis.setex("v2-cache3-foo", 30, orjson.dumps("baz"))
+    lru.put("foo", "qux")
+
+    with mock.patch.object(fake_redis, "pipeline", wraps=fake_redis.pipeline) as pipeline, mock.patch.object(
+        other_redis, "pipeline", wraps=other_redis.pipeline
+    ) as other_pipeline:
+        values = multi_get([(cache1, "foo"), (cache2, "foo"), (cache3, "foo"), (lru, "foo"), (cache1, "missing")])
+        assert pipeline.call_count == 1
+        assert other_pipeline.call_count == 1
+
+    assert values[0] == "bar"
+    assert isinstance(values[1], Blob)
+    assert values[1] == createBlob(firefox_100_0_build1)
+    assert values[2:] == ["baz", "qux", None]
+    assert (cache1.lookups, cache1.hits, cache1.misses) == (2, 1, 1)
+
+
+def test_unshared_cache_stays_in_memory(fake_redis):
+    cache = MaybeCacher()
+    cache.factory = lambda name, maxsize, timeout, post_load=None: TwoLayerCache(fake_redis, name, maxsize, timeout, post_load)
+    cache.make_cache("shared", 5, 30)
+    cache.make_cache("unshared", 5, 30, shared=False)
+    value = object()
+
+    cache.put("shared", "foo", "bar")
+    cache.put("unshared", "foo", value)
+
+    assert isinstance(cache.caches["shared"], TwoLayerCache)
+    assert not isinstance(cache.caches["unshared"], TwoLayerCache)
+    assert cache.get("unshared", "foo") is value
+    assert cache.get_many([("shared", "foo", None), ("unshared", "foo", None)]) == ["bar", value]
+    assert fake_redis.keys("v2-unshared-*") == []
+
+
+def test_uwsgi_cache():
+    uwsgi = FakeUwsgi()
+    cache = UwsgiCache(uwsgi, "balrog", "test", 30)
+    blobs = UwsgiCache(uwsgi, "balrog", "blobs", 30, lambda data: createBlob(data))
+
+    assert cache.get("key", "default") == "default"
+    cache.put("key", {"a": 1})
+    blobs.put("key", {"name": "a", "schema_version": 1})
+    assert cache.get("key") == {"a": 1}
+    assert isinstance(blobs.get("key"), Blob)
+    # Other processes see the same values
+    assert UwsgiCache(uwsgi, "balrog", "test", 30).get("key") == {"a": 1}
+    assert (cache.lookups, cache.hits, cache.misses) == (2, 1, 1)
+
+    cache.invalidate("key")
+    assert cache.get("key") is None
+
+    cache.put("key", {"a": 2})
+    with mock.patch("time.time", return_value=time.time() + 31):
+        assert cache.get("key") is None
+
+
+def test_uwsgi_cache_clear():
+    uwsgi = FakeUwsgi()
+    cache = UwsgiCache(uwsgi, "balrog", "test", 30)
+    other = UwsgiCache(uwsgi, "balrog", "other", 30)
+    cache.put("key", 1)
+    other.put("key", 2)
+
+    UwsgiCache(uwsgi, "balrog", "test", 30).clear()
+
+    assert cache.get("key") is None
+    assert other.get("key") == 2
+    cache.put("key", 3)
+    assert cache.get("key") == 3
+
+
+def test_uwsgi_cache_keeps_parsed_values():
+    uwsgi = FakeUwsgi()
+    post_load = mock.Mock(side_effect=lambda data: data)
+    cache = UwsgiCache(uwsgi, "balrog", "test", 30, post_load)
+    other = UwsgiCache(uwsgi, "balrog", "test", 30, post_load)
+    cache.put("key", {"a": 1})
+
+    with mock.patch("auslib.util.cache.orjson.loads", wraps=orjson.loads) as loads:
+        assert cache.get("key") == {"a": 1}
+        assert cache.get("key") == {"a": 1}
+        assert cache.get("key") is cache.get("key")
+        assert loads.call_count == 1
+        assert post_load.call_count == 1
+
+        # Changes made by other processes are still seen
+        other.put("key", {"a": 2})
+        assert cache.get("key") == {"a": 2}
+        other.invalidate("key")
+        assert cache.get("key") is None
+        other.put("key", {"a": 3})
+        other.clear()
+        assert cache.get("key") is None
+        assert loads.call_count == 2
+
+
+def test_uwsgi_cache_looks_up_generation_once_per_request():
+    uwsgi = FakeUwsgi()
+    cache = UwsgiCache(uwsgi, "balrog", "test", 30)
+    other = UwsgiCache(uwsgi, "balrog", "test", 30)
+    cache.put("key", {"a": 1})
+    cache.get("key")
+
+    with Flask(__name__).app_context():
+        g.statsd = mock.Mock()
+        enable_request_memo()
+        with mock.patch.object(uwsgi, "cache_get", wraps=uwsgi.cache_get) as cache_get:
+            for _ in range(3):
+                assert cache.get("key") == {"a": 1}
+        # One lookup of the generation, and one of the stamp for each get
+        assert cache_get.call_count == 4
+        # A clear from another worker takes effect from the next request on
+        other.clear()
+        assert cache.get("key") == {"a": 1}
+
+    with Flask(__name__).app_context():
+        g.statsd = mock.Mock()
+        enable_request_memo()
+        assert cache.get("key") is None
+
+
+def test_uwsgi_cache_value_too_big():
+    cache = UwsgiCache(FakeUwsgi(max_item_size=10), "balrog", "test", 30)
+    with mock.patch("auslib.util.cache.statsd.incr") as incr:
+        cache.put("key", "x" * 20)
+
+    assert cache.get("key") is None
+    incr.assert_called_once_with("cache.test.not_stored")
+
+
+def test_uwsgi_cache_as_factory():
+    uwsgi = FakeUwsgi()
+    cache = MaybeCacher()
+    cache.factory = lambda name, maxsize, timeout, post_load=None: UwsgiCache(uwsgi, "balrog", name, timeout, post_load)
+    cache.make_cache("test", 5, 30)
+    getter = mock.Mock(return_value="value")
+
+    assert cache.get("test", "key", getter) == "value"
+    assert cache.get("test", "key", getter) == "value"
+    assert cache.get_many([("test", "key", getter), ("test", "missing", None)]) == ["value", None]
+    assert getter.call_count == 1
+
+
+def test_uwsgi_cache_load_takes_and_releases_lease():
+    uwsgi = FakeUwsgi()
+    cache = UwsgiCache(uwsgi, "balrog", "test", 30, lease_timeout=5)
+
+    def getter():
+        assert uwsgi.cache_exists(cache.leasekey("key"), "balrog")
+        cache.put("key", "value")
+        return "value"
+
+    assert cache.load("key", getter) == "value"
+    assert not uwsgi.cache_exists(cache.leasekey("key"), "balrog")
+    assert cache.get("key") == "value"
+
+
+def test_uwsgi_cache_load_waits_for_lease_holder():
+    uwsgi = FakeUwsgi()
+    holder = UwsgiCache(uwsgi, "balrog", "test", 30, lease_timeout=5)
+    waiter = UwsgiCache(uwsgi, "balrog", "test", 30, lease_timeout=5)
+    getter = mock.Mock(return_value="other value")
+
+    def slow_getter():
+        with mock.patch("time.sleep", side_effect=lambda _: holder.put("key", "value")):
+            # Another worker asks for the key while we're looking it up
+            assert waiter.load("key", getter) == "value"
+        return "value"
+
+    assert holder.load("key", slow_getter) == "value"
+    assert getter.call_count == 0
+
+
+def test_uwsgi_cache_load_lease_released_without_value():
+    uwsgi = FakeUwsgi()
+    holder = UwsgiCache(uwsgi, "balrog", "test", 30, lease_timeout=5)
+    waiter = UwsgiCache(uwsgi, "balrog", "test", 30, lease_timeout=5)
+    getter = mock.Mock(return_value="value")
+    uwsgi.cache_set(holder.leasekey("key"), b"token", 5, "balrog")
+
+    # The lease holder failed to look the value up, so we do it ourselves
+    with mock.patch("time.sleep", side_effect=lambda _: uwsgi.cache_del(holder.leasekey("key"), "balrog")) as sleep:
+        assert waiter.load("key", getter) == "value"
+
+    assert sleep.call_count == 1
+    assert getter.call_count == 1
+
+
+def test_two_layer_cache_local_only(fake_redis):
+    cache = MaybeCacher()
+    cache.factory = lambda name, maxsize, timeout, post_load=None: TwoLayerCache(fake_redis, name, maxsize, timeout, post_load)
+    cache.make_cache("foo", 10, 60)
+    cache.put("foo", "a", 1)
+    cache.put("foo", "b", 2)
+
+    cache.invalidate("foo", "a", local_only=True)
+    cache.clear("foo", local_only=True)
+    assert cache.caches["foo"]._lru_cache.get("a") is None
+    assert cache.caches["foo"]._lru_cache.get("b") is None
+    assert len(fake_redis.keys("v2-foo-*")) == 2
+
+    cache.invalidate("foo", "a")
+    assert cache.get("foo", "a") is None
+    cache.clear()
+    assert fake_redis.keys("v2-foo-*") == []
@@ -0,0 +1,250 @@
+import json
+import time
+
+import mock
+import pytest
+from flask import Flask
+
+from auslib.util.cache import MaybeCacher, TwoLayerCache
+from auslib.util.invalidation import ChangePublisher, ChangeSubscriber, subscribe_in_each_process
+
+
+@pytest.fixture
+def cache(fake_redis):
+    cache = MaybeCacher()
+    cache.factory = lambda name, maxsize, timeout, post_load=None: TwoLayerCache(fake_redis, name, maxsize, timeout, post_load)
+    for name in (
+        "blob",
+        "blob_version",
+        "releases",
+        "releases_data_version",
+        "release_assets",
+        "release_assets_data_versions",
+        "release_assets_index",
+        "release_assets_by_path",
+        "rules",
+        "updates_disabled",
+    ):
+        cache.make_cache(name, 10, 60)
+    return cache
+
+
+@pytest.fixture
+def dbo():
+    return mock.Mock()
+
+
+def local(cache, name, key):
+    """Returns this process's copy of a cached value, without looking in Redis."""
+    return cache.caches[name]._lru_cache.get(key)
+
+
+def message(table, primary_key, data_version=1):
+    return {"type": "message", "data": json.dumps({"table": table, "primary_key": primary_key, "data_version": data_version}).encode()}
+
+
+def test_publish(fake_redis):
+    pubsub = fake_redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe("balrog-changes")
+    ChangePublisher(fake_redis).publish("rules", {"rule_id": 1}, 2)
+    msg = None
+    for _ in range(100):
+        msg = pubsub.get_message(timeout=0.01)
+        if msg:
+            break
+    assert json.loads(msg["data"]) == {"table": "rules", "primary_key": {"rule_id": 1}, "data_version": 2}
+
+
+def test_publish_failures_are_counted(fake_redis):
+    publisher = ChangePublisher(fake_redis)
+    with mock.patch.object(fake_redis, "publish", side_effect=ConnectionError()), mock.patch("auslib.util.invalidation.statsd") as statsd:
+        publisher.publish("rules", {"rule_id": 1}, 2)
+    statsd.incr.assert_called_once_with("invalidation.publish_failed")
+
+
+def test_publish_expires_shared_entries(cache, fake_redis):
+    for name in ("Firefox-60.0-build1", "Firefox-61.0-build1"):
+        cache.put("releases", name, {"data_version": 1})
+        cache.put("releases_data_version", name, 1)
+    cache.put("rules", "a:b:None:None:None", [])
+    cache.put("updates_disabled", ("Firefox", "release"), False)
+
+    publisher = ChangePublisher(fake_redis)
+    publisher.publish("releases_json", {"name": "Firefox-60.0-build1"}, 2)
+    publisher.publish("emergency_shutoffs", {"product": "Firefox", "channel": "release"}, 1)
+    assert fake_redis.get("v2-releases-Firefox-60.0-build1") is None
+    assert fake_redis.get("v2-releases_data_version-Firefox-60.0-build1") is None
+    assert fake_redis.get("v2-releases-Firefox-61.0-build1") is not None
+    assert fake_redis.keys("v2-updates_disabled-*") == []
+    assert fake_redis.keys("v2-rules-*") != []
+
+    publisher.publish("rules", {"rule_id": 4}, 2)
+    assert fake_redis.keys("v2-rules-*") == []
+
+
+def test_lookup_that_overlaps_a_publish_is_not_stored(cache, fake_redis):
+    publisher = ChangePublisher(fake_redis)
+    name = "Firefox-60.0-build1"
+
+    def lookup_during_change(table, primary_key, value):
+        def lookup():
+            # The value was read before the change was committed and published...
+            publisher.publish(table, primary_key, 2)
+            return value
+
+        return lookup
+
+    assert cache.get("releases", name, lookup_during_change("releases_json", {"name": name}, {"data_version": 1})) == {"data_version": 1}
+    # ...so it isn't stored, where it would have outlived the change.
+    assert fake_redis.get(f"v2-releases-{name}") is None
+    assert local(cache, "releases", name) is None
+    assert cache.get("releases", name, lambda: {"data_version": 2}) == {"data_version": 2}
+    assert cache.get("releases", name, lambda: {"data_version": 3}) == {"data_version": 2}
+    assert fake_redis.get(f"v2-releases-{name}") is not None
+
+    # Changes that make a whole cache stale count too.
+    assert cache.get("rules", "a:b", lookup_during_change("rules", {"rule_id": 1}, [1])) == [1]
+    assert fake_redis.get("v2-rules-a:b") is None
+    assert cache.get("rules", "a:b", lambda: [2]) == [2]
+    assert fake_redis.get("v2-rules-a:b") is not None
+
+
+def test_release_json_change(cache, dbo):
+    for name in ("Firefox-60.0-build1", "Firefox-61.0-build1"):
+        cache.put("releases", name, {"data_version": 1})
+        cache.put("releases_data_version", name, 1)
+
+    ChangeSubscriber(None, cache, dbo).handle(message("releases_json", {"name": "Firefox-60.0-build1"}, 2))
+
+    assert local(cache, "releases", "Firefox-60.0-build1") is None
+    assert local(cache, "releases_data_version", "Firefox-60.0-build1") is None
+    assert local(cache, "releases", "Firefox-61.0-build1") == {"data_version": 1}
+    assert local(cache, "releases_data_version", "Firefox-61.0-build1") == 1
+    # The publisher takes care of what's shared in Redis
+    assert cache.get("releases_data_version", "Firefox-60.0-build1") == 1
+
+
+def test_release_asset_change(cache, dbo):
+    name = "Firefox-60.0-build1"
+    for cache_name in ("release_assets", "release_assets_data_versions", "release_assets_index"):
+        cache.put(cache_name, name, [])
+    cache.put("release_assets_by_path", f"{name}:.platforms.p.locales.de", {"data_version": 1})
+    cache.put("release_assets_by_path", f"{name}:.platforms.p.locales.en-US", {"data_version": 1})
+
+    ChangeSubscriber(None, cache, dbo).handle(message("release_assets", {"name": name, "path": ".platforms.p.locales.de"}, 2))
+
+    for cache_name in ("release_assets", "release_assets_data_versions", "release_assets_index"):
+        assert local(cache, cache_name, name) is None
+    assert local(cache, "release_assets_by_path", f"{name}:.platforms.p.locales.de") is None
+    assert local(cache, "release_assets_by_path", f"{name}:.platforms.p.locales.en-US") == {"data_version": 1}
+
+
+def test_legacy_release_change(cache, dbo):
+    cache.put("blob", "b", {"data_version": 1})
+    cache.put("blob_version", "b", 1)
+
+    ChangeSubscriber(None, cache, dbo).handle(message("releases", {"name": "b"}, None))
+
+    assert local(cache, "blob", "b") is None
+    assert local(cache, "blob_version", "b") is None
+
+
+def test_rule_change(cache, dbo, fake_redis):
+    cache.put("rules", "a:b:None:None:None", [])
+    cache.put("rules", "a:c:None:None:None", [])
+    cache.put("releases", "a", {"data_version": 1})
+
+    ChangeSubscriber(None, cache, dbo).handle(message("rules", {"rule_id": 4}, 2))
+
+    assert local(cache, "rules", "a:b:None:None:None") is None
+    assert local(cache, "rules", "a:c:None:None:None") is None
+    # Every process that gets the change doesn't wipe the shared cache
+    assert len(fake_redis.keys("v2-rules-*")) == 2
+    assert local(cache, "releases", "a") == {"data_version": 1}
+    dbo.rules.index.invalidate.assert_called_once_with()
+
+
+def test_emergency_shutoff_change(cache, dbo):
+    cache.put("updates_disabled", ("Firefox", "release"), False)
+    cache.put("updates_disabled", ("Firefox", "beta"), False)
+
+    ChangeSubscriber(None, cache, dbo).handle(message("emergency_shutoffs", {"product": "Firefox", "channel": "release"}))
+
+    assert local(cache, "updates_disabled", ("Firefox", "release")) is None
+    assert local(cache, "updates_disabled", ("Firefox", "beta")) is False
+    dbo.emergencyShutoffs.snapshot.invalidate.assert_called_once_with()
+
+
+def test_pin_change(cache, dbo):
+    ChangeSubscriber(None, cache, dbo).handle(message("pinnable_releases", {"product": "Firefox", "channel": "release", "version": "60."}))
+
+    dbo.pinnable_releases.snapshot.invalidate.assert_called_once_with()
+
+
+def test_malformed_and_unknown_changes_are_ignored(cache, dbo):
+    cache.put("releases", "a", {"data_version": 1})
+    subscriber = ChangeSubscriber(None, cache, dbo)
+
+    subscriber.handle({"type": "message", "data": b"not json"})
+    subscriber.handle({"type": "message", "data": b'{"table": "rules"}'})
+    subscriber.handle(message("permissions", {"permission": "admin", "username": "bob"}))
+
+    assert cache.get("releases", "a") == {"data_version": 1}
+    assert not dbo.rules.index.invalidate.called
+
+
+def test_subscriber_receives_published_changes(cache, dbo, fake_redis):
+    cache.put("releases", "a", {"data_version": 1})
+    subscriber = ChangeSubscriber(fake_redis, cache, dbo)
+    subscriber.start()
+
+    publisher = ChangePublisher(fake_redis)
+    for _ in range(100):
+        publisher.publish("releases_json", {"name": "a"}, 2)
+        if cache.get("releases", "a") is None:
+            break
+        time.sleep(0.01)
+
+    assert cache.get("releases", "a") is None
+
+
+def test_subscriber_clears_everything_after_reconnecting(cache, dbo):
+    cache.put("releases", "a", {"data_version": 1})
+    redis = mock.Mock()
+    pubsub = redis.pubsub.return_value
+    pubsub.listen.side_effect = [ConnectionError(), [], KeyboardInterrupt()]
+    subscriber = ChangeSubscriber(redis, cache, dbo, retry_interval=0)
+
+    # The first connection fails, and nothing is cleared until the next one
+    with pytest.raises(KeyboardInterrupt):
+        with mock.patch.object(subscriber, "invalidateEverything", wraps=subscriber.invalidateEverything) as invalidate:
+            subscriber.run()
+
+    assert invalidate.call_count == 2
+    assert dbo.emergencyShutoffs.snapshot.invalidate.call_count == 2
+    assert dbo.pinnable_releases.snapshot.invalidate.call_count == 2
+    assert pubsub.subscribe.call_count == 3
+    assert local(cache, "releases", "a") is None
+    # Only this process's copies are dropped, so that every process reconnecting
+    # at once doesn't send them all to the database.
+    assert cache.get("releases", "a") == {"data_version": 1}
+
+
+def test_subscriber_runs_in_each_process_that_serves_requests(cache, dbo, fake_redis):
+    app = Flask(__name__)
+    app.add_url_rule("/", "index", lambda: "ok")
+    with mock.patch("auslib.util.invalidation.ChangeSubscriber") as Subscriber:
+        subscribe_in_each_process(app, fake_redis, cache, dbo)
+        # Nothing runs in the process that loads the app...
+        assert not Subscriber.called
+
+        # ...but the first request that each process serves starts one.
+        client = app.test_client()
+        for _ in range(2):
+            assert client.get("/").status_code == 200
+        Subscriber.assert_called_once_with(fake_redis, cache, dbo)
+        assert Subscriber.return_value.start.call_count == 1
+
+        with mock.patch("auslib.util.invalidation.os.getpid", return_value=-1):
+            client.get("/")
+        assert Subscriber.return_value.start.call_count == 2
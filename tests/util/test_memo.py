@@ -0,0 +1,51 @@
+import mock
+from flask import Flask, g
+
+from auslib.util.memo import enable_request_memo, memoize, memoize_many
+
+
+def test_memoize_without_request():
+    getter = mock.Mock(return_value=1)
+    assert memoize("thing", "a", getter) == 1
+    assert memoize("thing", "a", getter) == 1
+    assert getter.call_count == 2
+
+
+def test_memoize_without_memo():
+    getter = mock.Mock(return_value=1)
+    with Flask(__name__).app_context():
+        memoize("thing", "a", getter)
+        memoize("thing", "a", getter)
+    assert getter.call_count == 2
+
+
+def test_memoize():
+    getter = mock.Mock(side_effect=[None, 2, 3])
+    with Flask(__name__).app_context():
+        g.statsd = mock.Mock()
+        enable_request_memo()
+        # Falsy values are memoized too
+        assert memoize("thing", "a", getter) is None
+        assert memoize("thing", "a", getter) is None
+        assert memoize("thing", "b", getter) == 2
+        assert memoize("other", "a", getter) == 3
+        assert getter.call_count == 3
+        g.statsd.incr.assert_called_once_with("memo.thing.saved")
+
+        # A new memo starts out empty
+        enable_request_memo()
+        getter.side_effect = [4]
+        assert memoize("thing", "a", getter) == 4
+
+
+def test_memoize_many():
+    getter = mock.Mock(side_effect=lambda keys: [key.upper() for key in keys])
+    assert memoize_many("thing", ["a", "b"], getter) == ["A", "B"]
+    with Flask(__name__).app_context():
+        g.statsd = mock.Mock()
+        enable_request_memo()
+        assert memoize_many("thing", ["a", "b", "a"], getter) == ["A", "B", "A"]
+        assert memoize_many("thing", ["c", "b"], getter) == ["C", "B"]
+        assert memoize("thing", "c", getter) == "C"
+        assert getter.mock_calls[1:] == [mock.call(["a", "b"]), mock.call(["c"])]
+        assert g.statsd.incr.mock_calls == [mock.call("memo.thing.saved", 1), mock.call("memo.thing.saved", 1), mock.call("memo.thing.saved")]
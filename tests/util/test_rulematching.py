@@ -1,6 +1,19 @@
+import itertools
 import unittest
 
-from auslib.util.rulematching import matchMemory, matchVersion
+from auslib.errors import BadDataError
+from auslib.util.rulematching import (
+    CompiledRule,
+    matchBoolean,
+    matchBuildID,
+    matchChannel,
+    matchCsv,
+    matchLocale,
+    matchMemory,
+    matchSimpleExpression,
+    matchVersion,
+)
+from auslib.util.versions import LooseVersion, MozillaVersion
 
 
 class TestMatchMemory(unittest.TestCase):
@@ -34,3 +47,76 @@ class TestMatchVersion(unittest.TestCase):
         self.assertTrue(matchVersion("78.*", "78.8.0"))
         self.assertTrue(matchVersion("78.*", "78.9.0"))
         self.assertFalse(matchVersion("79.*", "78.9.0"))
+
+
+class TestCompiledRule(unittest.TestCase):
+    def _matchesUncompiled(self, rule, query, fallbackChannel, versionClass):
+        return (
+            matchChannel(rule.get("channel"), query["channel"], fallbackChannel)
+            and matchVersion(rule.get("version"), query["version"], versionClass)
+            and matchBuildID(rule.get("buildID"), query.get("buildID", ""))
+            and matchMemory(rule.get("memory"), query.get("memory"))
+            and matchSimpleExpression(rule.get("osVersion"), query.get("osVersion", ""))
+            and matchCsv(rule.get("instructionSet"), query.get("instructionSet", ""), substring=False)
+            and matchCsv(rule.get("distribution"), query.get("distribution", ""), substring=False)
+            and matchLocale(rule.get("locale"), query.get("locale", ""))
+            and matchBoolean(rule.get("mig64"), query.get("mig64"))
+            and matchBoolean(rule.get("jaws"), query.get("jaws"))
+        )
+
+    def test_same_results_as_match_functions(self):
+        rule_values = dict(
+            channel=[None, "release", "release*", "rel*", "r*", "re.ase*", "release-cck-*"],
+            version=[None, "78.0", ">=78.0", "<78.0.1", "78.*", "77.0,78.0.1", ">79.0"],
+            buildID=[None, "20200101000000", ">=20200101000000", "<20200101000000"],
+            memory=[None, "<2048", ">=2048", "4096"],
+            osVersion=[None, "Windows_NT 6.1", "Darwin 17,Windows_NT 5", "Windows_NT && AMD"],
+            locale=[None, "de", "de,en-US", "en"],
+            mig64=[None, True, False],
+        )
+        query_values = dict(
+            channel=["release", "release-cck-foo", "beta", "r"],
+            version=["78.0", "78.0.1", "79.0", "77.0"],
+            buildID=["20190101000000", "20200101000000", "20210101000000"],
+            memory=[None, "1024", "8192", "garbage"],
+            osVersion=["Windows_NT 6.1.0.0 (x64)", "Windows_NT 5.1 AMD", "Darwin 17.7.0", ""],
+            locale=["de", "en-US", "en"],
+            mig64=[None, True, False],
+        )
+        for column, values in rule_values.items():
+            for rule_value, query_value in itertools.product(values, query_values[column]):
+                rule = dict(channel="release", version="78.0", buildID=None, memory=None, osVersion=None, locale=None, mig64=None)
+                query = dict(channel="release", version="78.0", buildID="20200101000000", memory=None, osVersion="", locale="de", mig64=None)
+                rule[column] = rule_value
+                query[column] = query_value
+                fallbackChannel = query["channel"].split("-cck-")[0]
+                self.assertEqual(
+                    CompiledRule(rule).matchesQuery(query, fallbackChannel, MozillaVersion),
+                    bool(self._matchesUncompiled(rule, query, fallbackChannel, MozillaVersion)),
+                    (rule, query),
+                )
+
+    def test_loose_version(self):
+        rule = CompiledRule(version=">=1.10")
+        self.assertTrue(rule.matchesQuery(dict(channel="release", version="1.10.1"), "release", LooseVersion))
+        self.assertFalse(rule.matchesQuery(dict(channel="release", version="1.9"), "release", LooseVersion))
+
+    def test_find_mismatch(self):
+        rule = CompiledRule(channel="release", locale="de,fr", jaws=True)
+        self.assertEqual(rule.findMismatch(dict(channel="beta", version="1.0", locale="de"), "beta"), "channel")
+        self.assertEqual(rule.findMismatch(dict(channel="release", version="1.0", locale="en-US"), "release"), "jaws")
+        self.assertEqual(rule.findMismatch(dict(channel="release", version="1.0", locale="en-US", jaws=True), "release"), "locale")
+        self.assertIsNone(rule.findMismatch(dict(channel="release", version="1.0", locale="de", jaws=True), "release"))
+
+    def test_invalid_version_raises_when_channel_matches(self):
+        rule = CompiledRule(channel="release", version="<78.0", locale="de")
+        self.assertEqual(rule.findMismatch(dict(channel="beta", version="bogus", locale="de"), "beta"), "channel")
+        # The version is compared before any other column can rule the Rule out
+        with self.assertRaises(BadDataError):
+            rule.findMismatch(dict(channel="release", version="bogus", locale="fr"), "release")
+
+    def test_uncompilable_operator_raises_when_matched(self):
+        # get_op can't make sense of "=", and neither can matchBuildID
+        rule = CompiledRule(buildID="=20200101000000")
+        with self.assertRaises(TypeError):
+            rule.matchesQuery(dict(channel="release", version="1.0", buildID="20200101000000"), "release")
@@ -1,7 +1,7 @@
 import unittest
 
 from auslib.errors import BadDataError
-from auslib.util.versions import MozillaVersion, PinVersion
+from auslib.util.versions import LooseVersion, MozillaVersion, PinVersion, StrictVersion
 
 
 class TestMozillaVersions(unittest.TestCase):
@@ -191,3 +191,54 @@ class TestMozillaVersions(unittest.TestCase):
         self.comprehensive_assert_greater(version, MozillaVersion("1.5.0.1"))
         self.comprehensive_assert_greater(version, MozillaVersion("1.5.0.1rc1"))
         self.comprehensive_assert_greater(version, MozillaVersion("3.6.3plugin1"))
+
+    def test_interned(self):
+        self.assertIs(MozillaVersion("102.0a1"), MozillaVersion("102.0a1"))
+        self.assertIs(MozillaVersion("1.5.0.12"), MozillaVersion("1.5.0.12"))
+        self.assertIs(PinVersion("102."), PinVersion("102."))
+        self.assertIs(LooseVersion("2.10.1"), LooseVersion("2.10.1"))
+        # Equal versions with different strings are still different objects
+        self.assertIsNot(MozillaVersion("102.0"), MozillaVersion("102.0.0"))
+        self.assertEqual(MozillaVersion("102.0"), MozillaVersion("102.0.0"))
+
+    def test_unparsed_not_interned(self):
+        version = StrictVersion()
+        version.parse("1.0")
+        self.assertIsNot(StrictVersion(), version)
+        other = StrictVersion()
+        other.parse("2.0")
+        self.assertEqual(str(version), "1.0")
+        self.assertEqual(str(other), "2.0")
+        self.assertIsNot(LooseVersion(), LooseVersion())
+
+    def test_immutable(self):
+        version = MozillaVersion("102.0")
+        with self.assertRaises(AttributeError):
+            version.version = (103, 0, 0)
+        with self.assertRaises(AttributeError):
+            version.foo = 1
+        with self.assertRaises(AttributeError):
+            del version.prerelease
+        self.assertEqual(version.version, (102, 0, 0))
+
+    def test_sort_key_agrees_with_cmp(self):
+        versions = [MozillaVersion(v) for v in ("1.5.0.12", "3.6.3plugin1", "3.6.3", "4.0", "60.0a1", "60.0a2", "60.0", "60.0.1", "60.1a1", "61.0", "100.0")]
+        for i, a in enumerate(versions):
+            for j, b in enumerate(versions):
+                self.assertEqual(a._cmp(b), (i > j) - (i < j), "{} vs {}".format(a, b))
+                self.assertEqual((a > b) - (a < b), (i > j) - (i < j), "{} vs {}".format(a, b))
+        self.assertEqual(sorted(reversed(versions)), versions)
+
+    def test_compare_unparsed(self):
+        with self.assertRaisesRegex(ValueError, "before a version has been parsed"):
+            StrictVersion() < StrictVersion("60.0")
+        with self.assertRaisesRegex(ValueError, "before a version has been parsed"):
+            StrictVersion("60.0") == StrictVersion()
+        with self.assertRaisesRegex(ValueError, "before a version has been parsed"):
+            LooseVersion() > LooseVersion("2.10.1")
+
+    def test_loose(self):
+        self.comprehensive_assert_less(LooseVersion("2.9"), LooseVersion("2.10"))
+        self.comprehensive_assert_equal(LooseVersion("2.10.1"), LooseVersion("2.10.1"))
+        self.comprehensive_assert_greater(LooseVersion("2.10.1"), "2.10")
+        self.assertEqual(LooseVersion("1.0a2").version, (1, 0, "a", 2))
@@ -1,9 +1,11 @@
 # coding: latin-1
+import hashlib
 import logging
 import os
 import time
 import unittest
 from contextlib import ExitStack
+from copy import deepcopy
 from tempfile import mkstemp
 from xml.dom import minidom
 
@@ -17,6 +19,7 @@ from requests import HTTPError
 import auslib.services.releases as releases_service
 import auslib.web.public.client as client_api
 from auslib.blobs.base import createBlob
+from auslib.db import AUSTable
 from auslib.errors import BadDataError
 from auslib.global_state import cache, dbo
 from auslib.util.cache import TwoLayerCache
@@ -28,22 +31,28 @@ def setUpModule():
     logging.getLogger("migrate").setLevel(logging.CRITICAL)
 
 
-def validate_cache_stats(lookups, hits, misses, data_version_lookups, data_version_hits, data_version_misses, mocked_incr):
-    for cache_name in ("releases", "release_assets"):
+def validate_cache_stats(lookups, hits, misses, data_version_lookups, data_version_hits, data_version_misses, mocked_incr, releases_per_cache):
+    """Checks the cache stats, given the lookups/hits/misses for each Release that
+    was looked at, and the number of Releases that were looked at through each cache."""
+    for cache_name, data_version_cache_name in (
+        ("releases", "releases_data_version"),
+        ("release_assets", "release_assets_data_versions"),
+        ("release_assets_by_path", "release_assets_index"),
+    ):
+        count = releases_per_cache[cache_name]
         c = cache.caches[cache_name]
-        assert c.lookups == lookups, cache_name
-        assert c.hits == hits, cache_name
-        assert c.misses == misses, cache_name
-        mocked_incr.assert_has_calls([mock.call(f"cache.{cache_name}.hits")] * hits, any_order=True)
-        mocked_incr.assert_has_calls([mock.call(f"cache.{cache_name}.misses")] * misses, any_order=True)
+        assert c.lookups == lookups * count, cache_name
+        assert c.hits == hits * count, cache_name
+        assert c.misses == misses * count, cache_name
+        mocked_incr.assert_has_calls([mock.call(f"cache.{cache_name}.hits")] * hits * count, any_order=True)
+        mocked_incr.assert_has_calls([mock.call(f"cache.{cache_name}.misses")] * misses * count, any_order=True)
 
-    for cache_name in ("releases_data_version", "release_assets_data_versions"):
-        c = cache.caches[cache_name]
-        assert c.lookups == data_version_lookups, cache_name
-        assert c.hits == data_version_hits, cache_name
-        assert c.misses == data_version_misses, cache_name
-        mocked_incr.assert_has_calls([mock.call(f"cache.{cache_name}.hits")] * data_version_hits, any_order=True)
-        mocked_incr.assert_has_calls([mock.call(f"cache.{cache_name}.misses")] * data_version_misses, any_order=True)
+        c = cache.caches[data_version_cache_name]
+        assert c.lookups == data_version_lookups * count, data_version_cache_name
+        assert c.hits == data_version_hits * count, data_version_cache_name
+        assert c.misses == data_version_misses * count, data_version_cache_name
+        mocked_incr.assert_has_calls([mock.call(f"cache.{data_version_cache_name}.hits")] * data_version_hits * count, any_order=True)
+        mocked_incr.assert_has_calls([mock.call(f"cache.{data_version_cache_name}.misses")] * data_version_misses * count, any_order=True)
 
 
 class TestGetSystemCapabilities(unittest.TestCase):
@@ -123,6 +132,10 @@ class ClientTestBase(ClientTestCommon):
         cache.make_cache("releases_data_version", 50, 5)
         cache.make_cache("release_assets", 50, 10)
         cache.make_cache("release_assets_data_versions", 50, 5)
+        cache.make_cache("release_assets_index", 50, 5)
+        cache.make_cache("release_assets_by_path", 50, 10)
+        cache.make_cache("release_build_ids", 50, 10)
+        cache.make_cache("release_blobs", 50, 10, shared=False)
         self.version_fd, self.version_file = mkstemp()
         self.app.config["DEBUG"] = True
         self.app.config["SPECIAL_FORCE_HOSTS"] = ("http://a.com", "http://download.mozilla.org")
@@ -1367,6 +1380,14 @@ class ClientTest(ClientTestBase):
         ret = self.client.get("/update/4/gmp/1.0/1/p/l/a/a/a/a/1/update.xml")
         assert "Content-Signature" not in ret.headers
 
+    def testGMPResponseProductsAreEvaluatedTogether(self):
+        with mock.patch.object(client_api.AUS, "evaluateRulesBatch", wraps=client_api.AUS.evaluateRulesBatch) as evaluateRulesBatch:
+            ret = self.client.get("/update/4/gmp/1.0/1/p/l/a/a/a/a/1/update.xml")
+        self.assertEqual(ret.status_code, 200)
+        # Once for the query itself, and once for all of the response products
+        self.assertEqual(evaluateRulesBatch.call_count, 2)
+        self.assertEqual([query["product"] for query in evaluateRulesBatch.call_args[0][0]], ["response-a", "response-b"])
+
     @mock.patch("auslib.util.autograph.statsd.incr")
     def testGMPResponseWithSigning(self, mocked_incr):
         self.mock_autograph()
@@ -1375,6 +1396,13 @@ class ClientTest(ClientTestBase):
         assert mocked_incr.mock_calls.count(mock.call("autograph.code.500")) == 0
         assert mocked_incr.mock_calls.count(mock.call("autograph.code.200")) == 1
 
+    def testGMPResponseSignatureCoversBody(self):
+        self.mock_autograph(success=False)
+        with mock.patch("auslib.web.public.helpers.sign_hash", return_value=("abcdef", "https://this.is/a.x5u")) as sign_hash:
+            ret = self.client.get("/update/4/gmp/1.0/1/p/l/a/a/a/a/1/update.xml")
+        assert ret.headers["Content-Signature"] == "x5u=https://this.is/a.x5u; p384ecdsa=abcdef"
+        assert sign_hash.call_args[0][4] == hashlib.sha384(b"Content-Signature:\x00" + ret.get_data()).digest()
+
     @mock.patch("auslib.util.autograph.statsd.incr")
     def testGMPResponseWithSigningAutographTempFailure(self, mocked_incr):
         self.mock_autograph(failures=1)
@@ -1607,82 +1635,92 @@ class ClientTest(ClientTestBase):
             mocked_get_asset_data_versions = stack.enter_context(
                 mock.patch.object(releases_service, "get_asset_data_versions", wraps=releases_service.get_asset_data_versions)
             )
+            mocked_get_asset_index = stack.enter_context(mock.patch.object(releases_service, "get_asset_index", wraps=releases_service.get_asset_index))
+            mocked_get_asset_row = stack.enter_context(mock.patch.object(releases_service, "get_asset_row", wraps=releases_service.get_asset_row))
+            # The Releases that partials are from are covered by test_get_build_ids
+            stack.enter_context(
+                mock.patch.object(
+                    releases_service,
+                    "get_build_ids",
+                    side_effect=lambda name, locale, trans: {"WINNT_x86_64-msvc": "20170628075643"} if name == "Firefox-54.0.1-build1" else None,
+                )
+            )
             t = stack.enter_context(mock.patch("time.time"))
             mocked_incr = stack.enter_context(mock.patch("auslib.util.statsd.statsd.incr"))
-            # The lookups/hits/misses here come in multiples of 4 because we have:
-            #  - a release that the rule is pointing to
-            #  - 3 potential partials, all of which get looked at
+            # We only look at the release that the rule is pointing to, whose
+            # assets are loaded one at a time (only the en-US one is needed).
+            releases_per_cache = {"releases": 1, "release_assets": 0, "release_assets_by_path": 1}
             args = [
                 {
                     # The first query should be all misses
                     "time": 10,
-                    "lookups": 4,
+                    "lookups": 1,
                     "hits": 0,
-                    "misses": 4,
-                    "data_version_lookups": 4,
+                    "misses": 1,
+                    "data_version_lookups": 1,
                     "data_version_hits": 0,
-                    "data_version_misses": 4,
+                    "data_version_misses": 1,
                 },
                 {
                     # Make sure a look up soon after will be fully cached (including data version)
                     "time": 13,
-                    "lookups": 8,
-                    "hits": 4,
-                    "misses": 4,
-                    "data_version_lookups": 8,
-                    "data_version_hits": 4,
-                    "data_version_misses": 4,
+                    "lookups": 2,
+                    "hits": 1,
+                    "misses": 1,
+                    "data_version_lookups": 2,
+                    "data_version_hits": 1,
+                    "data_version_misses": 1,
                 },
                 {
                     # And a look up after the data version cache expires should only invalidate data version caches
                     "time": 15,
-                    "lookups": 12,
-                    "hits": 8,
-                    "misses": 4,
-                    "data_version_lookups": 12,
-                    "data_version_hits": 4,
-                    "data_version_misses": 8,
+                    "lookups": 3,
+                    "hits": 2,
+                    "misses": 1,
+                    "data_version_lookups": 3,
+                    "data_version_hits": 1,
+                    "data_version_misses": 2,
                 },
                 {
                     # And make sure the main caches invalidate at the right time
                     "time": 20,
-                    "lookups": 16,
-                    "hits": 8,
-                    "misses": 8,
-                    "data_version_lookups": 16,
-                    "data_version_hits": 4,
-                    "data_version_misses": 12,
+                    "lookups": 4,
+                    "hits": 2,
+                    "misses": 2,
+                    "data_version_lookups": 4,
+                    "data_version_hits": 1,
+                    "data_version_misses": 3,
                 },
                 {
                     # After an update if data_version is expired but the blob is not we forcibly update the blob
                     "time": 25,
-                    "lookups": 20,
-                    "hits": 12,
-                    "misses": 8,
-                    "data_version_lookups": 20,
-                    "data_version_hits": 4,
-                    "data_version_misses": 16,
+                    "lookups": 5,
+                    "hits": 3,
+                    "misses": 2,
+                    "data_version_lookups": 5,
+                    "data_version_hits": 1,
+                    "data_version_misses": 4,
                     "update": True,
                 },
                 {
                     # Fresh query with expired caches
                     "time": 30,
-                    "lookups": 24,
-                    "hits": 12,
-                    "misses": 12,
-                    "data_version_lookups": 24,
-                    "data_version_hits": 4,
-                    "data_version_misses": 20,
+                    "lookups": 6,
+                    "hits": 3,
+                    "misses": 3,
+                    "data_version_lookups": 6,
+                    "data_version_hits": 1,
+                    "data_version_misses": 5,
                 },
                 {
                     # And now check the blob is updated after assets update
                     "time": 35,
-                    "lookups": 28,
-                    "hits": 16,
-                    "misses": 12,
-                    "data_version_lookups": 28,
-                    "data_version_hits": 4,
-                    "data_version_misses": 24,
+                    "lookups": 7,
+                    "hits": 4,
+                    "misses": 3,
+                    "data_version_lookups": 7,
+                    "data_version_hits": 1,
+                    "data_version_misses": 6,
                     "update_assets": True,
                 },
             ]
@@ -1690,10 +1728,14 @@ class ClientTest(ClientTestBase):
                 t.return_value = arg["time"]
 
                 if arg.get("update"):
-                    dbo.releases_json.update(where={"name": "Firefox-54.0.1-build1"}, what={}, old_data_version=1)
+                    dbo.releases_json.update(where={"name": "Firefox-56.0-build1"}, what={}, old_data_version=1)
                 if arg.get("update_assets"):
                     dbo.release_assets.update(
-                        where={"name": "Firefox-54.0.1-build1", "path": ".platforms.Darwin_x86_64-gcc3-u-i386-x86_64.locales.af"}, what={}, old_data_version=1
+                        where={"name": "Firefox-56.0-build1", "path": ".platforms.WINNT_x86_64-msvc.locales.en-US"}, what={}, old_data_version=1
+                    )
+                    # Assets that the query doesn't need are never loaded, even if they change
+                    dbo.release_assets.update(
+                        where={"name": "Firefox-56.0-build1", "path": ".platforms.WINNT_x86_64-msvc.locales.af"}, what={}, old_data_version=1
                     )
 
                 ret = self.client.get(
@@ -1716,7 +1758,14 @@ class ClientTest(ClientTestBase):
 </updates>""",
                 )
                 validate_cache_stats(
-                    arg["lookups"], arg["hits"], arg["misses"], arg["data_version_lookups"], arg["data_version_hits"], arg["data_version_misses"], mocked_incr
+                    arg["lookups"],
+                    arg["hits"],
+                    arg["misses"],
+                    arg["data_version_lookups"],
+                    arg["data_version_hits"],
+                    arg["data_version_misses"],
+                    mocked_incr,
+                    releases_per_cache,
                 )
                 # In addition to validating cache hits and misses, we need to make
                 # sure that we didn't call the database layer more than we expected
@@ -1728,13 +1777,192 @@ class ClientTest(ClientTestBase):
                 call_count = arg["misses"]
                 if t.return_value >= 35:
                     call_count += 1
-                assert mocked_get_asset_rows.call_count == call_count
+                assert mocked_get_asset_row.call_count == call_count
+                assert mocked_get_asset_rows.call_count == 0
                 assert mocked_get_base_data_version.call_count == arg["data_version_misses"]
-                assert mocked_get_asset_data_versions.call_count == arg["data_version_misses"]
+                assert mocked_get_asset_data_versions.call_count == 0
+                assert mocked_get_asset_index.call_count == arg["data_version_misses"]
 
             assert mocked_releases_json_scheduled_changes.select.call_count == 0
             assert mocked_release_assets_scheduled_changes.select.call_count == 0
 
+    def test_get_release_for_locale(self):
+        release = releases_service.get_release_for_locale("Firefox-56.0-build1", ["WINNT_x86_64-msvc-x64"], "en-US", None)
+        # The cached Release must not have been modified.
+        self.assertEqual(cache.get("releases", "Firefox-56.0-build1")["data"]["platforms"]["WINNT_x86_64-msvc"], {"OS_BOUNCER": "win64", "OS_FTP": "win64"})
+        full = releases_service.get_release("Firefox-56.0-build1", None, include_sc=False)
+
+        platforms = release["blob"]["platforms"]
+        full_platforms = full["blob"]["platforms"]
+        # Only the locale that was asked for is loaded, on the platform that the requested one is an alias of...
+        self.assertEqual(platforms["WINNT_x86_64-msvc"]["locales"], {"en-US": full_platforms["WINNT_x86_64-msvc"]["locales"]["en-US"]})
+        self.assertEqual(platforms["WINNT_x86_64-msvc"]["OS_BOUNCER"], "win64")
+        self.assertEqual(platforms["WINNT_x86_64-msvc-x64"], full_platforms["WINNT_x86_64-msvc-x64"])
+        # ...and every other platform is still there, just without any locales.
+        self.assertEqual(platforms.keys(), full_platforms.keys())
+        self.assertEqual(platforms["Linux_x86-gcc3"]["locales"], {})
+        self.assertEqual(platforms["Linux_x86-gcc3"]["OS_FTP"], "linux-i686")
+        for key in full["blob"]:
+            if key != "platforms":
+                self.assertEqual(release["blob"][key], full["blob"][key])
+
+        self.assertEqual(release["data_versions"], {".": 1, "platforms": {"WINNT_x86_64-msvc": {"locales": {"en-US": 1}}}})
+        # Even after get_release has merged all of the assets into the cached Release.
+        release = releases_service.get_release_for_locale("Firefox-56.0-build1", ["WINNT_x86_64-msvc-x64"], "en-US", None)
+        self.assertEqual(release["blob"]["platforms"]["WINNT_x86_64-msvc"]["locales"].keys(), {"en-US"})
+
+    def test_get_release_for_locale_missing(self):
+        self.assertIsNone(releases_service.get_release_for_locale("Firefox-99.0-build1", ["WINNT_x86_64-msvc"], "en-US", None))
+        release = releases_service.get_release_for_locale("Firefox-56.0-build1", ["WINNT_x86_64-msvc"], "xx", None)
+        self.assertEqual(release["blob"]["platforms"]["WINNT_x86_64-msvc"]["locales"], {})
+        self.assertEqual(release["data_versions"], {".": 1})
+
+    def test_get_releases_for_locale(self):
+        names = ["Firefox-56.0-build1", "Firefox-99.0-build1", "Firefox-54.0.1-build1"]
+        with mock.patch.object(cache, "get_many", wraps=cache.get_many) as get_many:
+            releases = releases_service.get_releases_for_locale(names, ["WINNT_x86_64-msvc"], "en-US", None)
+            self.assertEqual(get_many.call_count, 2)
+        self.assertEqual(list(releases), names)
+        for name in names:
+            self.assertEqual(releases[name], releases_service.get_release_for_locale(name, ["WINNT_x86_64-msvc"], "en-US", None))
+
+    def test_get_release_for_locale_refreshes_stale_asset(self):
+        path = ".platforms.WINNT_x86_64-msvc.locales.de"
+        with mock.patch("time.time") as t:
+            t.return_value = 10
+            release = releases_service.get_release_for_locale("Firefox-56.0-build1", ["WINNT_x86_64-msvc"], "de", None)
+            data = release["blob"]["platforms"]["WINNT_x86_64-msvc"]["locales"]["de"]
+            self.assertEqual(data["buildID"], "20170918210324")
+
+            data = deepcopy(data)
+            data["buildID"] = "20170918210325"
+            dbo.release_assets.update(where={"name": "Firefox-56.0-build1", "path": path}, what={"data": data}, old_data_version=1)
+
+            # The asset is still cached, and so is the index that says it's fresh
+            t.return_value = 13
+            release = releases_service.get_release_for_locale("Firefox-56.0-build1", ["WINNT_x86_64-msvc"], "de", None)
+            self.assertEqual(release["blob"]["platforms"]["WINNT_x86_64-msvc"]["locales"]["de"]["buildID"], "20170918210324")
+
+            # Once the index expires, the new data_version makes us reload the asset, even though it's still cached
+            t.return_value = 16
+            release = releases_service.get_release_for_locale("Firefox-56.0-build1", ["WINNT_x86_64-msvc"], "de", None)
+            self.assertEqual(release["blob"]["platforms"]["WINNT_x86_64-msvc"]["locales"]["de"]["buildID"], "20170918210325")
+            self.assertEqual(release["data_versions"]["platforms"]["WINNT_x86_64-msvc"]["locales"]["de"], 2)
+            self.assertEqual(cache.get("release_assets_by_path", f"Firefox-56.0-build1:{path}")["data_version"], 2)
+
+    def test_get_build_ids(self):
+        name = "Firefox-54.0.1-build1"
+        with mock.patch.object(releases_service, "get_release_for_locale", wraps=releases_service.get_release_for_locale) as get_release_for_locale:
+            build_ids = releases_service.get_build_ids(name, "en-US", None)
+            self.assertEqual(build_ids["WINNT_x86_64-msvc"], "20170628075643")
+            # Aliases get the buildID of the platform that they're an alias of
+            self.assertEqual(build_ids["WINNT_x86_64-msvc-x64"], "20170628075643")
+            self.assertNotIn("xx", releases_service.get_build_ids(name, "xx", None))
+            self.assertIsNone(releases_service.get_build_ids("Firefox-99.0-build1", "en-US", None))
+            self.assertEqual(get_release_for_locale.call_count, 2)
+
+            # Cached...
+            self.assertEqual(releases_service.get_build_ids(name, "en-US", None), build_ids)
+            self.assertEqual(get_release_for_locale.call_count, 2)
+
+            # ...until one of the data_versions it came from changes.
+            path = ".platforms.WINNT_x86_64-msvc.locales.en-US"
+            data = deepcopy(releases_service.get_asset_row(name, path, None)["data"])
+            data["buildID"] = "20170628075644"
+            dbo.release_assets.update(where={"name": name, "path": path}, what={"data": data}, old_data_version=1)
+            cache.invalidate("release_assets_index", name)
+            build_ids = releases_service.get_build_ids(name, "en-US", None)
+            self.assertEqual(build_ids["WINNT_x86_64-msvc"], "20170628075644")
+            self.assertEqual(get_release_for_locale.call_count, 3)
+
+            # Other locales changing doesn't matter.
+            dbo.release_assets.update(where={"name": name, "path": ".platforms.WINNT_x86_64-msvc.locales.de"}, what={}, old_data_version=1)
+            cache.invalidate("release_assets_index", name)
+            self.assertEqual(releases_service.get_build_ids(name, "en-US", None), build_ids)
+            self.assertEqual(get_release_for_locale.call_count, 3)
+
+            dbo.releases_json.update(where={"name": name}, what={}, old_data_version=1)
+            cache.invalidate("releases_data_version", name)
+            self.assertEqual(releases_service.get_build_ids(name, "en-US", None), build_ids)
+            self.assertEqual(get_release_for_locale.call_count, 4)
+
+    def test_request_memo(self):
+        with mock.patch("auslib.util.statsd.statsd.incr") as mocked_incr:
+            self.client.get("/update/3/b/1.0/1/p/l/a/a/a/a/update.xml")
+            # The fallback channel is the same as the channel, so the second
+            # emergency shutoff check comes from the memo.
+            self.assertEqual(mocked_incr.mock_calls.count(mock.call("memo.updates_disabled.saved")), 1)
+
+            # Nothing is carried over to the next request.
+            with mock.patch("auslib.AUS.dbo.emergencyShutoffs.select", return_value=[{"product": "b", "channel": "a"}]):
+                cache.invalidate("updates_disabled", ("b", "a"))
+                ret = self.client.get("/update/3/b/1.0/1/p/l/a/a/a/a/update.xml")
+            self.assertUpdatesAreEmpty(ret)
+
+    def test_response_cache(self):
+        cache.make_cache("responses", 50, 100)
+        with mock.patch("auslib.web.public.client.render_response", wraps=client_api.render_response) as render_response:
+            ret = self.client.get("/update/3/b/1.0/1/p/l/a/a/a/a/update.xml")
+            self.assertIn('hashValue="4"', ret.get_data(as_text=True))
+            self.assertEqual(render_response.call_count, 1)
+
+            # Queries that only differ in ways that don't affect the XML share a response...
+            cached = self.client.get("/update/3/b/1.0/1/p/l/a/a/a/a/update.xml")
+            self.assertEqual(cached.get_data(), ret.get_data())
+            self.assertEqual(cached.headers["Rule-Data-Version"], ret.headers["Rule-Data-Version"])
+            self.client.get("/update/3/b/1.0/1/p/l/a/b/a/a/update.xml")
+            self.assertEqual(render_response.call_count, 1)
+
+            # ...but ones that don't, don't.
+            ret = self.client.get("/update/3/b/1.0/1/p/xh/a/a/a/a/update.xml")
+            self.assertIn('hashValue="6"', ret.get_data(as_text=True))
+            self.assertEqual(render_response.call_count, 2)
+
+            # Changing the Release gets us a new response.
+            blob = dbo.releases.getReleaseBlob("b")
+            blob["platforms"]["p"]["locales"]["l"]["complete"]["hashValue"] = "40"
+            dbo.releases.t.update().where(dbo.releases.name == "b").values(data=blob, data_version=2).execute()
+            ret = self.client.get("/update/3/b/1.0/1/p/l/a/a/a/a/update.xml")
+            self.assertIn('hashValue="40"', ret.get_data(as_text=True))
+            self.assertEqual(render_response.call_count, 3)
+
+    def test_response_cache_follows_partial_sources(self):
+        cache.make_cache("responses", 50, 100)
+        from_blob = createBlob(
+            {
+                "name": "b-old",
+                "schema_version": 1,
+                "appv": "0.9",
+                "extv": "0.9",
+                "hashFunction": "sha512",
+                "platforms": {"p": {"buildID": "1", "locales": {"l": {}}}},
+            }
+        )
+        dbo.releases.t.insert().execute(name="b-old", product="b", data_version=1, data=from_blob)
+        blob = dbo.releases.getReleaseBlob("b")
+        blob["platforms"]["p"]["locales"]["l"]["partial"] = {"filesize": "7", "from": "b-old", "hashValue": "8", "fileUrl": "http://a.com/p"}
+        dbo.releases.t.update().where(dbo.releases.name == "b").values(data=blob, data_version=2).execute()
+
+        ret = self.client.get("/update/3/b/1.0/1/p/l/a/a/a/a/update.xml")
+        self.assertIn('hashValue="8"', ret.get_data(as_text=True))
+
+        # Once the Release that the partial is from has a different buildID, it
+        # isn't served anymore, even though the Release that it's in is the same.
+        from_blob["platforms"]["p"]["buildID"] = "3"
+        dbo.releases.t.update().where(dbo.releases.name == "b-old").values(data=from_blob, data_version=2).execute()
+        ret = self.client.get("/update/3/b/1.0/1/p/l/a/a/a/a/update.xml")
+        self.assertNotIn('hashValue="8"', ret.get_data(as_text=True))
+        self.assertIn('hashValue="4"', ret.get_data(as_text=True))
+
+    @mock.patch("auslib.util.autograph.statsd.incr")
+    def test_response_cache_includes_content_signature(self, mocked_incr):
+        cache.make_cache("responses", 50, 100)
+        self.mock_autograph()
+        for _ in range(2):
+            ret = self.client.get("/update/4/gmp/1.0/1/p/l/a/a/a/a/1/update.xml")
+            assert ret.headers["Content-Signature"] == "x5u=https://this.is/a.x5u; p384ecdsa=abcdef"
+        assert mocked_incr.mock_calls.count(mock.call("autograph.code.200")) == 1
+
     def test_superblob_multiresponse_releases_json(self):
         with ExitStack() as stack:
             mocked_releases_json_scheduled_changes = stack.enter_context(mock.patch("auslib.services.releases.dbo.releases_json.scheduled_changes"))
@@ -1763,6 +1991,76 @@ class ClientTest(ClientTestBase):
             assert mocked_releases_json_scheduled_changes.select.call_count == 0
             assert mocked_release_assets_scheduled_changes.select.call_count == 0
 
+    def test_get_releases_by_names(self):
+        names = ["hotfix-bug-1548973@mozilla.org-1.1.4", "timecop@mozilla.com-1.0", "Firefox-56.0-build1", "b", "missing"]
+        with mock.patch("auslib.db.AUSTable.select", autospec=True, side_effect=AUSTable.select) as select:
+            with mock.patch.object(dbo.releases, "getReleaseInfo") as getReleaseInfo:
+                found = releases_service.get_releases_by_names(names, None)
+            # Base rows, base data versions, assets, asset data versions, and then the
+            # products and blobs of the releases that are only in the old table
+            self.assertEqual(select.call_count, 6)
+            # ...without the Rules that refer to them
+            self.assertFalse(getReleaseInfo.called)
+            self.assertEqual(set(select.call_args_list[4].kwargs["columns"]), {dbo.releases.name, dbo.releases.product, dbo.releases.data_version})
+
+        self.assertEqual(list(found), names)
+        for name in names[:3]:
+            release = releases_service.get_release(name, None, include_sc=False)
+            self.assertEqual(found[name]["release"], createBlob(release["blob"]))
+            self.assertEqual(found[name]["data_versions"], release["data_versions"])
+            self.assertEqual(found[name]["product"], releases_service.get_product(name, None))
+        self.assertEqual(found["b"], {"release": dbo.releases.getReleaseBlob("b"), "data_versions": 1, "product": "b"})
+        self.assertIsNone(found["missing"])
+
+        # Everything that's in the new tables is cached now.
+        with mock.patch("auslib.db.AUSTable.select", autospec=True, side_effect=AUSTable.select) as select:
+            self.assertEqual(releases_service.get_releases_by_names(names[:3], None), {name: found[name] for name in names[:3]})
+            self.assertEqual(select.call_count, 0)
+
+    def test_release_blobs_are_reused(self):
+        name = "Firefox-56.0-build1"
+        query = ["WINNT_x86_64-msvc"], "de", None
+
+        def built():
+            return [c.args[0]["name"] for c in create_blob.call_args_list].count(name)
+
+        with mock.patch("auslib.services.releases.createBlob", wraps=createBlob) as create_blob:
+            self.client.get("/update/6/Firefox/55.0/20170918210324/WINNT_x86_64-msvc/de/release/a/a/a/a/update.xml")
+            blob = releases_service.get_release_blob(name, releases_service.get_release_for_locale(name, *query), ("WINNT_x86_64-msvc", "de"))
+            ret = self.client.get("/update/6/Firefox/55.0/20170918210324/WINNT_x86_64-msvc/de/release/a/a/a/a/update.xml")
+            self.assertIn("firefox-56.0-complete&amp;os=win64&amp;lang=de", ret.get_data(as_text=True))
+            self.assertEqual(built(), 1)
+            self.assertEqual(blob.servingView.resolvedPlatforms["WINNT_x86_64-msvc"], "WINNT_x86_64-msvc")
+
+            # Other locales have their own Blobs
+            self.client.get("/update/6/Firefox/55.0/20170918210324/WINNT_x86_64-msvc/en-US/release/a/a/a/a/update.xml")
+            self.assertEqual(built(), 2)
+
+            # And a Release that changes is rebuilt
+            dbo.releases_json.update(where={"name": name}, what={"product": "Firefox"}, old_data_version=1)
+            cache.clear("releases")
+            cache.clear("releases_data_version")
+            release = releases_service.get_release_for_locale(name, *query)
+            self.assertIsNot(releases_service.get_release_blob(name, release, ("WINNT_x86_64-msvc", "de")), blob)
+            self.assertEqual(built(), 3)
+
+    def test_get_releases_by_names_refreshes_stale_releases(self):
+        name = "timecop@mozilla.com-1.0"
+        with mock.patch("time.time") as t:
+            t.return_value = 10
+            releases_service.get_releases_by_names([name], None)
+            dbo.releases_json.update(where={"name": name}, what={"product": "Timecop"}, old_data_version=1)
+
+            # The old row is still cached...
+            t.return_value = 13
+            self.assertEqual(releases_service.get_releases_by_names([name], None)[name]["product"], "SystemAddons")
+
+            # ...until the data_version expires.
+            t.return_value = 16
+            found = releases_service.get_releases_by_names([name], None)[name]
+            self.assertEqual(found["product"], "Timecop")
+            self.assertEqual(found["data_versions"]["."], 2)
+
     def test_serve_update_with_rule_information_in_header(self):
         ret = self.client.get("/update/6/c/1.0/1/p/l/a/a/SSE/default/a/update.xml")
         assert "Rule-ID" in ret.headers
@@ -2237,6 +2535,22 @@ class ClientTestEmergencyShutoff(ClientTestBase):
         ret = self.client.get(update_query)
         self.assertUpdateEqual(ret, self.update_xml)
 
+    def testShutoffUpdatesSnapshot(self):
+        dbo.emergencyShutoffs.enableSnapshot(3600)
+        update_query = "/update/3/b/1.0/1/p/l/a-cck-foo/a/a/a/update.xml"
+        ret = self.client.get(update_query)
+        self.assertUpdateEqual(ret, self.update_xml)
+
+        dbo.emergencyShutoffs.t.insert().execute(product="b", channel="a", data_version=1)
+
+        # Nothing changes until the snapshot is refreshed
+        ret = self.client.get(update_query)
+        self.assertUpdateEqual(ret, self.update_xml)
+
+        dbo.emergencyShutoffs.snapshot.invalidate()
+        ret = self.client.get(update_query)
+        self.assertUpdatesAreEmpty(ret)
+
     def testShutoffUpdatesFallbackChannel(self):
         update_query = "/update/3/b/1.0/1/p/l/a-cck-foo/a/a/a/update.xml"
         ret = self.client.get(update_query)
@@ -2922,3 +3236,9 @@ class ClientTestPinning(ClientTestCommon):
         # An empty pin param is rejected
         ret = self.client.get("/update/6/b/1.0/30000101000010/p/l/c/a/a/a/a/update.xml?pin=")
         self.assertEqual(ret.status_code, 400)
+
+
+class ClientTestPinningWithSnapshot(ClientTestPinning):
+    def setUp(self):
+        super(ClientTestPinningWithSnapshot, self).setUp()
+        dbo.pinnable_releases.enableSnapshot(0)
@@ -32,3 +32,25 @@ def test_get_content_signature_headers(monkeypatch):
     assert auslib.web.public.helpers.get_content_signature_headers(content, product) == {"Content-Signature": f"x5u={x5u}; p384ecdsa={ecdsa}"}
 
     assert mocksign.call_count == 1
+
+
+def test_get_content_signature_headers_with_signing_queue(monkeypatch):
+    signing_queue = MagicMock()
+    signing_queue.sign.return_value = ("foobar", "https://this.is/a.x5u")
+    mockapp = MagicMock()
+    mockapp.config = {
+        "AUTOGRAPH_product_URL": "foo://bar",
+        "AUTOGRAPH_product_KEYID": "fookeyid",
+        "AUTOGRAPH_product_USERNAME": "foousername",
+        "AUTOGRAPH_product_PASSWORD": "foopassword",
+        "SIGNING_QUEUE": signing_queue,
+    }
+    monkeypatch.setattr("auslib.web.public.helpers.app", mockapp)
+    mocksign = MagicMock()
+    monkeypatch.setattr(auslib.web.public.helpers, "sign_hash", mocksign)
+
+    headers = auslib.web.public.helpers.get_content_signature_headers("some content", "product")
+
+    assert headers == {"Content-Signature": "x5u=https://this.is/a.x5u; p384ecdsa=foobar"}
+    assert signing_queue.sign.call_count == 1
+    assert mocksign.call_count == 0